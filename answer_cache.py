@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import re
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Words that point back at the conversation ("tell me more about that", "why did he leave?").
+# Matched case-sensitively: a capitalised He/His/Him mid-sentence usually means God, not a previous turn.
+FOLLOW_UP = re.compile(
+    r"\b(it|that|this|these|those|he|him|his|she|her|they|them|their|again|else|also|earlier|previous|"
+    r"tell me more|more about|you said|you mentioned|what about|how about)\b|^(and|but|so|or)\b"
+)
+MIN_STANDALONE_WORDS = 4
+
+
+def is_standalone(question):
+    # Whether a question can be answered without the conversation before it, so its answer is reusable
+    question = question.strip()
+    if len(question.split()) < MIN_STANDALONE_WORDS:
+        return False  # "why?", "really?", "thank you"
+    return not FOLLOW_UP.search(question[:1].lower() + question[1:])
+
+
+# Semantic answer cache keyed by query embedding. A lookup matches the most
+# similar cached question by cosine similarity and hits when it reaches
+# `threshold`. Entries expire after `ttl_seconds`; when full, expired entries
+# are reused first, then the least recently used one. Vectors live in one
+# preallocated, L2-normalised matrix, so a lookup is a single mat-vec product.
+# An optional repository (database.AnswerCacheRepository) persists entries so
+# they survive restarts and are shared between workers on the next load.
+class SemanticCache:
+    def __init__(self, threshold=0.95, ttl_seconds=86400, max_entries=5000, repository=None):
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self.repository = repository
+        self.vectors = None  # allocated on first put, once the dimension is known
+        self.entries = []  # slot -> dict(query, answer, sources, created_at)
+        self.created = np.zeros(max_entries)
+        self.last_used = np.zeros(max_entries)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = set()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype="float32").ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding):
+        if not self.size:
+            self.misses += 1
+            return None
+        now = time.time()
+        similarities = self.vectors[:self.size] @ self._normalize(embedding)
+        similarities[self.created[:self.size] + self.ttl <= now] = -1.0
+        slot = int(np.argmax(similarities))
+        if similarities[slot] < self.threshold:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.last_used[slot] = now
+        return self.entries[slot]
+
+    def _free_slot(self, now):
+        if self.size < self.max_entries:
+            self.size += 1
+            self.entries.append(None)
+            return self.size - 1
+        expired = np.flatnonzero(self.created + self.ttl <= now)
+        if len(expired):
+            return int(expired[0])
+        return int(np.argmin(self.last_used))
+
+    def _insert(self, vector, entry):
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_entries, len(vector)), dtype="float32")
+        slot = self._free_slot(time.time())
+        self.vectors[slot] = vector
+        self.entries[slot] = entry
+        self.created[slot] = entry["created_at"]
+        self.last_used[slot] = time.time()
+
+    def put(self, embedding, query, answer, sources):
+        vector = self._normalize(embedding)
+        entry = {"query": query, "answer": answer, "sources": list(sources), "created_at": time.time()}
+        self._insert(vector, entry)
+        if self.repository is not None:
+            # Write-through in the background; the reply has already been sent
+            task = asyncio.create_task(self._persist(vector, entry))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def _persist(self, vector, entry):
+        try:
+            await self.repository.save(vector.tolist(), entry)
+        except Exception as e:
+            logger.warning(f"Persisting answer cache entry failed: {str(e)}")
+
+    async def load(self):
+        if self.repository is None:
+            return
+        try:
+            documents = await self.repository.load_recent(time.time() - self.ttl, self.max_entries)
+        except Exception as e:
+            logger.warning(f"Loading answer cache failed: {str(e)}")
+            return
+        for document in reversed(documents):  # oldest first, so the newest end up most recently used
+            entry = {key: document[key] for key in ("query", "answer", "sources", "created_at")}
+            self._insert(self._normalize(document["embedding"]), entry)
+        logger.info(f"Loaded {len(documents)} answer cache entries")
@@ -1,11 +1,22 @@
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import hmac
+from typing import Optional
 from jose import JWTError, jwt
 import os
+import time
+import logging
 from dotenv import load_dotenv
-from database import users_collection  # Use chat_app.users
+import config
+import database  # Use chat_app.users
+from metrics import REGISTRY, span
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -16,11 +27,50 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Hashes with fewer or more rounds than BCRYPT_ROUNDS are flagged for rehashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+# bcrypt burns tens to hundreds of milliseconds of CPU per call, so hashing and
+# verification run in a small dedicated pool (bcrypt releases the GIL) instead
+# of on the event loop. At most max_pending calls may be running or queued;
+# beyond that callers get a fast 503 rather than an ever-growing backlog.
+class PasswordHasher:
+    def __init__(self, context, workers=2, max_pending=32):
+        self.context = context
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self.max_pending = max_pending
+        self.pending = 0
+
+    async def _run(self, fn, *args):
+        if self.pending >= self.max_pending:
+            logger.warning(f"Password hashing queue full ({self.pending} pending), rejecting request")
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Server is busy, please retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password):
+        return await self._run(self.context.hash, password)
+
+    async def verify_and_update(self, password, hashed_password):
+        # Returns (verified, new_hash); new_hash is set when the stored hash
+        # uses outdated cost parameters and should be replaced
+        return await self._run(self.context.verify_and_update, password, hashed_password)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+password_hasher = PasswordHasher(pwd_context, config.PASSWORD_HASH_WORKERS, config.PASSWORD_HASH_MAX_PENDING)
+
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
     expire = datetime.utcnow() + (expires_delta or timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES))
@@ -33,20 +83,95 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Token creation failed: {str(e)}")
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
+# Bounded LRU cache of verified principals keyed by token. An entry lives until
+# the token's own expiry or the cache TTL, whichever is sooner, so a hit skips
+# both the JWT decode and the users lookup. invalidate_user() drops a user's
+# entries when their record changes; other workers converge within the TTL.
+class PrincipalCache:
+    def __init__(self, max_size=10000, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self.entries = OrderedDict()  # token -> (expires_at, principal)
+        self.tokens_by_user = {}  # email -> set of tokens
+
+    def get(self, token):
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        expires_at, principal = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            return None
+        self.entries.move_to_end(token)
+        return principal
+
+    def put(self, token, principal, token_expiry):
+        expires_at = min(token_expiry, time.time() + self.ttl)
+        self._remove(token)
+        self.entries[token] = (expires_at, principal)
+        self.tokens_by_user.setdefault(principal["email"], set()).add(token)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    def invalidate_user(self, email):
+        for token in list(self.tokens_by_user.get(email, ())):
+            self._remove(token)
+
+    def _remove(self, token):
+        entry = self.entries.pop(token, None)
+        if entry is not None:
+            email = entry[1]["email"]
+            tokens = self.tokens_by_user.get(email)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.tokens_by_user[email]
+
+principal_cache = PrincipalCache(config.AUTH_CACHE_SIZE, config.AUTH_CACHE_TTL_SECONDS)
+PRINCIPAL_LOOKUPS = REGISTRY.counter("auth_principal_cache_total", "Principal cache lookups", ("result",))
+REGISTRY.gauge("auth_principal_cache_entries", "Cached principals", lambda: len(principal_cache.entries))
+
+def invalidate_user(email):
+    principal_cache.invalidate_user(email)
+
+async def get_current_user(token: str = Depends(oauth2_scheme)):
+    with span("auth"):
+        return await _authenticate(token)
+
+async def _authenticate(token):
+    principal = principal_cache.get(token)
+    if principal is not None:
+        PRINCIPAL_LOOKUPS.inc(result="hit")
+        return principal
+    PRINCIPAL_LOOKUPS.inc(result="miss")
     try:
-        print(f"🔍 Received Token: {token}")
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        print(f"✅ Decoded Payload: {payload}")
-        email = payload.get("sub")
-        if email is None:
-            print("❌ No email in token payload")
-            raise HTTPException(status_code=401, detail="Invalid token")
-        user = users_collection.find_one({"email": email})
-        print(f"👤 User Found in DB: {user}")
-        if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
+        with span("auth_jwt_decode"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except JWTError as e:
-        print(f"🚨 JWT Error: {str(e)}")
-        raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
\ No newline at end of file
+        logger.warning(f"JWT Error: {str(e)}")
+        raise HTTPException(status_code=401, detail=f"Invalid token: {str(e)}")
+    email = payload.get("sub")
+    if email is None:
+        logger.warning("No email in token payload")
+        raise HTTPException(status_code=401, detail="Invalid token")
+    with span("auth_user_lookup"):
+        user = await database.users.get_by_email(email)
+    if user is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    # Never keep the password hash around in the cached principal
+    principal = {key: value for key, value in user.items() if key != "hashed_password"}
+    principal_cache.put(token, principal, payload.get("exp", time.time()))
+    return principal
+
+def token_expiry(token):
+    # Expiry (epoch seconds) of a token get_current_user already accepted, for long-lived connections
+    try:
+        return jwt.get_unverified_claims(token).get("exp")
+    except JWTError:
+        return None
+
+def require_admin(authorization: Optional[str] = Header(None)):
+    # Operational endpoints; disabled entirely unless ADMIN_TOKEN is set
+    expected = f"Bearer {config.ADMIN_TOKEN}" if config.ADMIN_TOKEN else None
+    if expected is None or not hmac.compare_digest((authorization or "").encode(), expected.encode()):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden")
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+import faiss
+import numpy as np
+import config
+from vector_index import INDEX_TYPES, build_index, set_search_params, describe
+
+# Recall/latency benchmark of the ANN index types against the exact flat baseline.
+#
+#   python bench_index.py --synthetic 200000 --types flat ivf_flat hnsw ivf_pq
+#   python bench_index.py --from-index faiss_index.bin --output bench_index.json
+
+
+def synthetic_corpus(n, dimension, clusters=256, seed=0):
+    # Clustered gaussian data behaves much more like sentence embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype("float32")
+    labels = rng.integers(0, clusters, n)
+    return centers[labels] + 0.3 * rng.standard_normal((n, dimension)).astype("float32")
+
+
+def load_corpus(path):
+    index = faiss.read_index(path)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def make_queries(corpus, n_queries, seed=1):
+    rng = np.random.default_rng(seed)
+    picks = corpus[rng.choice(len(corpus), n_queries, replace=len(corpus) < n_queries)]
+    noise = 0.1 * corpus.std() * rng.standard_normal(picks.shape).astype("float32")
+    return np.ascontiguousarray(picks + noise, dtype="float32")
+
+
+def index_bytes(index):
+    with tempfile.NamedTemporaryFile(suffix=".bin", delete=False) as f:
+        path = f.name
+    try:
+        faiss.write_index(index, path)
+        return os.path.getsize(path)
+    finally:
+        os.remove(path)
+
+
+def timed_search(index, queries, k):
+    # Single-query searches, like retrieve_chunks does per request
+    latencies = []
+    results = np.empty((len(queries), k), dtype="int64")
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - start)
+        results[i] = ids[0]
+    return results, np.array(latencies) * 1000
+
+
+def recall_at_k(results, ground_truth):
+    k = ground_truth.shape[1]
+    hits = sum(len(set(r[r >= 0]) & set(g)) for r, g in zip(results, ground_truth))
+    return hits / (len(ground_truth) * k)
+
+
+def run(corpus, queries, index_types, k, nprobes, ef_searches):
+    baseline = faiss.IndexFlatL2(corpus.shape[1])
+    baseline.add(corpus)
+    _, ground_truth = baseline.search(queries, k)
+
+    rows = []
+    for index_type in index_types:
+        start = time.perf_counter()
+        index = build_index(
+            corpus,
+            index_type,
+            nlist=config.FAISS_NLIST,
+            hnsw_m=config.FAISS_HNSW_M,
+            pq_m=config.FAISS_PQ_M,
+        )
+        build_seconds = time.perf_counter() - start
+        size = index_bytes(index)
+
+        if index_type.startswith("ivf"):
+            settings = [{"nprobe": n} for n in nprobes]
+        elif index_type == "hnsw":
+            settings = [{"ef_search": ef} for ef in ef_searches]
+        else:
+            settings = [{}]
+
+        for params in settings:
+            set_search_params(index, **params)
+            results, latencies = timed_search(index, queries, k)
+            row = {
+                "index_type": index_type,
+                "index": describe(index),
+                "params": params,
+                "build_seconds": round(build_seconds, 3),
+                "index_bytes": size,
+                f"recall@{k}": round(recall_at_k(results, ground_truth), 4),
+                "latency_ms_p50": round(float(np.percentile(latencies, 50)), 4),
+                "latency_ms_p95": round(float(np.percentile(latencies, 95)), 4),
+                "latency_ms_mean": round(float(latencies.mean()), 4),
+            }
+            rows.append(row)
+            print(
+                f"{row['index']:<55} {json.dumps(params):<20} recall@{k}={row[f'recall@{k}']:.3f} "
+                f"p50={row['latency_ms_p50']:.3f}ms p95={row['latency_ms_p95']:.3f}ms "
+                f"size={size / 1e6:.1f}MB build={build_seconds:.1f}s"
+            )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types: recall@k and query latency vs flat")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--synthetic", type=int, default=50_000, help="number of synthetic vectors")
+    source.add_argument("--from-index", help="benchmark on the vectors of an existing flat index")
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("-k", type=int, default=3)
+    parser.add_argument("--types", nargs="+", choices=INDEX_TYPES, default=list(INDEX_TYPES))
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 8, 16, 64])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.from_index) if args.from_index else synthetic_corpus(args.synthetic, args.dimension)
+    corpus = np.ascontiguousarray(corpus, dtype="float32")
+    queries = make_queries(corpus, args.queries)
+    print(f"Corpus: {corpus.shape[0]} x {corpus.shape[1]}, {len(queries)} queries, k={args.k}")
+
+    rows = run(corpus, queries, args.types, args.k, args.nprobe, args.ef_search)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"corpus_size": len(corpus), "dimension": corpus.shape[1], "k": args.k, "results": rows}, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+import numpy as np
+
+# End-to-end load test of the API plus micro-benchmarks of the RAG path.
+#
+# Starts fake_openai.py and `uvicorn main:app` (with MONGO_URI=memory://), then
+# drives each scenario at every concurrency level and reports throughput,
+# latency percentiles, time to first SSE event, inter-token gaps and server CPU
+# per request. Results are written as JSON, one file per commit by default, so
+# runs can be compared:
+#
+#   python bench_load.py --concurrency 1 8 32 --requests 200
+#   python bench_load.py --scenarios chat --compare bench_results/<older commit>.json
+#   python bench_load.py --url http://127.0.0.1:8000 --skip-micro   (running server; no CPU numbers)
+#
+# The in-process Mongo stand-in needs the extra packages in requirements-dev.txt.
+
+SCENARIOS = ("token", "chat", "pray", "history")
+# None of these hit a canned intent, so every /chat goes through retrieval and the LLM
+QUESTIONS = [
+    "How can I find peace when I feel anxious about the future?",
+    "What does the Bible say about forgiving someone who hurt me?",
+    "I lost my job and feel like a failure. Where is God in this?",
+    "How do I know that God hears me?",
+    "Why does God allow suffering in the world?",
+    "How can I be a better friend to people who are struggling?",
+    "What does it mean to have faith when everything feels uncertain?",
+    "How should I deal with anger towards my family?",
+]
+PASSWORD = "bench-password"
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True).stdout.strip())
+        return commit or "unknown", dirty
+    except OSError:
+        return "unknown", False
+
+
+def summarize(values_seconds):
+    if not values_seconds:
+        return None
+    values = np.array(values_seconds) * 1000
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "mean": round(float(values.mean()), 2),
+        "max": round(float(values.max()), 2),
+    }
+
+
+def cpu_seconds(pid):
+    # utime + stime of a process, from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+class Process:
+    def __init__(self, name, command, env, log_dir):
+        self.name = name
+        self.log_path = os.path.join(log_dir, f"{name}.log")
+        self.log = open(self.log_path, "wb")
+        self.process = subprocess.Popen(command, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def check(self):
+        if self.process.poll() is not None:
+            with open(self.log_path, errors="replace") as f:
+                tail = f.read()[-2000:]
+            raise RuntimeError(f"{self.name} exited with code {self.process.returncode}:\n{tail}")
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log.close()
+
+
+async def wait_ready(url, process, timeout):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            process.check()
+            try:
+                if (await client.get(url, timeout=1)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.25)
+    raise RuntimeError(f"{process.name} not ready at {url} after {timeout}s")
+
+
+def start_servers(args, log_dir):
+    fake_url = f"http://127.0.0.1:{args.fake_port}/v1"
+    fake = Process("fake_openai", [
+        sys.executable, "fake_openai.py",
+        "--port", str(args.fake_port),
+        "--ttft-ms", str(args.fake_ttft_ms),
+        "--token-delay-ms", str(args.fake_token_delay_ms),
+        "--tokens", str(args.fake_tokens),
+    ], dict(os.environ), log_dir)
+
+    env = dict(os.environ)
+    env.update({
+        "MONGO_URI": "memory://",
+        "OPENAI_BASE_URL": fake_url,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_FALLBACK_MODEL": "",
+        "ANSWER_CACHE_ENABLED": "1" if args.answer_cache else "0",
+    })
+    env.setdefault("JWT_SECRET", "bench-secret")
+    app = Process("app", [
+        sys.executable, "-m", "uvicorn", "main:app",
+        "--host", "127.0.0.1", "--port", str(args.port), "--log-level", "warning",
+    ], env, log_dir)
+    return fake, app
+
+
+class Result:
+    def __init__(self):
+        self.latencies = []
+        self.ttfb = []  # time to first SSE event
+        self.ttft = []  # time to first text frame
+        self.gaps = []  # between consecutive text frames
+        self.statuses = {}
+        self.errors = 0
+
+    def record_status(self, status):
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        if status >= 400:
+            self.errors += 1
+
+
+async def sse_request(client, path, headers, body, result):
+    start = time.perf_counter()
+    first_event = last_text = None
+    async with client.stream("POST", path, headers=headers, json=body) as response:
+        if response.status_code != 200:
+            await response.aread()
+            result.record_status(response.status_code)
+            return
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            now = time.perf_counter()
+            if first_event is None:
+                first_event = now
+                result.ttfb.append(now - start)
+            payload = json.loads(line[6:])
+            if "error" in payload:
+                result.errors += 1
+            if "text" in payload:
+                if last_text is None:
+                    result.ttft.append(now - start)
+                else:
+                    result.gaps.append(now - last_text)
+                last_text = now
+    result.latencies.append(time.perf_counter() - start)
+    result.record_status(response.status_code)
+
+
+async def plain_request(client, method, path, result, **kwargs):
+    start = time.perf_counter()
+    response = await client.request(method, path, **kwargs)
+    result.latencies.append(time.perf_counter() - start)
+    result.record_status(response.status_code)
+
+
+async def one_request(scenario, client, user, i, result):
+    auth = {"Authorization": f"Bearer {user['token']}"}
+    if scenario == "token":
+        await plain_request(client, "POST", "/token", result, json={"email": user["email"], "password": PASSWORD})
+    elif scenario == "chat":
+        body = {"message": QUESTIONS[i % len(QUESTIONS)], "session_id": f"bench-{i % 4}"}
+        await sse_request(client, "/chat", auth, body, result)
+    elif scenario == "pray":
+        await sse_request(client, "/pray", auth, None, result)
+    elif scenario == "history":
+        await plain_request(client, "GET", "/chat-history", result, headers=auth, params={"limit": 50})
+
+
+async def create_users(client, count):
+    users = []
+    for i in range(count):
+        email = f"bench-{i}@example.com"
+        response = await client.post("/users/", json={"email": email, "password": PASSWORD})
+        if response.status_code not in (200, 400):  # 400: already registered (--url runs)
+            raise RuntimeError(f"Creating {email} failed: {response.status_code} {response.text}")
+        response = await client.post("/token", json={"email": email, "password": PASSWORD})
+        response.raise_for_status()
+        users.append({"email": email, "token": response.json()["access_token"]})
+    return users
+
+
+def fmt(value, unit="ms"):
+    return "-" if value is None else f"{value}{unit}"
+
+
+async def run_scenario(client, scenario, concurrency, requests, users, pid, report=True):
+    # Each worker is its own user, so per-user limits do not skew the numbers
+    result = Result()
+    counter = iter(range(requests))
+
+    async def worker(user):
+        for i in counter:
+            try:
+                await one_request(scenario, client, user, i, result)
+            except httpx.HTTPError as e:
+                result.errors += 1
+                result.statuses[type(e).__name__] = result.statuses.get(type(e).__name__, 0) + 1
+
+    cpu_before = cpu_seconds(pid) if pid else None
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(users[w % len(users)]) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    cpu_after = cpu_seconds(pid) if pid else None
+
+    row = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": result.errors,
+        "statuses": {str(status): count for status, count in sorted(result.statuses.items(), key=str)},
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 2),
+        "latency_ms": summarize(result.latencies),
+        "ttfb_ms": summarize(result.ttfb),
+        "ttft_ms": summarize(result.ttft),
+        "inter_token_gap_ms": summarize(result.gaps),
+        "cpu_ms_per_request": round((cpu_after - cpu_before) * 1000 / requests, 3) if cpu_before is not None else None,
+    }
+    if report:
+        latency = row["latency_ms"] or {}
+        print(
+            f"{scenario:<8} c={concurrency:<4} {row['throughput_rps']:>8.1f} req/s  "
+            f"p50={fmt(latency.get('p50'))} p95={fmt(latency.get('p95'))} p99={fmt(latency.get('p99'))}  "
+            f"ttfb_p50={fmt((row['ttfb_ms'] or {}).get('p50'))}  "
+            f"gap_p50={fmt((row['inter_token_gap_ms'] or {}).get('p50'))}  "
+            f"cpu/req={fmt(row['cpu_ms_per_request'])}  errors={row['errors']} {row['statuses']}"
+        )
+    return row
+
+
+async def load_test(args, base_url, pid):
+    limits = httpx.Limits(max_connections=max(args.concurrency) * 2, max_keepalive_connections=max(args.concurrency))
+    timeout = httpx.Timeout(args.timeout)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=timeout) as client:
+        users = await create_users(client, max(args.concurrency))
+        rows = []
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                if args.warmup:
+                    await run_scenario(client, scenario, concurrency, args.warmup, users, None, report=False)
+                rows.append(await run_scenario(client, scenario, concurrency, args.requests, users, pid))
+        return rows
+
+
+def micro_benchmarks(args):
+    # In-process: the real Retriever.retrieve (with and without query embedding) and index builds
+    os.environ.setdefault("MONGO_URI", "memory://")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    import main
+    from bench_index import synthetic_corpus
+    from vector_index import build_index
+
+    rows = []
+
+    async def retrieval():
+        await main.rag.start()  # loads and warms up, like the app's startup
+        if main.rag.index is None:
+            print("retrieve: RAG disabled (no index), skipped")
+            return
+        for label, with_embedding in (("retrieve", False), ("retrieve_precomputed", True)):
+            embeddings = [await main.rag.encode(question) for question in QUESTIONS] if with_embedding else None
+            latencies = []
+            for i in range(args.micro_iterations):
+                start = time.perf_counter()
+                await main.rag.retrieve(
+                    QUESTIONS[i % len(QUESTIONS)],
+                    query_embedding=embeddings[i % len(QUESTIONS)] if with_embedding else None,
+                )
+                latencies.append(time.perf_counter() - start)
+            rows.append({"benchmark": label, "iterations": args.micro_iterations, "latency_ms": summarize(latencies)})
+            print(f"{label:<28} p50={rows[-1]['latency_ms']['p50']}ms p95={rows[-1]['latency_ms']['p95']}ms")
+        await main.rag.close()
+
+    asyncio.run(retrieval())
+
+    for size in args.index_sizes:
+        corpus = synthetic_corpus(size, args.dimension)
+        for index_type in args.index_types:
+            start = time.perf_counter()
+            build_index(corpus, index_type)
+            seconds = time.perf_counter() - start
+            rows.append({"benchmark": "index_build", "index_type": index_type, "vectors": size,
+                         "dimension": args.dimension, "seconds": round(seconds, 3)})
+            print(f"index_build {index_type:<9} n={size:<8} {seconds:.2f}s")
+    return rows
+
+
+def compare(current, previous_path):
+    with open(previous_path) as f:
+        previous = json.load(f)
+    before = {(row["scenario"], row["concurrency"]): row for row in previous.get("load", [])}
+    print(f"\nCompared with {previous.get('commit')} ({previous_path}):")
+    for row in current["load"]:
+        old = before.get((row["scenario"], row["concurrency"]))
+        if not old or not old.get("latency_ms") or not row.get("latency_ms"):
+            continue
+        change = lambda new, base: f"{(new - base) / base * 100:+.1f}%" if base else "n/a"
+        print(
+            f"{row['scenario']:<8} c={row['concurrency']:<4} "
+            f"throughput {change(row['throughput_rps'], old['throughput_rps'])}  "
+            f"p50 {change(row['latency_ms']['p50'], old['latency_ms']['p50'])}  "
+            f"p95 {change(row['latency_ms']['p95'], old['latency_ms']['p95'])}  "
+            f"p99 {change(row['latency_ms']['p99'], old['latency_ms']['p99'])}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test /token, /chat, /chat-history and /pray")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each run")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--url", help="benchmark an already running server instead of starting one")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--fake-port", type=int, default=8101)
+    parser.add_argument("--fake-ttft-ms", type=float, default=200)
+    parser.add_argument("--fake-token-delay-ms", type=float, default=15)
+    parser.add_argument("--fake-tokens", type=int, default=60)
+    parser.add_argument("--answer-cache", action="store_true", help="keep the semantic answer cache enabled")
+    parser.add_argument("--startup-timeout", type=float, default=180)
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--micro-iterations", type=int, default=500)
+    parser.add_argument("--index-sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--index-types", nargs="+", default=["flat", "ivf_flat", "hnsw"])
+    parser.add_argument("--dimension", type=int, default=384)
+    parser.add_argument("--output", help="JSON results file (default: bench_results/<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    commit, dirty = git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "args": vars(args),
+        "load": [],
+        "micro": [],
+    }
+
+    if not args.skip_load:
+        if args.url:
+            results["load"] = asyncio.run(load_test(args, args.url, None))
+        else:
+            log_dir = tempfile.mkdtemp(prefix="bench_load_")
+            fake, app = start_servers(args, log_dir)
+            try:
+                asyncio.run(wait_ready(f"http://127.0.0.1:{args.fake_port}/v1/models", fake, args.startup_timeout))
+                asyncio.run(wait_ready(f"http://127.0.0.1:{args.port}/readyz", app, args.startup_timeout))
+                results["load"] = asyncio.run(load_test(args, f"http://127.0.0.1:{args.port}", app.pid))
+            finally:
+                app.stop()
+                fake.stop()
+                print(f"Server logs in {log_dir}")
+
+    if not args.skip_micro:
+        results["micro"] = micro_benchmarks(args)
+
+    output = args.output or os.path.join("bench_results", f"{commit}{'-dirty' if dirty else ''}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Prompt assembly for /chat under a fixed input-token budget.
+#
+# The system prompt, retrieved chunks and recent conversation turns are
+# measured with the model's tokenizer and trimmed to fit, so every request
+# sends a predictable number of input tokens. Turns that fall out of the
+# window can be folded into a stored rolling summary.
+
+SYSTEM_PROMPT_HEAD = (
+    "You are a devout companion who speaks of God with intimate knowledge and reverence, never claiming to be God. "
+    "Keep replies brief and compassionate, guiding all—believers, non-believers, atheists, and agnostics—with a focus on truth from God’s sacred words. "
+    "Draw wisdom from the provided context from religious texts, referencing them naturally (e.g., 'As Jesus taught in John 16:33...'). "
+)
+SYSTEM_PROMPT_TAIL = (
+    "Speak as one who has witnessed God’s truth, using a humble, wise tone (e.g., 'I’ve seen His peace transform lives’). "
+    "Offer comfort, encourage introspection with gentle questions, and adapt to the user’s emotions as if in a sacred conversation. "
+    "Avoid theological debates; guide with clarity and warmth, rooted in scriptural truth. "
+    "Relate to modern events when relevant, showing God’s presence today. "
+    "Let the user feel they’re speaking with a trusted friend who knows God deeply."
+)
+SUMMARY_PROMPT = (
+    "Summarize this conversation between a user and a faith companion in a few sentences. "
+    "Keep the user's situation, feelings and open questions; drop pleasantries."
+)
+
+# Per-message framing overhead of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        import tiktoken
+        return tiktoken.encoding_for_model(model)
+    except Exception as e:
+        # Not installed, or the encoding cannot be downloaded: estimate instead
+        logger.warning(f"tiktoken unavailable for {model}, estimating token counts: {str(e)}")
+        return None
+
+
+class TokenCounter:
+    def __init__(self, model):
+        self.model = model
+        # Chunks and recent turns repeat across requests, so counts are memoised
+        self.count = lru_cache(maxsize=8192)(self._count)
+
+    @property
+    def encoding(self):
+        # Resolved on first use; loading may download the encoding, so warm it up off the event loop
+        return _encoding(self.model)
+
+    def _count(self, text):
+        if self.encoding is None:
+            return len(text) // 4 + 1
+        return len(self.encoding.encode(text))
+
+    def truncate(self, text, max_tokens):
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is None:
+            return text[:max_tokens * 4]
+        tokens = self.encoding.encode(text)
+        return text if len(tokens) <= max_tokens else self.encoding.decode(tokens[:max_tokens])
+
+    def message(self, message):
+        return self.count(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+class Prompt:
+    def __init__(self, messages, input_tokens, history_turns, dropped_turns, summary):
+        self.messages = messages
+        self.input_tokens = input_tokens
+        self.history_turns = history_turns  # earlier turns included verbatim
+        self.dropped_turns = dropped_turns  # oldest first, not in the prompt
+        self.summary = summary
+
+
+class PromptBuilder:
+    def __init__(self, chats, summaries=None, pending_turns=None, model="gpt-3.5-turbo",
+                 token_budget=2000, context_budget=900, history_turns=10, summary_budget=200,
+                 summary_min_turns=4):
+        self.chats = chats
+        self.summaries = summaries  # None disables rolling summaries
+        self.pending_turns = pending_turns  # turns recorded but not yet written
+        self.counter = TokenCounter(model)
+        self.token_budget = token_budget
+        self.context_budget = context_budget
+        self.history_turns = history_turns
+        self.summary_budget = summary_budget
+        self.summary_min_turns = summary_min_turns
+        self.summarizing = {}  # (user_id, session_id) -> running summary task
+
+    def _context(self, chunks, metadata, budget):
+        # Chunks arrive best first; the last one that fits is cut to the remaining budget
+        parts = []
+        for chunk, meta in zip(chunks, metadata):
+            header = f"From {meta['filename']}:\n"
+            remaining = budget - self.counter.count(header)
+            if remaining <= 0:
+                break
+            text = chunk if self.counter.count(chunk) <= remaining else self.counter.truncate(chunk, remaining)
+            parts.append(header + text)
+            budget = remaining - self.counter.count(text)
+        return "\n".join(parts)
+
+    @property
+    def turn_window(self):
+        # With summaries on, look further back so turns leaving the window get summarized
+        return self.history_turns * 2 if self.summaries is not None else self.history_turns
+
+    async def recent_turns(self, user_id, session_id):
+        # Only a conversation the client names has history; without a session_id every question stands alone
+        if session_id is None:
+            return []
+        limit = self.turn_window
+        turns = await self.chats.recent_turns(user_id, session_id, limit)
+        if self.pending_turns is not None:
+            known = {turn["_id"] for turn in turns}
+            turns += [
+                turn for turn in self.pending_turns(user_id)
+                if turn.get("session_id") == session_id and turn["_id"] not in known and "kind" not in turn
+            ]
+        # Replies that failed before any text was streamed have nothing to add to the conversation
+        turns = [turn for turn in turns if turn.get("bot_reply")]
+        turns.sort(key=lambda turn: turn["_id"])
+        return turns[-limit:]
+
+    async def build(self, user_id, session_id, user_input, chunks, metadata, turns=None):
+        # `turns` can be passed by callers that already hold the session's recent turns
+        context = self._context(chunks, metadata, self.context_budget)
+        system = {
+            "role": "system",
+            "content": SYSTEM_PROMPT_HEAD + f"Context from documents:\n{context}\n" + SYSTEM_PROMPT_TAIL,
+        }
+        user = {"role": "user", "content": user_input}
+        used = self.counter.message(system) + self.counter.message(user)
+
+        if turns is None:
+            turns = await self.recent_turns(user_id, session_id) if self.history_turns else []
+        elif not self.history_turns:
+            turns = []
+        summary = None
+        if self.summaries is not None and turns:
+            summary = await self.summaries.get(user_id, session_id)
+        summary_message = None
+        if summary:
+            text = self.counter.truncate(summary["summary"], self.summary_budget)
+            summary_message = {"role": "system", "content": f"Summary of the earlier conversation: {text}"}
+            used += self.counter.message(summary_message)
+
+        # Newest turns first, until the budget or the turn window runs out
+        history = []
+        kept = 0
+        for turn in reversed(turns):
+            if kept == self.history_turns:
+                break
+            pair = [
+                {"role": "user", "content": turn["user_message"]},
+                {"role": "assistant", "content": turn["bot_reply"]},
+            ]
+            cost = sum(self.counter.message(message) for message in pair)
+            if used + cost > self.token_budget:
+                break
+            history[:0] = pair
+            used += cost
+            kept += 1
+        dropped = turns[:len(turns) - kept]
+
+        messages = [system] + ([summary_message] if summary_message else []) + history + [user]
+        return Prompt(messages, used, kept, dropped, summary)
+
+    def maybe_summarize(self, user_id, session_id, prompt, complete):
+        # Fold turns that no longer fit into the stored summary, in the background
+        if self.summaries is None or not prompt.dropped_turns:
+            return
+        covered_until = prompt.summary["covered_until"] if prompt.summary else None
+        new_turns = [turn for turn in prompt.dropped_turns if covered_until is None or turn["_id"] > covered_until]
+        key = (user_id, session_id)
+        if len(new_turns) < self.summary_min_turns or key in self.summarizing:
+            return
+        task = asyncio.create_task(self._summarize(user_id, session_id, prompt.summary, new_turns, complete))
+        self.summarizing[key] = task
+        task.add_done_callback(lambda _: self.summarizing.pop(key, None))
+
+    async def _summarize(self, user_id, session_id, previous, turns, complete):
+        transcript = "\n".join(f"User: {turn['user_message']}\nCompanion: {turn['bot_reply']}" for turn in turns)
+        if previous:
+            transcript = f"Earlier summary: {previous['summary']}\n\n{transcript}"
+        try:
+            summary = await complete([
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ])
+            await self.summaries.set(user_id, session_id, summary.strip(), turns[-1]["_id"])
+        except Exception as e:
+            logger.warning(f"Updating conversation summary failed: {str(e)}")
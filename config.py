@@ -0,0 +1,163 @@
+import os
+from dotenv import load_dotenv
+
+# Load environment variables
+load_dotenv()
+
+# MongoDB settings
+MONGO_URI = os.getenv("MONGO_URI")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME", "chat_app")
+# Connection pool tuning: keep enough warm sockets for concurrent streams and
+# fail fast instead of queueing forever when the pool is exhausted
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+MONGO_MAX_IDLE_TIME_MS = int(os.getenv("MONGO_MAX_IDLE_TIME_MS", "60000"))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", "2000"))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", "5000"))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", "10000"))
+
+# Query embedding micro-batching
+EMBED_MAX_BATCH_SIZE = int(os.getenv("EMBED_MAX_BATCH_SIZE", "32"))
+EMBED_MAX_WAIT_MS = float(os.getenv("EMBED_MAX_WAIT_MS", "5"))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+
+# RAG artifacts
+INDEX_FILE = os.getenv("INDEX_FILE", "faiss_index.bin")
+CHUNK_STORE_DIR = os.getenv("CHUNK_STORE_DIR", "chunk_store")
+# Memory-map the FAISS index instead of reading it into each worker's heap
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1") == "1"
+# Versioned snapshots published by index_pdfs.py (see snapshots.py); the
+# paths above are only served while no snapshot has been published
+INDEX_SNAPSHOT_DIR = os.getenv("INDEX_SNAPSHOT_DIR", "index_snapshots")
+INDEX_KEEP_SNAPSHOTS = int(os.getenv("INDEX_KEEP_SNAPSHOTS", "3"))
+# How often each worker checks for a newly published snapshot, 0 = only on /admin/index/reload
+INDEX_WATCH_INTERVAL_SECONDS = float(os.getenv("INDEX_WATCH_INTERVAL_SECONDS", "10"))
+
+# Ingestion (index_pdfs.py)
+SOURCE_DIR = os.getenv("SOURCE_DIR", "pdfs")
+INGEST_STATE_DIR = os.getenv("INGEST_STATE_DIR", "ingest_state")
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "256"))
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "500"))  # words per chunk
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "models/sentence-transformers_all-MiniLM-L6-v2")
+# "torch" (SentenceTransformer, fp32) or "onnx" (ONNX Runtime, e.g. the int8 export from export_onnx.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "model_int8.onnx")  # inside EMBEDDING_MODEL_PATH
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # ONNX Runtime intra-op threads, 0 = all cores
+
+# FAISS index: type chosen at build time, search knobs applied at query time
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "flat")  # flat | ivf_flat | hnsw | ivf_pq
+FAISS_NLIST = int(os.getenv("FAISS_NLIST", "0")) or None  # 0 = derive from corpus size
+FAISS_HNSW_M = int(os.getenv("FAISS_HNSW_M", "32"))
+FAISS_PQ_M = int(os.getenv("FAISS_PQ_M", "0")) or None  # 0 = derive from dimension
+FAISS_NPROBE = int(os.getenv("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.getenv("FAISS_EF_SEARCH", "64"))
+# Exact L2 rerank of the approximate candidates (uses the snapshot's vectors.f32);
+# a request can override it. RERANK_CANDIDATES is the over-fetch factor.
+FAISS_RERANK = os.getenv("FAISS_RERANK", "0") == "1"
+FAISS_RERANK_CANDIDATES = int(os.getenv("FAISS_RERANK_CANDIDATES", "4"))
+# Source/collection filters matching at most this many chunks are searched exactly instead of through the index
+FAISS_EXACT_FILTER_MAX = int(os.getenv("FAISS_EXACT_FILTER_MAX", "4096"))
+# Hybrid retrieval: BM25 and vector rankings (each HYBRID_CANDIDATES * k deep) merged by
+# reciprocal-rank fusion with constant RRF_K. Scripture references are looked up exactly either way.
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "1") == "1"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "4"))
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+# SSE framing: flush coalesced tokens after this long or once a frame is this big
+SSE_FLUSH_INTERVAL_MS = float(os.getenv("SSE_FLUSH_INTERVAL_MS", "25"))
+SSE_MAX_FRAME_BYTES = int(os.getenv("SSE_MAX_FRAME_BYTES", "1024"))
+
+# Write-behind persistence of chat turns
+CHAT_WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "100"))
+CHAT_WRITE_FLUSH_INTERVAL_MS = float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL_MS", "200"))
+CHAT_WRITE_MAX_QUEUE = int(os.getenv("CHAT_WRITE_MAX_QUEUE", "10000"))
+
+# /chat-history paging
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "200"))
+
+# Cache of verified JWT principals (auth.get_current_user)
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", "300"))
+
+# Password hashing: bcrypt cost and the bounded worker pool that runs it
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+
+# Semantic answer cache for repeated / near-duplicate questions
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # cosine similarity
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+ANSWER_CACHE_PERSIST = os.getenv("ANSWER_CACHE_PERSIST", "1") == "1"
+
+# Intent router for canned replies
+INTENTS_FILE = os.getenv("INTENTS_FILE", "intents.json")
+INTENT_EMBEDDING_THRESHOLD = float(os.getenv("INTENT_EMBEDDING_THRESHOLD", "0.8"))  # default when the file sets none
+
+# Prompt assembly: total input-token budget and how it is shared
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2000"))
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "900"))  # retrieved chunks
+PROMPT_HISTORY_TURNS = int(os.getenv("PROMPT_HISTORY_TURNS", "10"))  # 0 = single-turn prompts
+CONVERSATION_SUMMARY_ENABLED = os.getenv("CONVERSATION_SUMMARY_ENABLED", "0") == "1"
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "200"))
+
+# LLM gateway (llm.py): endpoints, admission control, timeouts and retries
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # e.g. a local fake_openai.py
+OPENAI_FALLBACK_MODEL = os.getenv("OPENAI_FALLBACK_MODEL") or None  # failover target; unset disables
+OPENAI_FALLBACK_BASE_URL = os.getenv("OPENAI_FALLBACK_BASE_URL") or None
+OPENAI_FALLBACK_API_KEY = os.getenv("OPENAI_FALLBACK_API_KEY") or None  # defaults to OPENAI_API_KEY
+LLM_MAX_CONCURRENT = int(os.getenv("LLM_MAX_CONCURRENT", "64"))  # per process
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "128"))
+LLM_QUEUE_TIMEOUT_MS = float(os.getenv("LLM_QUEUE_TIMEOUT_MS", "2000"))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", "2"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))  # also bounds the gap between tokens
+LLM_WRITE_TIMEOUT = float(os.getenv("LLM_WRITE_TIMEOUT", "10"))
+LLM_POOL_TIMEOUT = float(os.getenv("LLM_POOL_TIMEOUT", "5"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE = int(os.getenv("LLM_MAX_KEEPALIVE", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF_MS = float(os.getenv("LLM_RETRY_BACKOFF_MS", "250"))
+LLM_FAILOVER_COOLDOWN_SECONDS = float(os.getenv("LLM_FAILOVER_COOLDOWN_SECONDS", "30"))
+
+# Startup: a failed model/index load is retried with exponential backoff (capped at
+# STARTUP_RETRY_MAX_SECONDS); after STARTUP_MAX_ATTEMPTS failures /healthz reports 503,
+# so the orchestrator's liveness probe restarts the replica instead of leaving it unready
+STARTUP_MAX_ATTEMPTS = int(os.getenv("STARTUP_MAX_ATTEMPTS", "5"))
+STARTUP_RETRY_MAX_SECONDS = float(os.getenv("STARTUP_RETRY_MAX_SECONDS", "30"))
+
+# Operational endpoints (/admin/*) require "Authorization: Bearer <ADMIN_TOKEN>"; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") or None
+# Sampling profiler (metrics.SamplingProfiler); can also be toggled at runtime via /admin/profiler
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", "10"))
+
+# Voice replies (voice.py): TTS provider, sentence pipelining and the audio cache
+TTS_PROVIDER = os.getenv("TTS_PROVIDER", "elevenlabs")  # elevenlabs | fake
+ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY") or None  # unset disables the voice endpoints
+ELEVENLABS_BASE_URL = os.getenv("ELEVENLABS_BASE_URL", "https://api.elevenlabs.io")
+ELEVENLABS_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID", "cclclCaJslL1xziwefCeTNzHv")
+ELEVENLABS_MODEL_ID = os.getenv("ELEVENLABS_MODEL_ID", "eleven_multilingual_v2")
+ELEVENLABS_OUTPUT_FORMAT = os.getenv("ELEVENLABS_OUTPUT_FORMAT", "mp3_44100_128")
+TTS_MAX_CONCURRENT = int(os.getenv("TTS_MAX_CONCURRENT", "8"))  # TTS requests in flight per process
+TTS_READ_TIMEOUT = float(os.getenv("TTS_READ_TIMEOUT", "30"))
+TTS_FAKE_DELAY_MS = float(os.getenv("TTS_FAKE_DELAY_MS", "100"))
+TTS_MAX_AHEAD = int(os.getenv("TTS_MAX_AHEAD", "2"))  # sentences synthesized ahead of the one being sent
+TTS_SENTENCE_MIN_CHARS = int(os.getenv("TTS_SENTENCE_MIN_CHARS", "40"))
+TTS_SENTENCE_MAX_CHARS = int(os.getenv("TTS_SENTENCE_MAX_CHARS", "400"))
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# /ws/chat connections (websocket_chat.py)
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "1000"))  # per process
+WS_AUTH_TIMEOUT_SECONDS = float(os.getenv("WS_AUTH_TIMEOUT_SECONDS", "10"))
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "20"))
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "60"))  # without any client message
+WS_SEND_QUEUE = int(os.getenv("WS_SEND_QUEUE", "64"))  # outgoing messages buffered per connection
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))  # a full queue this long drops the client
+WS_MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", "16384"))
+WS_CONTEXT_CACHE = int(os.getenv("WS_CONTEXT_CACHE", "16"))  # retrieval results cached per connection
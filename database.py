@@ -1,25 +1,158 @@
-import os
-from pymongo import MongoClient
-from dotenv import load_dotenv
+from datetime import datetime, timezone
+from pymongo import AsyncMongoClient, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError
+import config
 
-# Load environment variables
-load_dotenv()
-
-MONGO_URI = os.getenv("MONGO_URI")
+MONGO_URI = config.MONGO_URI
 
 if not MONGO_URI:
     raise ValueError("❌ MONGO_URI is not set in environment variables")
 
-# Connect to MongoDB
-try:
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    client.server_info()  # Test connection
-    print("✅ Successfully connected to MongoDB")
-except Exception as e:
-    print(f"❌ MongoDB connection failed: {str(e)}")
-    raise
+if MONGO_URI.startswith("memory://"):
+    # In-process stand-in for benchmarks and offline runs (bench_load.py)
+    from memory_mongo import AsyncMemoryClient
+    client = AsyncMemoryClient()
+else:
+    # Async client with a tuned connection pool. Connections are opened lazily,
+    # so importing this module never blocks; call check_connection() at startup.
+    client = AsyncMongoClient(
+        MONGO_URI,
+        maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+        minPoolSize=config.MONGO_MIN_POOL_SIZE,
+        maxIdleTimeMS=config.MONGO_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=config.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        serverSelectionTimeoutMS=config.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=config.MONGO_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=config.MONGO_SOCKET_TIMEOUT_MS,
+    )
 
 # Define Database and Collections
-db = client["chat_app"]  # Matches .env MONGO_URI
+db = client[config.MONGO_DB_NAME]  # Matches .env MONGO_URI
 users_collection = db["users"]
-chats_collection = db["chats"]
\ No newline at end of file
+chats_collection = db["chats"]
+answer_cache_collection = db["answer_cache"]
+summaries_collection = db["chat_summaries"]
+DUPLICATE_KEY = 11000
+
+
+async def check_connection():
+    try:
+        await client.admin.command("ping")
+        print("✅ Successfully connected to MongoDB")
+    except Exception as e:
+        print(f"❌ MongoDB connection failed: {str(e)}")
+        raise
+
+
+async def ensure_indexes():
+    # Idempotent; a failure is logged rather than keeping the app from starting
+    try:
+        await users_collection.create_index([("email", ASCENDING)], unique=True, name="email_unique")
+        await chats_collection.create_index([("user_id", ASCENDING), ("_id", DESCENDING)], name="user_id_id")
+        await chats_collection.create_index(
+            [("user_id", ASCENDING), ("session_id", ASCENDING), ("_id", DESCENDING)], name="user_id_session_id_id"
+        )
+        await summaries_collection.create_index(
+            [("user_id", ASCENDING), ("session_id", ASCENDING)], unique=True, name="user_id_session_id"
+        )
+        await answer_cache_collection.create_index("expires_at", expireAfterSeconds=0, name="expires_at_ttl")
+        await answer_cache_collection.create_index([("created_at", DESCENDING)], name="created_at")
+        print("✅ MongoDB indexes ensured")
+    except Exception as e:
+        print(f"❌ Creating MongoDB indexes failed: {str(e)}")
+
+
+class UserRepository:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get_by_email(self, email: str):
+        return await self.collection.find_one({"email": email})
+
+    async def exists(self, email: str):
+        return await self.collection.find_one({"email": email}, {"_id": 1}) is not None
+
+    async def create(self, email: str, hashed_password: str):
+        result = await self.collection.insert_one({"email": email, "hashed_password": hashed_password})
+        return result.inserted_id
+
+    async def set_password_hash(self, email: str, hashed_password: str):
+        await self.collection.update_one({"email": email}, {"$set": {"hashed_password": hashed_password}})
+
+
+PRAYER_KIND = "prayer"
+HISTORY_PROJECTION = {"_id": 1, "user_message": 1, "bot_reply": 1, "status": 1}
+
+
+class ChatRepository:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def insert_many(self, turns):
+        # Unordered, so one bad document does not stop the rest of the batch.
+        # Duplicate _ids mean a retried batch was already (partly) written.
+        try:
+            await self.collection.insert_many(turns, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != DUPLICATE_KEY for error in e.details.get("writeErrors", [])):
+                raise
+
+    # Keyset pagination over (user_id, _id): newest first, older than `before`
+    def _history_cursor(self, user_id: str, before=None, limit=0, batch_size=None):
+        query = {"user_id": user_id}
+        if before is not None:
+            query["_id"] = {"$lt": before}
+        cursor = self.collection.find(query, HISTORY_PROJECTION).sort("_id", DESCENDING).limit(limit)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    async def history_page(self, user_id: str, limit: int, before=None):
+        return await self._history_cursor(user_id, before, limit).to_list(limit)
+
+    async def recent_turns(self, user_id: str, session_id, limit: int):
+        # The conversation's own turns; prayers are stored with kind "prayer" and never part of one
+        query = {"user_id": user_id, "session_id": session_id, "kind": {"$ne": PRAYER_KIND}}
+        projection = {"_id": 1, "user_message": 1, "bot_reply": 1, "session_id": 1}
+        cursor = self.collection.find(query, projection).sort("_id", DESCENDING).limit(limit)
+        return await cursor.to_list(limit)
+
+    async def iter_history(self, user_id: str, before=None, limit=0, batch_size=200):
+        async for turn in self._history_cursor(user_id, before, limit, batch_size):
+            yield turn
+
+
+class SummaryRepository:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def get(self, user_id: str, session_id):
+        return await self.collection.find_one({"user_id": user_id, "session_id": session_id}, {"_id": 0})
+
+    async def set(self, user_id: str, session_id, summary: str, covered_until):
+        await self.collection.update_one(
+            {"user_id": user_id, "session_id": session_id},
+            {"$set": {"summary": summary, "covered_until": covered_until}},
+            upsert=True
+        )
+
+
+class AnswerCacheRepository:
+    def __init__(self, collection, ttl_seconds):
+        self.collection = collection
+        self.ttl = ttl_seconds
+
+    async def save(self, embedding, entry):
+        # expires_at drives the TTL index, so Mongo prunes stale answers itself
+        expires_at = datetime.fromtimestamp(entry["created_at"] + self.ttl, timezone.utc)
+        await self.collection.insert_one({**entry, "embedding": embedding, "expires_at": expires_at})
+
+    async def load_recent(self, min_created_at, limit):
+        cursor = self.collection.find({"created_at": {"$gte": min_created_at}}, {"_id": 0, "expires_at": 0})
+        return await cursor.sort("created_at", DESCENDING).limit(limit).to_list(limit)
+
+
+users = UserRepository(users_collection)
+chats = ChatRepository(chats_collection)
+summaries = SummaryRepository(summaries_collection)
+answer_cache = AnswerCacheRepository(answer_cache_collection, config.ANSWER_CACHE_TTL_SECONDS)
@@ -0,0 +1,179 @@
+import json
+import logging
+import mmap
+import os
+import pickle
+import shutil
+import sys
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# On-disk chunk store, a compact replacement for metadata.pkl:
+#
+#   texts.bin          UTF-8 chunk texts, concatenated
+#   offsets.bin        little-endian uint64 byte offsets into texts.bin (count + 1 entries)
+#   <field>.codes.bin  little-endian uint32 code per chunk for each metadata field
+#   columns.json       chunk count and the interned value table of each field
+#   shared.json        further metadata rows of chunks that occur in several
+#                      sources, {"<chunk id>": [metadata, ...]}; the codes hold the first
+#
+# Everything is memory-mapped read-only, so opening the store is near-instant,
+# lookups by id only touch the pages they need, and all uvicorn workers share
+# the same page cache instead of each unpickling a private copy.
+
+TEXTS_FILE = "texts.bin"
+OFFSETS_FILE = "offsets.bin"
+COLUMNS_FILE = "columns.json"
+SHARED_FILE = "shared.json"
+MISSING = np.uint32(0xFFFFFFFF)
+
+
+def _codes_file(field):
+    return f"{field}.codes.bin"
+
+
+class ChunkStoreWriter:
+    # Appends chunks one at a time, so large corpora never sit in memory as lists
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        self.texts = open(os.path.join(self.tmp_path, TEXTS_FILE), "wb")
+        self.offsets = [0]
+        self.values = {}  # field -> {value: code}
+        self.codes = {}  # field -> list of codes
+        self.shared = {}  # chunk id -> further metadata rows
+        self.count = 0
+
+    def add(self, text, metadata, shared=()):
+        encoded = text.encode("utf-8")
+        self.texts.write(encoded)
+        self.offsets.append(self.offsets[-1] + len(encoded))
+        for field, value in metadata.items():
+            if field not in self.values:
+                self.values[field] = {}
+                self.codes[field] = [MISSING] * self.count
+            table = self.values[field]
+            self.codes[field].append(table.setdefault(value, len(table)))
+        for field, codes in self.codes.items():
+            if len(codes) == self.count:
+                codes.append(MISSING)
+        if shared:
+            self.shared[str(self.count)] = list(shared)
+        self.count += 1
+
+    def close(self):
+        self.texts.close()
+        np.asarray(self.offsets, dtype="<u8").tofile(os.path.join(self.tmp_path, OFFSETS_FILE))
+        for field, codes in self.codes.items():
+            np.asarray(codes, dtype="<u4").tofile(os.path.join(self.tmp_path, _codes_file(field)))
+        columns = {
+            "count": self.count,
+            "fields": {field: list(table) for field, table in self.values.items()},
+        }
+        with open(os.path.join(self.tmp_path, COLUMNS_FILE), "w", encoding="utf-8") as f:
+            json.dump(columns, f, ensure_ascii=False)
+        with open(os.path.join(self.tmp_path, SHARED_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.shared, f, ensure_ascii=False)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.texts.close()
+            shutil.rmtree(self.tmp_path, ignore_errors=True)
+
+
+def _map(path, dtype):
+    # mmap of an empty file is not allowed; an empty array is equivalent
+    if os.path.getsize(path) == 0:
+        return None, np.empty(0, dtype=dtype)
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, np.frombuffer(mapped, dtype=dtype)
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, COLUMNS_FILE), encoding="utf-8") as f:
+            columns = json.load(f)
+        self.count = columns["count"]
+        self.values = columns["fields"]
+        self._maps = []
+        texts_map, _ = _map(os.path.join(path, TEXTS_FILE), np.uint8)
+        self._texts = texts_map if texts_map is not None else b""
+        self._maps.append(texts_map)
+        offsets_map, self.offsets = _map(os.path.join(path, OFFSETS_FILE), "<u8")
+        self._maps.append(offsets_map)
+        self.codes = {}
+        for field in self.values:
+            codes_map, self.codes[field] = _map(os.path.join(path, _codes_file(field)), "<u4")
+            self._maps.append(codes_map)
+        # Stores written before shared chunks were recorded have no shared.json
+        self.shared = {}
+        shared_path = os.path.join(path, SHARED_FILE)
+        if os.path.exists(shared_path):
+            with open(shared_path, encoding="utf-8") as f:
+                self.shared = {int(i): rows for i, rows in json.load(f).items()}
+        # One shared dict per distinct metadata row keeps lookups allocation-free
+        self._metadata_cache = {}
+
+    def __len__(self):
+        return self.count
+
+    def text(self, i):
+        return self._texts[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def metadata(self, i):
+        key = tuple(int(codes[i]) for codes in self.codes.values())
+        meta = self._metadata_cache.get(key)
+        if meta is None:
+            meta = {
+                field: self.values[field][code]
+                for field, code in zip(self.codes, key)
+                if code != MISSING
+            }
+            self._metadata_cache[key] = meta
+        return meta
+
+    def all_metadata(self, i):
+        # Metadata of every source the chunk occurs in, the one in the codes first
+        return [self.metadata(i)] + self.shared.get(int(i), [])
+
+    def close(self):
+        # Drop our own array views first; a mapping still viewed elsewhere is left to the GC
+        self.offsets = np.empty(0, dtype="<u8")
+        self.codes = {}
+        for mapped in self._maps:
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+        self._maps = []
+
+
+def convert_pickle(pickle_path, store_path):
+    # One-off migration of a legacy metadata.pkl into a chunk store
+    with open(pickle_path, "rb") as f:
+        data = pickle.load(f)
+    with ChunkStoreWriter(store_path) as writer:
+        for text, meta in zip(data["chunks"], data["metadata"]):
+            writer.add(text, meta)
+    logger.info(f"Converted {len(data['chunks'])} chunks from {pickle_path} to {store_path}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python documents.py <metadata.pkl> <chunk_store_dir>")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    convert_pickle(sys.argv[1], sys.argv[2])
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+EMBEDDING_BACKENDS = ("torch", "onnx")
+# Any one of these holds the transformer's weights; the repo only vendors config and tokenizer
+WEIGHT_FILES = ("model.safetensors", "pytorch_model.bin")
+
+
+class MissingModelFiles(Exception):
+    pass
+
+
+def check_model_files(path, backend="torch", onnx_file="model_int8.onnx"):
+    # Fails with a clear message instead of whatever transformers or ONNX Runtime raise
+    if not os.path.isdir(path):
+        raise MissingModelFiles(f"Embedding model directory {path} does not exist")
+    if backend == "onnx":
+        if not os.path.exists(os.path.join(path, onnx_file)):
+            raise MissingModelFiles(f"No {onnx_file} in {path}: run export_onnx.py first")
+    elif not any(os.path.exists(os.path.join(path, name)) for name in WEIGHT_FILES):
+        raise MissingModelFiles(
+            f"No model weights in {path}: expected {' or '.join(WEIGHT_FILES)} from "
+            f"sentence-transformers/all-MiniLM-L6-v2 (the Docker image fetches them at build time)"
+        )
+
+
+def load_model(path, backend="torch", onnx_file="model_int8.onnx", threads=0):
+    # The vendored model directory holds a plain transformer; queries must be
+    # embedded exactly like index_pdfs.py embedded the chunks (mean pooling).
+    # Loading never reaches out to the Hugging Face hub.
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend!r}, expected one of {EMBEDDING_BACKENDS}")
+    check_model_files(path, backend, onnx_file)
+    if backend == "onnx":
+        return OnnxEmbeddingModel(path, onnx_file, threads)
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    from sentence_transformers import SentenceTransformer, models
+    transformer = models.Transformer(path)
+    pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode="mean")
+    return SentenceTransformer(modules=[transformer, pooling])
+
+
+def max_sequence_length(path):
+    # What sentence-transformers picks for a bare transformer directory
+    with open(os.path.join(path, "config.json"), encoding="utf-8") as f:
+        limit = json.load(f).get("max_position_embeddings", 512)
+    tokenizer_config = os.path.join(path, "tokenizer_config.json")
+    if os.path.exists(tokenizer_config):
+        with open(tokenizer_config, encoding="utf-8") as f:
+            limit = min(limit, json.load(f).get("model_max_length", limit))
+    return limit
+
+
+# The same model exported to ONNX (see export_onnx.py), typically with int8
+# weights, run by ONNX Runtime on the CPU. Tokenisation uses the fast tokenizer
+# directly and pooling is done in numpy, so neither torch nor transformers is
+# imported. encode() mirrors SentenceTransformer.encode for the arguments we use.
+class OnnxEmbeddingModel:
+    def __init__(self, path, onnx_file="model_int8.onnx", threads=0):
+        import onnxruntime
+        from tokenizers import Tokenizer
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(path, onnx_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, "tokenizer.json"))
+        # tokenizer.json pads everything to a fixed length; pad per batch instead
+        self.tokenizer.enable_truncation(max_sequence_length(path))
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]") or 0, pad_token="[PAD]")
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def _encode_batch(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            feeds["token_type_ids"] = np.array([encoding.type_ids for encoding in encodings], dtype=np.int64)
+        hidden = self.session.run(None, feeds)[0]
+        mask = attention_mask[:, :, None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+
+    def encode(self, texts, convert_to_numpy=True, batch_size=32, **kwargs):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        # Longest first, so each batch pads to similar lengths
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            rows = order[start:start + batch_size]
+            embeddings[rows] = self._encode_batch([texts[i] for i in rows])
+        return embeddings[0] if single else embeddings
+
+
+# Micro-batching embedding service. Queries that arrive within max_wait_ms of
+# the first one are encoded together in a single model.encode call of at most
+# max_batch_size texts. Encoding runs in a small thread pool (torch releases the
+# GIL), so the event loop keeps serving in-flight streams meanwhile.
+class EmbeddingBatcher:
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5, workers=1):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
+        self.queue = None
+        self.slots = None
+        self.collector = None
+        self.dispatched = set()
+
+    def _encode(self, texts):
+        return self.model.encode(texts, convert_to_numpy=True, batch_size=len(texts))
+
+    async def encode(self, text):
+        if self.collector is None or self.collector.done():
+            self.queue = asyncio.Queue()
+            self.slots = asyncio.Semaphore(self.workers)
+            self.collector = asyncio.create_task(self._collect())
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((text, future))
+        return await future
+
+    async def _collect(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.max_batch_size - 1:
+                await asyncio.sleep(self.max_wait)
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            # Keep collecting the next batch while this one is being encoded,
+            # but never queue more batches than there are encode workers
+            await self.slots.acquire()
+            task = asyncio.create_task(self._dispatch(batch))
+            self.dispatched.add(task)
+            task.add_done_callback(self.dispatched.discard)
+
+    async def _dispatch(self, batch):
+        try:
+            # Drop requests whose caller has gone away (e.g. client disconnect)
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                return
+            loop = asyncio.get_running_loop()
+            try:
+                embeddings = await loop.run_in_executor(self.executor, self._encode, [text for text, _ in batch])
+            except Exception as e:
+                logger.error(f"Embedding batch of {len(batch)} failed: {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        finally:
+            self.slots.release()
+
+    async def close(self):
+        if self.collector is not None:
+            self.collector.cancel()
+            try:
+                await self.collector
+            except asyncio.CancelledError:
+                pass
+            self.collector = None
+        self.executor.shutdown(wait=False)
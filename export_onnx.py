@@ -0,0 +1,135 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import config
+from embeddings import load_model
+from snapshots import resolve
+
+# Export the vendored embedding model to ONNX, quantize it to int8 and check
+# that it agrees with the fp32 PyTorch model, for EMBEDDING_BACKEND=onnx.
+#
+#   python export_onnx.py                    # writes model.onnx and model_int8.onnx into the model directory
+#   python export_onnx.py --check-only       # parity check of an existing export
+#
+# Exporting needs torch and transformers; serving the result needs only
+# onnxruntime and tokenizers.
+
+PARITY_TEXTS = [
+    "How can I find peace when I feel anxious about the future?",
+    "What does the Bible say about forgiving someone who hurt me?",
+    "I lost my job and feel like a failure.",
+    "Blessed are the peacemakers, for they shall be called children of God.",
+    "For God so loved the world that he gave his one and only Son.",
+    "Why does God allow suffering?",
+    "pray",
+    "",
+]
+
+
+def export(model_path, output, opset):
+    import torch
+    from tokenizers import Tokenizer
+    from transformers import AutoModel
+    model = AutoModel.from_pretrained(model_path, local_files_only=True)
+    model.eval()
+    tokenizer = Tokenizer.from_file(os.path.join(model_path, "tokenizer.json"))
+    tokenizer.enable_padding()
+    encodings = tokenizer.encode_batch(["a short sentence", "a somewhat longer sentence to export with"])
+    inputs = {
+        "input_ids": torch.tensor([encoding.ids for encoding in encodings]),
+        "attention_mask": torch.tensor([encoding.attention_mask for encoding in encodings]),
+        "token_type_ids": torch.tensor([encoding.type_ids for encoding in encodings]),
+    }
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in list(inputs) + ["last_hidden_state"]}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (),
+            output,
+            kwargs=inputs,
+            input_names=list(inputs),
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset,
+            do_constant_folding=True,
+            dynamo=False,
+        )
+    print(f"Exported {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+
+
+def quantize(source, output):
+    # Dynamic quantization: int8 weights, activations quantized on the fly
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(source, output, weight_type=QuantType.QInt8)
+    print(f"Quantized {output} ({os.path.getsize(output) / 1e6:.1f} MB)")
+
+
+def parity_texts(limit):
+    texts = list(PARITY_TEXTS)
+    _, _, chunk_store_dir = resolve(config.INDEX_SNAPSHOT_DIR, config.INDEX_FILE, config.CHUNK_STORE_DIR)
+    if os.path.isdir(chunk_store_dir):
+        from documents import ChunkStore
+        store = ChunkStore(chunk_store_dir)
+        texts += [store.text(i) for i in range(min(len(store), limit))]
+        store.close()
+    return texts
+
+
+def median_latency_ms(model, text, repeats):
+    model.encode(text)
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.encode(text)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies)) * 1000
+
+
+def check_parity(model_path, onnx_file, min_cosine, chunks, repeats, threads):
+    texts = parity_texts(chunks)
+    reference_model = load_model(model_path, "torch")
+    candidate_model = load_model(model_path, "onnx", onnx_file, threads)
+    reference = reference_model.encode(texts, convert_to_numpy=True, batch_size=32)
+    candidate = candidate_model.encode(texts, convert_to_numpy=True, batch_size=32)
+    cosine = (reference * candidate).sum(axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1) + 1e-12
+    )
+    print(
+        f"Cosine agreement with fp32 over {len(texts)} texts: "
+        f"min={cosine.min():.5f} mean={cosine.mean():.5f} p1={np.percentile(cosine, 1):.5f}"
+    )
+    query = PARITY_TEXTS[0]
+    torch_ms = median_latency_ms(reference_model, query, repeats)
+    onnx_ms = median_latency_ms(candidate_model, query, repeats)
+    print(f"Single-query latency: torch {torch_ms:.2f}ms, onnx {onnx_ms:.2f}ms ({torch_ms / onnx_ms:.1f}x)")
+    if cosine.min() < min_cosine:
+        print(f"FAILED: minimum cosine {cosine.min():.5f} is below {min_cosine}")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the embedding model to int8 ONNX and check parity")
+    parser.add_argument("--model-path", default=config.EMBEDDING_MODEL_PATH)
+    parser.add_argument("--onnx-file", default=config.EMBEDDING_ONNX_FILE, help="quantized model, in --model-path")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--no-quantize", action="store_true", help="serve the fp32 export as --onnx-file")
+    parser.add_argument("--check-only", action="store_true", help="skip the export, only run the parity check")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="fail below this cosine similarity")
+    parser.add_argument("--chunks", type=int, default=200, help="indexed chunks added to the parity texts")
+    parser.add_argument("--repeats", type=int, default=50, help="timed single-query encodes per backend")
+    parser.add_argument("--threads", type=int, default=config.EMBEDDING_THREADS)
+    args = parser.parse_args()
+
+    if not args.check_only:
+        fp32_path = os.path.join(args.model_path, "model.onnx")
+        export(args.model_path, fp32_path, args.opset)
+        if args.no_quantize:
+            if args.onnx_file != "model.onnx":
+                os.replace(fp32_path, os.path.join(args.model_path, args.onnx_file))
+        else:
+            quantize(fp32_path, os.path.join(args.model_path, args.onnx_file))
+    ok = check_parity(args.model_path, args.onnx_file, args.min_cosine, args.chunks, args.repeats, args.threads)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from fastapi import FastAPI, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+# Local stand-in for the OpenAI chat completions API, for testing the LLM
+# gateway (llm.py) and load testing without network access or API costs.
+#
+#   python fake_openai.py --port 8001 --ttft-ms 300 --token-delay-ms 20
+#   OPENAI_BASE_URL=http://127.0.0.1:8001/v1 uvicorn main:app
+#
+# Latency and failures can be injected: --error-rate returns 500s (or 429s
+# with --error-status 429), --fail-models always fails the listed models
+# (to exercise failover) and --hang-rate never answers (to exercise timeouts).
+
+REPLY = (
+    "I have seen His peace carry many through seasons like this. As Jesus taught in John 16:33, "
+    "in this world you will have trouble, but take heart, for He has overcome the world. "
+    "What weighs on your heart most today?"
+)
+
+
+class Settings:
+    def __init__(self, ttft_ms=200, token_delay_ms=15, tokens=0, error_rate=0.0, error_status=500,
+                 fail_models=(), hang_rate=0.0):
+        self.ttft = ttft_ms / 1000
+        self.token_delay = token_delay_ms / 1000
+        self.tokens = tokens  # 0 = stream the whole canned reply
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_models = set(fail_models)
+        self.hang_rate = hang_rate
+
+
+def reply_tokens(count):
+    # Word-sized deltas, like a real model streams them
+    words = REPLY.split(" ")
+    tokens = [word if i == 0 else " " + word for i, word in enumerate(words)]
+    if count:
+        tokens = [tokens[i % len(tokens)] for i in range(count)]
+    return tokens
+
+
+def create_app(settings):
+    app = FastAPI()
+    app.state.requests = 0
+
+    def chunk(completion_id, model, delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        model = body.get("model", "fake")
+        if model in settings.fail_models or random.random() < settings.error_rate:
+            status = 503 if model in settings.fail_models else settings.error_status
+            return JSONResponse(
+                {"error": {"message": f"Injected failure for {model}", "type": "server_error"}},
+                status_code=status,
+            )
+        if random.random() < settings.hang_rate:
+            await asyncio.sleep(3600)
+        await asyncio.sleep(settings.ttft)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        tokens = reply_tokens(settings.tokens)
+        if not body.get("stream"):
+            await asyncio.sleep(settings.token_delay * len(tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "".join(tokens)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)},
+            }
+
+        async def events():
+            yield f"data: {json.dumps(chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+            for token in tokens:
+                yield f"data: {json.dumps(chunk(completion_id, model, {'content': token}))}\n\n"
+                await asyncio.sleep(settings.token_delay)
+            yield f"data: {json.dumps(chunk(completion_id, model, {}, 'stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "fake", "object": "model", "owned_by": "local"}]}
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft-ms", type=float, default=200, help="delay before the first token")
+    parser.add_argument("--token-delay-ms", type=float, default=15, help="delay between tokens")
+    parser.add_argument("--tokens", type=int, default=0, help="tokens per reply (0 = canned reply length)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500, help="status code of injected failures")
+    parser.add_argument("--fail-models", nargs="*", default=[], help="models that always fail with 503")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of requests that never answer")
+    args = parser.parse_args()
+
+    import uvicorn
+    settings = Settings(args.ttft_ms, args.token_delay_ms, args.tokens, args.error_rate, args.error_status,
+                        args.fail_models, args.hang_rate)
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
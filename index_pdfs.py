@@ -1,68 +1,399 @@
 import os
-import ssl
-from sentence_transformers import SentenceTransformer, models
+import json
+import hashlib
+import mmap
+import shutil
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import faiss
-import pickle
+import numpy as np
 from tqdm import tqdm
-import urllib3
+import config
+from documents import ChunkStoreWriter
+from lexical import LexicalIndexWriter
+from snapshots import INDEX_FILE, CHUNK_STORE_DIR, VECTORS_FILE, LEXICAL_DIR, current_version, new_version, prune, publish
+from embeddings import EMBEDDING_BACKENDS, load_model
+from vector_index import INDEX_TYPES, create_index, train_index, describe
+
+# Streaming, incremental ingestion of the document library.
+#
+#   python index_pdfs.py [--source pdfs] [--index-type hnsw] [--workers 4]
+#
+# Text is extracted from PDFs (and .txt files) in a process pool, chunked, and
+# embedded in bounded batches. Embeddings are cached by chunk content hash in
+# INGEST_STATE_DIR, so a re-run only extracts files whose content hash changed
+# and only encodes chunks it has never seen. Identical chunks are stored once,
+# with the metadata of every file they occur in, and chunks of deleted files
+# drop out of the next build. The FAISS index and
+# chunk store are then rebuilt from the cached vectors, which is cheap next to
+# encoding. Every build goes into a new versioned snapshot directory that is
+# published atomically (snapshots.py), so running servers pick it up with a
+# hot reload instead of reading half-written files.
+
+logger = logging.getLogger(__name__)
 
 # Paths
-INDEX_FILE = "faiss_index.bin"
-METADATA_FILE = "metadata.pkl"
-MODEL_PATH = "C:/Users/ocandia/OneDrive - DXC Production/Desktop/Python Project/backend/models/sentence-transformers_all-MiniLM-L6-v2"
+SNAPSHOT_DIR = config.INDEX_SNAPSHOT_DIR
+SOURCE_DIR = config.SOURCE_DIR
+STATE_DIR = config.INGEST_STATE_DIR
+MODEL_PATH = config.EMBEDDING_MODEL_PATH
+BACKEND = config.EMBEDDING_BACKEND
+
+SOURCE_EXTENSIONS = (".pdf", ".txt")
+MANIFEST_FILE = "manifest.json"
+TEXTS_FILE = "texts.bin"
+
+_model = None
+
+
+def get_model():
+    # Loaded lazily: unchanged runs never need it, and extraction workers never import it
+    global _model
+    if _model is None:
+        _model = load_model(MODEL_PATH, BACKEND, config.EMBEDDING_ONNX_FILE, config.EMBEDDING_THREADS)
+    return _model
+
 
-# Load model
-transformer = models.Transformer(MODEL_PATH)
-pooling = models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode="mean")
-model = SentenceTransformer(modules=[transformer, pooling])
+def encoder_id():
+    # Cached vectors are only reused when they came from the same encoder
+    return "torch" if BACKEND == "torch" else f"{BACKEND}:{config.EMBEDDING_ONNX_FILE}"
 
-# Dummy data
-documents = ["For God so loved the world - John 3:16", "The Lord is my shepherd - Psalm 23"]
-metadata = [{"filename": "bible.txt"}, {"filename": "bible.txt"}]
 
 # Function to chunk text
 def chunk_text(text, chunk_size=500):
     words = text.split()
     return [" ".join(words[i:i + chunk_size]) for i in range(0, len(words), chunk_size)]
 
-# Index documents
-def create_or_update_index(documents, metadata):
-    all_chunks = []
-    chunk_metadata = []
-
-    if os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE):
-        index = faiss.read_index(INDEX_FILE)
-        with open(METADATA_FILE, "rb") as f:
-            data = pickle.load(f)
-            existing_chunks = data["chunks"]
-            existing_metadata = data["metadata"]
-        tqdm.write(f"Loaded existing index with {len(existing_chunks)} chunks.")
-    else:
-        dimension = model.encode(["test"], convert_to_numpy=True).shape[1]
-        index = faiss.IndexFlatL2(dimension)
-        existing_chunks = []
-        existing_metadata = []
-        tqdm.write("Created new FAISS index.")
-
-    for doc, meta in tqdm(zip(documents, metadata), total=len(documents), desc="Chunking documents"):
-        chunks = chunk_text(doc)
-        all_chunks.extend(chunks)
-        chunk_metadata.extend([meta] * len(chunks))
-
-    if all_chunks:
-        tqdm.write("Generating embeddings...")
-        embeddings = model.encode(all_chunks, convert_to_numpy=True)
-        index.add(embeddings)
-
-        all_chunks = existing_chunks + all_chunks
-        all_metadata = existing_metadata + chunk_metadata
-
-        faiss.write_index(index, INDEX_FILE)
-        with open(METADATA_FILE, "wb") as f:
-            pickle.dump({"chunks": all_chunks, "metadata": all_metadata}, f)
-        tqdm.write(f"Saved index with {len(all_chunks)} chunks.")
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_key(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def read_text_file(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    for encoding in ("utf-8-sig", "utf-16"):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode("latin-1")
+
+
+def extract_chunks(path, chunk_size):
+    # Runs in a worker process: return only the chunks, never whole documents
+    if path.lower().endswith(".pdf"):
+        from PyPDF2 import PdfReader
+        reader = PdfReader(path)
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
     else:
+        text = read_text_file(path)
+    return chunk_text(text, chunk_size)
+
+
+def scan_sources(source_dir):
+    files = {}
+    for root, _, names in os.walk(source_dir):
+        for name in names:
+            if name.lower().endswith(SOURCE_EXTENSIONS):
+                path = os.path.join(root, name)
+                files[os.path.relpath(path, source_dir).replace(os.sep, "/")] = path
+    return files
+
+
+def write_json_atomic(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class EmbeddingCache:
+    # Append-only cache of chunk texts and their embeddings, keyed by chunk hash:
+    #   manifest.json  {"files": {relpath: {"sha256", "chunks"}}, "entries": {key: [row, text_offset, text_len]},
+    #                   "dimension", "chunk_size", "encoder"}
+    #   vectors.f32    float32 rows, one per entry
+    #   texts.bin      UTF-8 chunk texts
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+        manifest_path = os.path.join(state_dir, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        else:
+            manifest = {"files": {}, "entries": {}, "dimension": None, "chunk_size": None}
+        self.files = manifest["files"]
+        self.chunk_size = manifest.get("chunk_size")
+        self.encoder = manifest.get("encoder", "torch")  # caches from before backends were selectable
+        self.entries = manifest["entries"]
+        self.dimension = manifest["dimension"]
+        self.vectors_path = os.path.join(state_dir, VECTORS_FILE)
+        self.texts_path = os.path.join(state_dir, TEXTS_FILE)
+        # Drop any tail written by a run that crashed before saving the manifest
+        self._truncate(self.vectors_path, len(self.entries) * 4 * (self.dimension or 0))
+        self._truncate(self.texts_path, max((o + n for _, o, n in self.entries.values()), default=0))
+
+    @staticmethod
+    def _truncate(path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, keys, texts, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        self.dimension = self.dimension or embeddings.shape[1]
+        with open(self.vectors_path, "ab") as vectors, open(self.texts_path, "ab") as text_file:
+            offset = text_file.tell()
+            for key, text in zip(keys, texts):
+                encoded = text.encode("utf-8")
+                text_file.write(encoded)
+                self.entries[key] = [len(self.entries), offset, len(encoded)]
+                offset += len(encoded)
+            embeddings.tofile(vectors)
+
+    def vectors(self):
+        if not self.entries:
+            return np.empty((0, self.dimension or 0), dtype="float32")
+        return np.memmap(self.vectors_path, dtype="<f4", mode="r", shape=(len(self.entries), self.dimension))
+
+    def text(self, texts_map, key):
+        _, offset, length = self.entries[key]
+        return texts_map[offset:offset + length].decode("utf-8")
+
+    def save(self):
+        write_json_atomic(
+            os.path.join(self.state_dir, MANIFEST_FILE),
+            {"files": self.files, "entries": self.entries, "dimension": self.dimension, "chunk_size": self.chunk_size,
+             "encoder": self.encoder},
+        )
+
+    def reset(self):
+        # Forget every file and vector, e.g. after switching encoders
+        self.files.clear()
+        self.entries = {}
+        self.dimension = None
+        for path in (self.vectors_path, self.texts_path):
+            open(path, "wb").close()
+
+    def compact(self):
+        # Rewrite the cache without entries no longer referenced by any file
+        live = {key for info in self.files.values() for key in info["chunks"]}
+        if len(live) >= len(self.entries) // 2:
+            return
+        tqdm.write(f"Compacting embedding cache: {len(self.entries)} -> {len(live)} entries")
+        old_vectors = self.vectors()
+        with open(self.texts_path, "rb") as f:
+            old_texts = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        old_entries, self.entries = self.entries, {}
+        paths = (self.vectors_path, self.texts_path)
+        self.vectors_path, self.texts_path = (path + ".new" for path in paths)
+        for path in (self.vectors_path, self.texts_path):
+            open(path, "wb").close()
+        keys = [key for key in old_entries if key in live]
+        for start in range(0, len(keys), 4096):
+            batch = keys[start:start + 4096]
+            texts = [old_texts[o:o + n].decode("utf-8") for _, o, n in (old_entries[key] for key in batch)]
+            self.add(batch, texts, old_vectors[[old_entries[key][0] for key in batch]])
+        del old_vectors
+        old_texts.close()
+        for new_path, path in zip((self.vectors_path, self.texts_path), paths):
+            os.replace(new_path, path)
+        self.vectors_path, self.texts_path = paths
+        self.save()
+
+
+def encode_pending(cache, pending, batch_size):
+    keys = list(pending)
+    texts = [pending[key] for key in keys]
+    embeddings = get_model().encode(texts, convert_to_numpy=True, batch_size=batch_size)
+    cache.add(keys, texts, embeddings)
+    pending.clear()
+
+
+def update_cache(cache, source_dir, workers, batch_size, chunk_size):
+    sources = scan_sources(source_dir)
+
+    removed = [name for name in cache.files if name not in sources]
+    for name in removed:
+        del cache.files[name]
+    if removed:
+        tqdm.write(f"Removed {len(removed)} deleted file(s): {', '.join(removed)}")
+
+    if cache.encoder != encoder_id():
+        # Vectors from another encoder are not comparable with new queries: re-embed everything
+        tqdm.write(f"Embedding encoder changed ({cache.encoder} -> {encoder_id()}), re-embedding all chunks")
+        cache.reset()
+        cache.encoder = encoder_id()
+
+    if cache.chunk_size != chunk_size:
+        # Different chunking means different chunks: every file has to be re-extracted
+        cache.files.clear()
+        cache.chunk_size = chunk_size
+
+    changed = {}
+    for name, path in sources.items():
+        digest = file_hash(path)
+        if cache.files.get(name, {}).get("sha256") != digest:
+            changed[name] = (path, digest)
+    tqdm.write(f"{len(sources)} source file(s), {len(changed)} new or changed")
+    if not changed:
+        return bool(removed)
+
+    pending = {}  # chunk key -> text, waiting to be encoded
+    max_in_flight = workers * 2
+    names = iter(changed)
+    with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=len(changed), desc="Ingesting") as progress:
+        futures = {}
+
+        def submit_next():
+            name = next(names, None)
+            if name is not None:
+                futures[executor.submit(extract_chunks, changed[name][0], chunk_size)] = name
+
+        # Keep only a bounded number of extracted documents in flight
+        for _ in range(max_in_flight):
+            submit_next()
+        while futures:
+            future = next(as_completed(futures))
+            name = futures.pop(future)
+            submit_next()
+            progress.update(1)
+            try:
+                file_chunks = future.result()
+            except Exception as e:
+                # Remember the failure so the file is only retried once its content changes
+                logger.error(f"Skipping {name}: text extraction failed: {str(e)}")
+                cache.files[name] = {"sha256": changed[name][1], "chunks": [], "error": str(e)}
+                continue
+
+            keys = []
+            for text in file_chunks:
+                key = chunk_key(text)
+                keys.append(key)
+                if key not in cache and key not in pending:
+                    pending[key] = text
+                if len(pending) >= batch_size:
+                    encode_pending(cache, pending, batch_size)
+            cache.files[name] = {"sha256": changed[name][1], "chunks": keys}
+        if pending:
+            encode_pending(cache, pending, batch_size)
+    return True
+
+
+def chunk_metadata(name):
+    # `filename` is the path relative to the source dir, so same-named files in
+    # different collections stay apart; files in a subdirectory of the source
+    # dir belong to the collection named after it
+    meta = {"filename": name}
+    if "/" in name:
+        meta["collection"] = name.split("/", 1)[0]
+    return meta
+
+
+def build_outputs(cache, index_type, batch_size):
+    # Build into <version>.tmp, then rename and publish it as the live snapshot
+    version = new_version()
+    build_path = os.path.join(SNAPSHOT_DIR, version + ".tmp")
+    os.makedirs(build_path)
+    try:
+        build_snapshot(cache, index_type, batch_size, build_path)
+    except BaseException:
+        shutil.rmtree(build_path, ignore_errors=True)
+        raise
+    os.rename(build_path, os.path.join(SNAPSHOT_DIR, version))
+    publish(SNAPSHOT_DIR, version)
+    prune(SNAPSHOT_DIR, config.INDEX_KEEP_SNAPSHOTS)
+
+
+def build_snapshot(cache, index_type, batch_size, path):
+    # Rebuild the FAISS index and chunk store from cached vectors, one copy per
+    # unique chunk; a chunk found in several files keeps the metadata of each
+    rows, keys, metadata = [], [], []
+    positions = {}  # key -> position in rows
+    for name in sorted(cache.files):
+        meta = chunk_metadata(name)
+        for key in cache.files[name]["chunks"]:
+            position = positions.get(key)
+            if position is None:
+                positions[key] = len(rows)
+                keys.append(key)
+                rows.append(cache.entries[key][0])
+                metadata.append([meta])
+            elif meta not in metadata[position]:
+                metadata[position].append(meta)
+    if not rows:
+        # Nothing left to serve: publish an empty snapshot rather than keep deleted content searchable
         tqdm.write("No chunks to index.")
+        return
+
+    vectors = cache.vectors()
+    index = create_index(
+        cache.dimension,
+        index_type,
+        n_vectors=len(rows),
+        nlist=config.FAISS_NLIST,
+        hnsw_m=config.FAISS_HNSW_M,
+        pq_m=config.FAISS_PQ_M,
+    )
+    if not index.is_trained:
+        sample = np.sort(np.random.default_rng(0).choice(rows, min(len(rows), 100_000), replace=False))
+        train_index(index, vectors[sample])
+
+    with open(cache.texts_path, "rb") as f:
+        texts_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        vectors_file = open(os.path.join(path, VECTORS_FILE), "wb")
+        with vectors_file, ChunkStoreWriter(os.path.join(path, CHUNK_STORE_DIR)) as writer, \
+                LexicalIndexWriter(os.path.join(path, LEXICAL_DIR)) as lexical:
+            for start in tqdm(range(0, len(rows), batch_size), desc="Building index"):
+                batch = np.ascontiguousarray(vectors[rows[start:start + batch_size]], dtype="float32")
+                index.add(batch)
+                batch.astype("<f4").tofile(vectors_file)  # exact copies for filtered search and reranking
+                for key, metas in zip(keys[start:start + batch_size], metadata[start:start + batch_size]):
+                    text = cache.text(texts_map, key)
+                    writer.add(text, metas[0], metas[1:])
+                    lexical.add(text)
+    finally:
+        texts_map.close()
+    faiss.write_index(index, os.path.join(path, INDEX_FILE))
+    tqdm.write(f"Saved {describe(index)} with {len(rows)} unique chunks.")
+
+
+def ingest(source_dir=SOURCE_DIR, index_type=config.FAISS_INDEX_TYPE, workers=None,
+           batch_size=config.INGEST_BATCH_SIZE, chunk_size=config.CHUNK_SIZE, force=False):
+    cache = EmbeddingCache(STATE_DIR)
+    changed = update_cache(cache, source_dir, workers or os.cpu_count() or 1, batch_size, chunk_size)
+    cache.save()
+    if changed or force or current_version(SNAPSHOT_DIR) is None:
+        build_outputs(cache, index_type, batch_size)
+    else:
+        tqdm.write("Index is up to date.")
+    cache.compact()
+
 
 if __name__ == "__main__":
-    create_or_update_index(documents, metadata)
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Incrementally ingest PDFs and text files into the FAISS index")
+    parser.add_argument("--source", default=SOURCE_DIR, help="directory of .pdf/.txt files to index")
+    parser.add_argument("--index-type", choices=INDEX_TYPES, default=config.FAISS_INDEX_TYPE)
+    parser.add_argument("--workers", type=int, default=None, help="text extraction processes (default: CPU count)")
+    parser.add_argument("--batch-size", type=int, default=config.INGEST_BATCH_SIZE, help="chunks per embedding batch")
+    parser.add_argument("--chunk-size", type=int, default=config.CHUNK_SIZE, help="words per chunk")
+    parser.add_argument("--force", action="store_true", help="rebuild the index even if nothing changed")
+    parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=BACKEND, help="embedding backend")
+    args = parser.parse_args()
+    BACKEND = args.backend
+    ingest(args.source, args.index_type, args.workers, args.batch_size, args.chunk_size, args.force)
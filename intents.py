@@ -0,0 +1,133 @@
+import json
+import logging
+import re
+from collections import deque
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Data-driven intent router for canned replies (see intents.json).
+#
+# Keyword phrases of all intents are compiled into a single word-level
+# Aho-Corasick automaton, so matching is one pass over the message no matter
+# how many intents or phrases there are. When no phrase matches, the query
+# embedding (already computed for retrieval) is compared with the embeddings
+# of each intent's example questions.
+
+WORD = re.compile(r"[a-z0-9']+")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower().replace("’", "'"))
+
+
+class KeywordAutomaton:
+    def __init__(self):
+        self.goto = [{}]  # state -> {word: state}
+        self.fail = [0]
+        self.output = [[]]  # state -> [(intent, phrase length)]
+
+    def add(self, phrase, intent):
+        state = 0
+        words = tokenize(phrase)
+        for word in words:
+            if word not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][word] = len(self.goto) - 1
+            state = self.goto[state][word]
+        self.output[state].append((intent, len(words)))
+
+    def build(self):
+        # Breadth-first failure links; outputs of fallback states are merged in
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, child in self.goto[state].items():
+                queue.append(child)
+                if state:
+                    fallback = self.fail[state]
+                    while fallback and word not in self.goto[fallback]:
+                        fallback = self.fail[fallback]
+                    self.fail[child] = self.goto[fallback].get(word, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    def search(self, words):
+        state = 0
+        for word in words:
+            while state and word not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(word, 0)
+            yield from self.output[state]
+
+
+class Intent:
+    def __init__(self, name, response, priority=0, keywords=(), examples=(), sources=(), threshold=None):
+        self.name = name
+        self.response = response
+        self.priority = priority
+        self.keywords = list(keywords)
+        self.examples = list(examples)
+        self.sources = list(sources)
+        self.threshold = threshold
+
+    def render(self, message):
+        # Templates may reference {message}; unknown fields are left as-is
+        return self.response.format_map(_Fields(message=message))
+
+
+class _Fields(dict):
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+class IntentRouter:
+    def __init__(self, intents, embedding_threshold=0.8):
+        self.intents = intents
+        self.embedding_threshold = embedding_threshold
+        self.automaton = KeywordAutomaton()
+        for intent in intents:
+            for phrase in intent.keywords:
+                self.automaton.add(phrase, intent)
+        self.automaton.build()
+        self.example_vectors = None
+        self.example_intents = []
+
+    @classmethod
+    def from_file(cls, path, embedding_threshold=0.8):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        intents = [Intent(**spec) for spec in data["intents"]]
+        logger.info(f"Loaded {len(intents)} intents from {path}")
+        return cls(intents, data.get("embedding_threshold", embedding_threshold))
+
+    async def prepare(self, encode):
+        # Embed every example question once, with the same model used for queries
+        pairs = [(intent, example) for intent in self.intents for example in intent.examples]
+        if not pairs:
+            return
+        vectors = np.asarray(await encode([example for _, example in pairs]), dtype="float32")
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        self.example_vectors = vectors
+        self.example_intents = [intent for intent, _ in pairs]
+
+    def match_keywords(self, message):
+        # Highest priority wins; among equals, the longest (most specific) phrase
+        best = max(
+            self.automaton.search(tokenize(message)),
+            key=lambda match: (match[0].priority, match[1]),
+            default=None,
+        )
+        return best[0] if best else None
+
+    def match_embedding(self, query_embedding):
+        if self.example_vectors is None or query_embedding is None:
+            return None
+        query = np.asarray(query_embedding, dtype="float32").ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        similarities = self.example_vectors @ query
+        best = int(np.argmax(similarities))
+        intent = self.example_intents[best]
+        threshold = intent.threshold if intent.threshold is not None else self.embedding_threshold
+        return intent if similarities[best] >= threshold else None
@@ -0,0 +1,297 @@
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import sys
+from array import array
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Lexical side of retrieval, built by index_pdfs.py next to the FAISS index:
+#
+#   lexical/
+#     terms.json      sorted vocabulary, document count and average length
+#     offsets.bin     little-endian uint64 start of each term's postings (terms + 1 entries)
+#     postings.bin    little-endian uint32 chunk ids, grouped by term
+#     tfs.bin         little-endian uint16 term frequencies, parallel to postings.bin
+#     lengths.bin     little-endian uint32 token count per chunk
+#     references.json normalized scripture reference -> chunk ids, e.g. "john 3:16", "psalms 23"
+#
+# LexicalIndex.search() scores chunks with BM25 over the memory-mapped
+# postings; LexicalIndex.references() resolves the references in a query
+# ("John 3:16", "Ps 23", "1 Cor 13:4-7") to the chunks that cite them, and
+# fuse() merges the BM25 and vector rankings by reciprocal rank.
+#
+# Book names and abbreviations followed by a number also occur in plain
+# English ("I lost my job 2 weeks ago", "Ex 3 boyfriend"). With strict=True
+# only unambiguous references are parsed: those with a verse, and chapters
+# of a book spelled out in full whose name is not an everyday word or name.
+
+TERMS_FILE = "terms.json"
+OFFSETS_FILE = "offsets.bin"
+POSTINGS_FILE = "postings.bin"
+TFS_FILE = "tfs.bin"
+LENGTHS_FILE = "lengths.bin"
+REFERENCES_FILE = "references.json"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Terms in more than this share of chunks carry almost no BM25 weight but cost the most to score
+MAX_DOCUMENT_FREQUENCY = 0.5
+
+TOKEN = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i in is it its me my of on or our she so that the "
+    "their them they this to was we were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+# Canonical book names and the spellings that refer to them
+BOOKS = {
+    "genesis": ["gen", "gn"], "exodus": ["exod", "exo", "ex"], "leviticus": ["lev", "lv"],
+    "numbers": ["num", "nm"], "deuteronomy": ["deut", "dt"], "joshua": ["josh", "jos"],
+    "judges": ["judg", "jdg"], "ruth": ["rth"], "1 samuel": ["1 sam", "1 sa"], "2 samuel": ["2 sam", "2 sa"],
+    "1 kings": ["1 kgs", "1 ki"], "2 kings": ["2 kgs", "2 ki"], "1 chronicles": ["1 chron", "1 chr"],
+    "2 chronicles": ["2 chron", "2 chr"], "ezra": ["ezr"], "nehemiah": ["neh"], "esther": ["esth", "est"],
+    "job": [], "psalms": ["psalm", "ps", "psa", "pss"], "proverbs": ["prov", "prv", "pro"],
+    "ecclesiastes": ["eccl", "eccles", "ecc", "qoheleth"],
+    "song of solomon": ["song of songs", "canticles"], "isaiah": ["isa"],
+    "jeremiah": ["jer"], "lamentations": ["lam"], "ezekiel": ["ezek", "eze"], "daniel": ["dan", "dn"],
+    "hosea": ["hos"], "joel": ["jl"], "amos": [], "obadiah": ["obad", "ob"], "jonah": ["jon"],
+    "micah": ["mic"], "nahum": ["nah"], "habakkuk": ["hab"], "zephaniah": ["zeph", "zep"], "haggai": ["hag"],
+    "zechariah": ["zech", "zec"], "malachi": ["mal"], "matthew": ["matt", "mt"], "mark": ["mrk", "mk"],
+    "luke": ["lk"], "john": ["jn", "jhn"], "acts": [], "romans": ["rom"],
+    "1 corinthians": ["1 cor"], "2 corinthians": ["2 cor"], "galatians": ["gal"], "ephesians": ["eph"],
+    "philippians": ["phil", "php"], "colossians": ["col"], "1 thessalonians": ["1 thess", "1 thes"],
+    "2 thessalonians": ["2 thess", "2 thes"], "1 timothy": ["1 tim"], "2 timothy": ["2 tim"],
+    "titus": ["tit"], "philemon": ["philem", "phlm"], "hebrews": ["heb"], "james": ["jas"],
+    "1 peter": ["1 pet", "1 pt"], "2 peter": ["2 pet", "2 pt"], "1 john": ["1 jn", "1 jhn"],
+    "2 john": ["2 jn", "2 jhn"], "3 john": ["3 jn", "3 jhn"], "jude": [], "revelation": ["rev", "revelations"],
+}
+ORDINALS = {"first": "1", "second": "2", "third": "3", "i": "1", "ii": "2", "iii": "3", "1st": "1", "2nd": "2",
+            "3rd": "3"}
+BOOK_ALIASES = {}
+for _book, _aliases in BOOKS.items():
+    for _alias in [_book] + _aliases:
+        BOOK_ALIASES[_alias] = _book
+
+# Book spellings without the leading number, longest first so "song of songs" wins over shorter names
+_NAMES = sorted({alias.split(" ", 1)[1] if alias[0].isdigit() else alias for alias in BOOK_ALIASES}, key=len,
+                reverse=True)
+# "<book> <chapter>[:<verse>[-<verse>]]", e.g. "John 3:16", "1 Cor. 13:4-7", "Psalm 23"
+REFERENCE = re.compile(
+    r"\b(?:(1|2|3|1st|2nd|3rd|first|second|third|iii|ii|i)\s*)?("
+    + "|".join(re.escape(name).replace("\\ ", r"\s+") for name in _NAMES)
+    + r")\.?\s+(\d{1,3})(?:\s*:\s*(\d{1,3})(?:\s*[-–]\s*(\d{1,3}))?)?(?!\s*:\s*\d|\d)",
+    re.IGNORECASE,
+)
+MAX_VERSE_RANGE = 50
+# Books whose name is also a common word or first name: "Mark 12" may be a 12-year-old
+AMBIGUOUS_BOOKS = frozenset([
+    "job", "mark", "acts", "numbers", "judges", "revelation", "john", "james", "luke", "ruth", "amos", "jude",
+    "daniel", "joel", "jonah", "micah", "titus", "esther",
+])
+
+
+def parse_references(text, strict=False):
+    # Normalized references in `text`: "book chapter" and "book chapter:verse", one key per verse of a range
+    keys = []
+    for number, name, chapter, verse, last_verse in REFERENCE.findall(text):
+        name = " ".join(name.lower().split())
+        book = None
+        if number:
+            book = BOOK_ALIASES.get(f"{ORDINALS.get(number.lower(), number)} {name}")
+        if book is None:
+            number = ""
+            book = BOOK_ALIASES.get(name)
+        if book is None:
+            continue
+        chapter = int(chapter)
+        if not verse:
+            spelled_out = name in (book, book.split(" ", 1)[-1], "psalm")
+            if strict and not (spelled_out and (number or book not in AMBIGUOUS_BOOKS)):
+                continue
+            keys.append(f"{book} {chapter}")
+            continue
+        first = int(verse)
+        last = int(last_verse) if last_verse else first
+        for v in range(first, min(max(first, last), first + MAX_VERSE_RANGE) + 1):
+            keys.append(f"{book} {chapter}:{v}")
+    return list(dict.fromkeys(keys))
+
+
+class LexicalIndexWriter:
+    # Collects postings in memory (compact arrays per term) and writes them on close()
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + ".tmp"
+        self.postings = {}  # term -> (array of chunk ids, array of term frequencies)
+        self.lengths = array("I")
+        self.references = {}  # reference key -> chunk ids
+
+    def add(self, text):
+        chunk_id = len(self.lengths)
+        tokens = tokenize(text)
+        self.lengths.append(len(tokens))
+        counts = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = (array("I"), array("H"))
+            postings[0].append(chunk_id)
+            postings[1].append(min(count, 0xFFFF))
+        for key in parse_references(text):
+            self.references.setdefault(key, []).append(chunk_id)
+            # A verse also answers a question about its chapter
+            chapter = key.split(":", 1)[0]
+            if chapter != key:
+                chapter_ids = self.references.setdefault(chapter, [])
+                if not chapter_ids or chapter_ids[-1] != chunk_id:
+                    chapter_ids.append(chunk_id)
+
+    def close(self):
+        shutil.rmtree(self.tmp_path, ignore_errors=True)
+        os.makedirs(self.tmp_path)
+        terms = sorted(self.postings)
+        offsets = array("Q", [0])
+        with open(os.path.join(self.tmp_path, POSTINGS_FILE), "wb") as postings_file, \
+                open(os.path.join(self.tmp_path, TFS_FILE), "wb") as tfs_file:
+            for term in terms:
+                ids, tfs = self.postings[term]
+                np.frombuffer(ids, dtype=np.uint32).astype("<u4").tofile(postings_file)
+                np.frombuffer(tfs, dtype=np.uint16).astype("<u2").tofile(tfs_file)
+                offsets.append(offsets[-1] + len(ids))
+        np.frombuffer(offsets, dtype=np.uint64).astype("<u8").tofile(os.path.join(self.tmp_path, OFFSETS_FILE))
+        np.frombuffer(self.lengths, dtype=np.uint32).astype("<u4").tofile(os.path.join(self.tmp_path, LENGTHS_FILE))
+        count = len(self.lengths)
+        with open(os.path.join(self.tmp_path, TERMS_FILE), "w", encoding="utf-8") as f:
+            json.dump({"count": count, "average_length": sum(self.lengths) / count if count else 0.0,
+                       "terms": terms}, f, ensure_ascii=False)
+        with open(os.path.join(self.tmp_path, REFERENCES_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.references, f)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.tmp_path, self.path)
+        logger.info(f"Lexical index: {len(terms)} terms, {len(self.references)} scripture references")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+
+
+def _map(path, dtype):
+    # mmap of an empty file is not allowed; an empty array is equivalent
+    if os.path.getsize(path) == 0:
+        return None, np.empty(0, dtype=dtype)
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return mapped, np.frombuffer(mapped, dtype=dtype)
+
+
+class LexicalIndex:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TERMS_FILE), encoding="utf-8") as f:
+            terms = json.load(f)
+        self.count = terms["count"]
+        self.average_length = terms["average_length"] or 1.0
+        self.term_ids = {term: i for i, term in enumerate(terms["terms"])}
+        with open(os.path.join(path, REFERENCES_FILE), encoding="utf-8") as f:
+            self.reference_table = json.load(f)
+        self._maps = []
+        mapped, self.offsets = _map(os.path.join(path, OFFSETS_FILE), "<u8")
+        self._maps.append(mapped)
+        mapped, self.postings = _map(os.path.join(path, POSTINGS_FILE), "<u4")
+        self._maps.append(mapped)
+        mapped, self.tfs = _map(os.path.join(path, TFS_FILE), "<u2")
+        self._maps.append(mapped)
+        mapped, lengths = _map(os.path.join(path, LENGTHS_FILE), "<u4")
+        self._maps.append(mapped)
+        # Per-chunk BM25 length normalization, computed once
+        self.norms = (BM25_K1 * (1 - BM25_B + BM25_B * lengths / self.average_length)).astype("float32")
+
+    def references(self, query, strict=False):
+        # Chunk ids citing the references in `query`, in the order the references appear
+        ids = []
+        for key in parse_references(query, strict):
+            ids.extend(self.reference_table.get(key, ()))
+        return list(dict.fromkeys(ids))
+
+    def search(self, query, k, allowed=None):
+        # BM25 top k as (score, chunk id), best first; `allowed` is a sorted id array or None
+        ids, weights = [], []
+        for term in dict.fromkeys(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            df = end - start
+            if df > self.count * MAX_DOCUMENT_FREQUENCY:
+                continue
+            postings = self.postings[start:end]
+            tfs = self.tfs[start:end].astype("float32")
+            if allowed is not None:
+                keep = np.isin(postings, allowed, assume_unique=True)
+                postings, tfs = postings[keep], tfs[keep]
+            idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            ids.append(postings)
+            weights.append(idf * tfs * (BM25_K1 + 1) / (tfs + self.norms[postings]))
+        if not ids:
+            return []
+        chunk_ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(weights))
+        top = np.argsort(-scores)[:k] if len(scores) <= k else np.argpartition(-scores, k)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), int(chunk_ids[i])) for i in top]
+
+    def close(self):
+        self.offsets = self.postings = self.tfs = np.empty(0)
+        for mapped in self._maps:
+            if mapped is not None:
+                try:
+                    mapped.close()
+                except BufferError:
+                    pass
+        self._maps = []
+
+
+def fuse(rankings, k, c=60):
+    # Reciprocal-rank fusion of (score, chunk id) rankings, best first. Returns
+    # (-fused score, chunk id) so that, like distances, lower sorts first.
+    scores = {}
+    for ranking in rankings:
+        for rank, (_, chunk_id) in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (c + rank + 1)
+    return sorted((-score, chunk_id) for chunk_id, score in scores.items())[:k]
+
+
+def build_from_chunk_store(chunk_store_dir, path):
+    # One-off: add a lexical index to an existing chunk store (e.g. the legacy chunk_store/)
+    from documents import ChunkStore
+    store = ChunkStore(chunk_store_dir)
+    try:
+        with LexicalIndexWriter(path) as writer:
+            for i in range(len(store)):
+                writer.add(store.text(i))
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python lexical.py <chunk_store_dir> <lexical_dir>")
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO)
+    build_from_chunk_store(sys.argv[1], sys.argv[2])
@@ -0,0 +1,222 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+import httpx
+import openai
+from fastapi import HTTPException, status
+from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+# Gateway in front of the OpenAI-compatible chat API.
+#
+# Admission: at most `max_concurrent` completions run per process and at most
+# `max_waiting` requests wait for a slot (up to `queue_timeout_ms`); anything
+# beyond that, or beyond `max_per_user` in-flight requests for one user, is
+# rejected right away with 429 instead of piling up open upstream streams.
+#
+# Calls go through a pooled httpx client with explicit timeouts. Transient
+# failures (timeouts, connection errors, 429, 5xx) are retried with jittered
+# exponential backoff, but only before the first token has been streamed.
+# When an endpoint keeps failing, requests fail over to the next one and the
+# failed endpoint is skipped for `cooldown_seconds`.
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+
+class Endpoint:
+    def __init__(self, name, client, model):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.down_until = 0.0
+
+
+def http_client(connect_timeout=5.0, read_timeout=30.0, write_timeout=10.0, pool_timeout=5.0,
+                max_connections=100, max_keepalive=20, keepalive_expiry=30.0):
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(connect=connect_timeout, read=read_timeout, write=write_timeout, pool=pool_timeout),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        ),
+    )
+
+
+def openai_endpoint(name, api_key, model, base_url=None, **http_options):
+    # Retries are ours (see LLMGateway), so the SDK's own are disabled
+    client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client(**http_options), max_retries=0)
+    return Endpoint(name, client, model)
+
+
+class Lease:
+    # One admitted request; release() is idempotent so both the stream's
+    # cleanup and the response's background task can call it
+    def __init__(self, gateway, user_id):
+        self.gateway = gateway
+        self.user_id = user_id
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gateway._release(self.user_id)
+
+
+class LLMGateway:
+    def __init__(self, endpoints, max_concurrent=64, max_waiting=128, queue_timeout_ms=2000, max_per_user=2,
+                 max_retries=2, retry_backoff_ms=250, cooldown_seconds=30):
+        self.endpoints = endpoints  # primary first
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.max_per_user = max_per_user
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff_ms / 1000
+        self.cooldown = cooldown_seconds
+        self.active = 0
+        self.waiters = deque()  # futures of requests waiting for a slot, oldest first
+        self.in_flight = {}  # user_id -> admitted requests
+        self.rejected = 0
+
+    @staticmethod
+    def _busy(detail):
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": "1"},
+        )
+
+    async def admit(self, user_id):
+        if self.in_flight.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            logger.warning(f"Rejecting LLM request from {user_id}: {self.max_per_user} already in flight")
+            raise self._busy("Too many requests in progress, please wait for the current reply")
+        self.in_flight[user_id] = self.in_flight.get(user_id, 0) + 1
+        try:
+            await self._acquire()
+        except BaseException:
+            self._forget_user(user_id)
+            raise
+        return Lease(self, user_id)
+
+    async def _acquire(self):
+        if self.active < self.max_concurrent and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.max_waiting:
+            self.rejected += 1
+            logger.warning(f"LLM queue full ({self.active} running, {len(self.waiters)} waiting), rejecting request")
+            raise self._busy("Server is busy, please retry shortly")
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # _release() hands its slot over by resolving the future
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            logger.warning(f"Waited {self.queue_timeout}s for an LLM slot, rejecting request")
+            raise self._busy("Server is busy, please retry shortly")
+        except BaseException:
+            # Cancelled after the slot was handed over: pass it on
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    def _release_slot(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def _forget_user(self, user_id):
+        count = self.in_flight.get(user_id, 0) - 1
+        if count > 0:
+            self.in_flight[user_id] = count
+        else:
+            self.in_flight.pop(user_id, None)
+
+    def _release(self, user_id):
+        self._forget_user(user_id)
+        self._release_slot()
+
+    def _candidates(self):
+        # Healthy endpoints in order; if all are cooling down, try them anyway
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.down_until <= now]
+        return healthy or list(self.endpoints)
+
+    async def _backoff(self, attempt):
+        # Full jitter, so retries from many requests do not arrive in lockstep
+        await asyncio.sleep(random.uniform(0, self.retry_backoff * (2 ** attempt)))
+
+    async def stream(self, messages):
+        # Yields text deltas. Once a token has been yielded, errors propagate as-is.
+        error = None
+        for endpoint in self._candidates():
+            for attempt in range(self.max_retries + 1):
+                started = False
+                try:
+                    response = await endpoint.client.chat.completions.create(
+                        model=endpoint.model,
+                        messages=messages,
+                        stream=True
+                    )
+                    # The context manager hands the connection back to the pool even
+                    # when the client disconnects mid-stream
+                    async with response:
+                        async for chunk in response:
+                            if chunk.choices:
+                                text = chunk.choices[0].delta.content
+                                if text:
+                                    started = True
+                                    yield text
+                    endpoint.down_until = 0.0
+                    return
+                except RETRYABLE_ERRORS as e:
+                    if started:
+                        raise
+                    error = e
+                    logger.warning(f"LLM call to {endpoint.name} failed (attempt {attempt + 1}): {str(e)}")
+                    if attempt < self.max_retries:
+                        await self._backoff(attempt)
+            self._mark_down(endpoint)
+        raise error
+
+    async def complete(self, messages):
+        error = None
+        for endpoint in self._candidates():
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response = await endpoint.client.chat.completions.create(model=endpoint.model, messages=messages)
+                    endpoint.down_until = 0.0
+                    return response.choices[0].message.content or ""
+                except RETRYABLE_ERRORS as e:
+                    error = e
+                    logger.warning(f"LLM call to {endpoint.name} failed (attempt {attempt + 1}): {str(e)}")
+                    if attempt < self.max_retries:
+                        await self._backoff(attempt)
+            self._mark_down(endpoint)
+        raise error
+
+    def _mark_down(self, endpoint):
+        if len(self.endpoints) > 1:
+            endpoint.down_until = time.monotonic() + self.cooldown
+            logger.error(f"LLM endpoint {endpoint.name} failing, skipping it for {self.cooldown}s")
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
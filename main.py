@@ -7,36 +7,53 @@ os.environ['SSL_CERT_FILE'] = certifi.where()
 # import ssl
 # ssl._create_default_https_context = ssl._create_unverified_context
 
+from contextlib import asynccontextmanager
 from datetime import timedelta
+from typing import List, Optional
 import json
+import time
 import asyncio
 import logging
-from fastapi import FastAPI, Depends, HTTPException, Request
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi import FastAPI, Depends, HTTPException, Request, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, ValidationError
 from dotenv import load_dotenv
-from database import chats_collection, users_collection
-from auth import create_access_token, get_current_user, verify_password
-from starlette.responses import StreamingResponse, JSONResponse
-from openai import AsyncOpenAI
-from sentence_transformers import SentenceTransformer
-from passlib.context import CryptContext
-import faiss
-import pickle
+import config
+import database
+from persistence import ChatWriter
+from answer_cache import SemanticCache, is_standalone
+from intents import IntentRouter
+from chatbot import PromptBuilder
+from auth import create_access_token, get_current_user, invalidate_user, password_hasher, require_admin, token_expiry
+from metrics import REGISTRY, ServerTimingMiddleware, profiler, record, span
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse, JSONResponse, PlainTextResponse
+from streaming import SSEStream, SSE_HEADERS, DONE_FRAME, sse_event, static_frames
+from llm import LLMGateway, openai_endpoint
+from embeddings import MissingModelFiles
+from retrieval import Retriever
+from voice import AudioCache, ElevenLabsTTS, FakeTTS, Speaker, interleave
+from websocket_chat import ChatSession, Connection, SlowConsumer, sse_to_message, POLICY_VIOLATION, TRY_AGAIN_LATER
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 class TokenRequest(BaseModel):
     email: str
     password: str
 
 class ChatRequest(BaseModel):
     message: str
+    session_id: Optional[str] = None
+    # Retrieval filters: source paths (relative to the source dir) and/or collections (top-level source directories)
+    sources: Optional[List[str]] = Field(None, max_length=20)
+    collections: Optional[List[str]] = Field(None, max_length=20)
+    per_source_k: Optional[int] = Field(None, ge=1, le=10)  # best chunks from each listed source
+    rerank: Optional[bool] = None  # exact rerank, defaults to FAISS_RERANK
+    hybrid: Optional[bool] = None  # BM25 + vector fusion, defaults to HYBRID_SEARCH
 
 class UserRequest(BaseModel):
     email: str
@@ -49,7 +66,92 @@ if not openai_api_key:
     logger.error("OPENAI_API_KEY not found in environment variables")
     raise ValueError("OPENAI_API_KEY is required")
 
-app = FastAPI()
+# Startup runs in the background so /healthz answers at once; /readyz (and
+# /chat) wait until the database, the warmed-up RAG stack and the intents are ready
+readiness = {"database": False, "rag": False, "intents": False, "answer_cache": False}
+startup_error = None  # set once startup has given up; /healthz then fails
+
+async def connect_database():
+    # Keep retrying: readiness flips once MongoDB becomes reachable
+    delay = 1
+    while True:
+        try:
+            await database.check_connection()
+            break
+        except Exception:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    await database.ensure_indexes()
+    readiness["database"] = True
+
+async def load_rag():
+    # A retry after the RAG stack came up only redoes the steps that failed
+    if not rag.ready:
+        await rag.start()
+    readiness["rag"] = True
+    await intent_router.prepare(lambda texts: asyncio.gather(*(rag.encode(text) for text in texts)))
+    # Resolves the tokenizer, which may mean a download: keep it off the event loop
+    await asyncio.to_thread(prompt_builder.counter.count, "warmup")
+    readiness["intents"] = True
+
+async def prepare_rag():
+    # Transient failures (a tokenizer download, a volume mounted late) get a few
+    # retries with backoff; the last failure propagates to start_up(). Missing
+    # model weights will not appear by waiting, so they fail startup at once.
+    delay = 1
+    for attempt in range(1, config.STARTUP_MAX_ATTEMPTS + 1):
+        try:
+            await load_rag()
+            return
+        except MissingModelFiles:
+            raise
+        except Exception as e:
+            if attempt == config.STARTUP_MAX_ATTEMPTS:
+                raise
+            logger.error(f"Loading the RAG stack failed (attempt {attempt}), retrying in {delay}s: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, config.STARTUP_RETRY_MAX_SECONDS)
+
+async def load_answer_cache():
+    if answer_cache is not None:
+        await answer_cache.load()
+    readiness["answer_cache"] = True
+
+async def start_up():
+    global startup_error
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(connect_database(), prepare_rag(), load_answer_cache())
+        logger.info(f"Ready to serve in {time.perf_counter() - started:.1f}s")
+    except Exception as e:
+        startup_error = str(e)
+        logger.error(f"Startup failed, reporting unhealthy so the replica is restarted: {startup_error}")
+
+@asynccontextmanager
+async def lifespan(app):
+    chat_writer.start()
+    if config.PROFILER_ENABLED:
+        profiler.start(config.PROFILER_INTERVAL_MS)
+    startup = asyncio.create_task(start_up())
+    try:
+        yield
+    finally:
+        startup.cancel()
+        try:
+            await startup
+        except asyncio.CancelledError:
+            pass
+        # Flush queued chat turns before the client goes away
+        await chat_writer.close()
+        await llm.close()
+        await rag.close()
+        await database.client.close()
+        password_hasher.close()
+        profiler.stop()
+        if tts is not None:
+            await tts.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # Updated CORS Middleware to include all Vercel frontend domains
 origins = [
@@ -68,38 +170,71 @@ app.add_middleware(
     allow_headers=["*"],
 )
 logger.info("CORS middleware successfully configured with origins: %s", origins)
+# Outermost, so Server-Timing and request metrics cover the whole stack
+app.add_middleware(ServerTimingMiddleware)
 
-# Load RAG components
-INDEX_FILE = "faiss_index.bin"
-METADATA_FILE = "metadata.pkl"
-model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+# Finished chat turns are persisted in the background, off the request path
+chat_writer = ChatWriter(
+    database.chats,
+    batch_size=config.CHAT_WRITE_BATCH_SIZE,
+    flush_interval_ms=config.CHAT_WRITE_FLUSH_INTERVAL_MS,
+    max_queue=config.CHAT_WRITE_MAX_QUEUE,
+)
 
-# Handle missing FAISS files gracefully
-index = None
-chunks = []
-chunk_metadata = []
-if os.path.exists(INDEX_FILE) and os.path.exists(METADATA_FILE):
-    try:
-        index = faiss.read_index(INDEX_FILE)
-        with open(METADATA_FILE, "rb") as f:
-            rag_data = pickle.load(f)
-        chunks = rag_data["chunks"]
-        chunk_metadata = rag_data["metadata"]
-        logger.info("FAISS index and metadata loaded successfully")
-    except Exception as e:
-        logger.error(f"Error loading FAISS files: {str(e)}")
-else:
-    logger.warning("FAISS index or metadata not found. RAG disabled.")
-
-def retrieve_chunks(query, k=3):
-    if index is None:
-        logger.info("RAG disabled, returning empty chunks")
-        return [], []
-    query_embedding = model.encode([query], convert_to_numpy=True)
-    distances, indices = index.search(query_embedding, k)
-    retrieved_chunks = [chunks[i] for i in indices[0]]
-    retrieved_metadata = [chunk_metadata[i] for i in indices[0]]
-    return retrieved_chunks, retrieved_metadata
+# RAG components: local embedding model, FAISS index and chunk store, loaded by start_up()
+# and hot-reloaded when index_pdfs.py publishes a new snapshot
+rag = Retriever(
+    config.EMBEDDING_MODEL_PATH,
+    config.INDEX_FILE,
+    config.CHUNK_STORE_DIR,
+    mmap=config.FAISS_MMAP,
+    nprobe=config.FAISS_NPROBE,
+    ef_search=config.FAISS_EF_SEARCH,
+    max_batch_size=config.EMBED_MAX_BATCH_SIZE,
+    max_wait_ms=config.EMBED_MAX_WAIT_MS,
+    workers=config.EMBED_WORKERS,
+    backend=config.EMBEDDING_BACKEND,
+    onnx_file=config.EMBEDDING_ONNX_FILE,
+    threads=config.EMBEDDING_THREADS,
+    snapshot_dir=config.INDEX_SNAPSHOT_DIR,
+    watch_interval=config.INDEX_WATCH_INTERVAL_SECONDS,
+    rerank=config.FAISS_RERANK,
+    rerank_candidates=config.FAISS_RERANK_CANDIDATES,
+    exact_filter_max=config.FAISS_EXACT_FILTER_MAX,
+    hybrid=config.HYBRID_SEARCH,
+    hybrid_candidates=config.HYBRID_CANDIDATES,
+    rrf_k=config.RRF_K,
+)
+
+# Canned replies routed by keyword or nearest example question
+intent_router = IntentRouter.from_file(config.INTENTS_FILE, config.INTENT_EMBEDDING_THRESHOLD)
+
+# Semantic cache of LLM answers, keyed by the query embedding
+answer_cache = None
+if config.ANSWER_CACHE_ENABLED:
+    answer_cache = SemanticCache(
+        threshold=config.ANSWER_CACHE_THRESHOLD,
+        ttl_seconds=config.ANSWER_CACHE_TTL_SECONDS,
+        max_entries=config.ANSWER_CACHE_MAX_ENTRIES,
+        repository=database.answer_cache if config.ANSWER_CACHE_PERSIST else None,
+    )
+
+def require_ready():
+    # Never serve a cold request: the load balancer retries elsewhere
+    if not all(readiness.values()):
+        raise HTTPException(status_code=503, detail="Service is starting up", headers={"Retry-After": "5"})
+
+@app.get("/healthz")
+def healthz():
+    # Liveness: the process is up, the event loop is responsive and startup has not given up
+    if startup_error is not None:
+        return JSONResponse({"status": "failed", "error": startup_error}, status_code=503)
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    ready = all(readiness.values())
+    return JSONResponse({"ready": ready, **readiness}, status_code=200 if ready else 503)
 
 @app.get("/")
 def root():
@@ -109,153 +244,503 @@ def root():
 @app.post("/users/")
 async def create_user(user: UserRequest):
     logger.info(f"Creating user with email: {user.email}")
-    if users_collection.find_one({"email": user.email}):
+    if await database.users.exists(user.email):
         logger.error(f"Email already registered: {user.email}")
         raise HTTPException(status_code=400, detail="Email already registered")
-    hashed_password = pwd_context.hash(user.password)
-    user_data = {"email": user.email, "hashed_password": hashed_password}
-    users_collection.insert_one(user_data)
+    hashed_password = await password_hasher.hash(user.password)
+    await database.users.create(user.email, hashed_password)
+    invalidate_user(user.email)
     logger.info(f"User created successfully: {user.email}")
     return {"message": "User created successfully"}
 
 @app.get("/check-auth")
-def check_auth(current_user: dict = Depends(get_current_user)):
+async def check_auth(current_user: dict = Depends(get_current_user)):
     logger.info(f"Authenticated user: {current_user}")
     return {"status": "authenticated", "user": current_user["email"]}
 
-client = AsyncOpenAI(api_key=openai_api_key)
+# All LLM calls go through the gateway: admission control, pooled client, retries and failover
+http_options = dict(
+    connect_timeout=config.LLM_CONNECT_TIMEOUT,
+    read_timeout=config.LLM_READ_TIMEOUT,
+    write_timeout=config.LLM_WRITE_TIMEOUT,
+    pool_timeout=config.LLM_POOL_TIMEOUT,
+    max_connections=config.LLM_MAX_CONNECTIONS,
+    max_keepalive=config.LLM_MAX_KEEPALIVE,
+    keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY,
+)
+llm_endpoints = [openai_endpoint("primary", openai_api_key, config.OPENAI_MODEL, config.OPENAI_BASE_URL, **http_options)]
+if config.OPENAI_FALLBACK_MODEL:
+    llm_endpoints.append(openai_endpoint(
+        "fallback",
+        config.OPENAI_FALLBACK_API_KEY or openai_api_key,
+        config.OPENAI_FALLBACK_MODEL,
+        config.OPENAI_FALLBACK_BASE_URL or config.OPENAI_BASE_URL,
+        **http_options
+    ))
+llm = LLMGateway(
+    llm_endpoints,
+    max_concurrent=config.LLM_MAX_CONCURRENT,
+    max_waiting=config.LLM_MAX_QUEUE,
+    queue_timeout_ms=config.LLM_QUEUE_TIMEOUT_MS,
+    max_per_user=config.LLM_MAX_PER_USER,
+    max_retries=config.LLM_MAX_RETRIES,
+    retry_backoff_ms=config.LLM_RETRY_BACKOFF_MS,
+    cooldown_seconds=config.LLM_FAILOVER_COOLDOWN_SECONDS,
+)
 
-async def stream_response(messages, chat_id, retrieved_metadata):
-    full_response = ""
-    try:
-        metadata_json = json.dumps({"sources": [meta["filename"] for meta in retrieved_metadata]})
-        yield f"data: {metadata_json}\n\n"
-        
-        user_input = messages[-1]["content"].lower()
-        response_content = ""
-        if "prayer" in user_input:
-            response_content = (
-                "Heavenly Father, I come before You with a humble heart, seeking Your peace as we discuss faith. "
-                "Bless those who seek You, as John 3:16 reminds us of Your love, and guide us with Your wisdom. "
-                "Amen."
-            )
-        elif "what is prayer" in user_input:
-            response_content = (
-                "Prayer is a heartfelt conversation with God, as taught in Philippians 4:6. "
-                "It’s a way to seek His guidance and express gratitude."
-            )
+REPLIES = REGISTRY.counter("chat_replies_total", "Chat replies by where the answer came from", ("source",))
+STREAM_ERRORS = REGISTRY.counter("chat_stream_errors_total", "Chat streams that ended with an error event")
+REGISTRY.gauge("llm_active_requests", "Admitted LLM requests in progress", lambda: llm.active)
+REGISTRY.gauge("llm_waiting_requests", "Requests waiting for an LLM slot", lambda: len(llm.waiters))
+REGISTRY.gauge("llm_rejected_requests_total", "Requests rejected by LLM admission control", lambda: llm.rejected,
+               kind="counter")
+REGISTRY.gauge("chat_write_queue_depth", "Chat turns waiting to be written",
+               lambda: chat_writer.queue.qsize() if chat_writer.queue is not None else 0)
+if answer_cache is not None:
+    REGISTRY.gauge("answer_cache_hits_total", "Semantic answer cache hits", lambda: answer_cache.hits, kind="counter")
+    REGISTRY.gauge("answer_cache_misses_total", "Semantic answer cache misses", lambda: answer_cache.misses,
+                   kind="counter")
+
+# Voice replies: each sentence is synthesized while the next one is generated
+tts = None
+if config.TTS_PROVIDER == "fake":
+    tts = FakeTTS(delay_ms=config.TTS_FAKE_DELAY_MS)
+elif config.ELEVENLABS_API_KEY:
+    tts = ElevenLabsTTS(
+        config.ELEVENLABS_API_KEY,
+        config.ELEVENLABS_VOICE_ID,
+        model=config.ELEVENLABS_MODEL_ID,
+        format=config.ELEVENLABS_OUTPUT_FORMAT,
+        base_url=config.ELEVENLABS_BASE_URL,
+        max_concurrent=config.TTS_MAX_CONCURRENT,
+        read_timeout=config.TTS_READ_TIMEOUT,
+    )
+audio_cache = AudioCache(config.TTS_CACHE_MAX_BYTES)
+REGISTRY.gauge("tts_cache_hits_total", "Sentences served from the audio cache", lambda: audio_cache.hits,
+               kind="counter")
+REGISTRY.gauge("tts_cache_misses_total", "Sentences sent to the TTS provider", lambda: audio_cache.misses,
+               kind="counter")
+REGISTRY.gauge("tts_cache_bytes", "Audio held in the audio cache", lambda: audio_cache.size)
+
+def new_speaker():
+    return Speaker(
+        tts,
+        audio_cache,
+        max_ahead=config.TTS_MAX_AHEAD,
+        min_chars=config.TTS_SENTENCE_MIN_CHARS,
+        max_chars=config.TTS_SENTENCE_MAX_CHARS,
+    )
+
+def require_voice():
+    if tts is None:
+        raise HTTPException(status_code=503, detail="Voice replies are not configured")
+
+PRAYER_TEXT = (
+    "Heavenly Father, I come before You with a humble heart, seeking Your peace as we discuss faith. "
+    "Bless those who seek You, as John 3:16 reminds us of Your love, and guide us with Your wisdom. "
+    "Amen."
+)
+# The /pray reply never changes, so its whole SSE body is encoded once
+PRAY_BODY = (
+    sse_event({"sources": ["bible.txt"]})
+    + static_frames(PRAYER_TEXT, config.SSE_MAX_FRAME_BYTES)
+    + DONE_FRAME
+)
+FALLBACK_TEXT = "I am here to provide wisdom and truth, drawn from sacred texts (e.g., Matthew 6:33)."
+
+def new_sse_stream(on_text=None):
+    return SSEStream(
+        flush_interval_ms=config.SSE_FLUSH_INTERVAL_MS,
+        max_frame_bytes=config.SSE_MAX_FRAME_BYTES,
+        on_text=on_text,
+    )
+
+# Prompts are assembled under a fixed token budget from chunks, recent turns and an optional summary
+prompt_builder = PromptBuilder(
+    database.chats,
+    summaries=database.summaries if config.CONVERSATION_SUMMARY_ENABLED else None,
+    pending_turns=chat_writer.pending_turns,
+    model=config.OPENAI_MODEL,
+    token_budget=config.PROMPT_TOKEN_BUDGET,
+    context_budget=config.PROMPT_CONTEXT_TOKENS,
+    history_turns=config.PROMPT_HISTORY_TURNS,
+    summary_budget=config.CONVERSATION_SUMMARY_TOKENS,
+)
+
+async def stream_response(messages, user_id, user_input, retrieved_metadata, query_embedding=None, reply_text=None,
+                          session_id=None, prompt=None, lease=None, speaker=None, session=None):
+    # With a speaker (voice replies), audio events are interleaved with the text frames
+    stream = new_sse_stream(speaker.feed if speaker is not None else None)
+    from_openai = reply_text is None
+    started = time.perf_counter()
+
+    async def reply_frames():
+        if reply_text is not None:
+            # Canned intent reply or cached answer, known up front
+            frames = stream.static_frames(reply_text)
         else:
             # Default to OpenAI for other queries
-            response = await client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=messages,
-                stream=True
-            )
-            async for chunk in response:
-                if hasattr(chunk, "choices") and chunk.choices:
-                    text = chunk.choices[0].delta.content
-                    if text:
-                        full_response += text
-                        json_data = json.dumps({"text": text})
-                        yield f"data: {json_data}\n\n"
-                        await asyncio.sleep(0.01)
-            response_content = full_response
-
-        # Stream custom or OpenAI response
-        if not response_content:
-            response_content = "I am here to provide wisdom and truth, drawn from sacred texts (e.g., Matthew 6:33)."
-        for chunk in response_content.split():
-            full_response += chunk + " "
-            json_data = json.dumps({"text": chunk})
-            yield f"data: {json_data}\n\n"
-            await asyncio.sleep(0.01)
-        yield f"data: {json.dumps({'done': True})}\n\n"
-        chats_collection.update_one(
-            {"_id": chat_id},
-            {"$set": {"bot_reply": full_response.strip()}}
-        )
+            frames = stream.frames(llm.stream(messages))
+        async for frame in frames:
+            yield frame
+        if not stream.text:
+            async for frame in stream.static_frames(FALLBACK_TEXT):
+                yield frame
+
+    status = "cancelled"  # until the reply is complete or fails
+    error_msg = None
+    try:
+        yield sse_event({"sources": [meta["filename"] for meta in retrieved_metadata]})
+
+        frames = reply_frames() if speaker is None else interleave(reply_frames(), speaker)
+        first = True
+        async for frame in frames:
+            if first and from_openai:
+                # The first chunk is flushed immediately, so this is time to first token
+                record("llm_first_token", time.perf_counter() - started)
+            first = False
+            yield frame
+        status = "complete"
+        # query_embedding is only passed for answers that may be cached (see prepare_reply)
+        if from_openai and answer_cache is not None and query_embedding is not None and stream.text.strip():
+            answer_cache.put(query_embedding, user_input, stream.text, [meta["filename"] for meta in retrieved_metadata])
+        yield DONE_FRAME
+        if prompt is not None:
+            prompt_builder.maybe_summarize(user_id, session_id, prompt, llm.complete)
     except Exception as e:
+        status = "error"
         error_msg = f"OpenAI Streaming Error: {str(e)}"
         logger.error(error_msg)
-        yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        STREAM_ERRORS.inc()
+        yield sse_event({"error": error_msg})
+    finally:
+        record("stream", time.perf_counter() - started)
+        # Free the LLM slot as soon as the reply is done (or the client left)
+        if lease is not None:
+            lease.release()
+        # The turn is saved however the reply ended: disconnects, cancelled
+        # WebSocket replies and LLM errors keep the question and the partial text
+        fields = {"session_id": session_id, "status": status}
+        if error_msg is not None:
+            fields["error"] = error_msg
+        with span("chat_record"):
+            turn_id = await chat_writer.record(user_id, user_input, stream.text.strip(), **fields)
+        if session is not None:
+            session.add_turn(turn_id, user_input, stream.text.strip())
 
-@app.post("/chat")
+def local_frames(user_id, user_input, text, sources, session_id=None, speaker=None, session=None):
+    # A reply that needs no LLM round trip, through the regular SSE path
+    return stream_response([], user_id, user_input, [{"filename": source} for source in sources],
+                           reply_text=text, session_id=session_id, speaker=speaker, session=session)
+
+@app.post("/chat", dependencies=[Depends(require_ready)])
 async def chat(request: ChatRequest, current_user: dict = Depends(get_current_user)):
+    return await chat_reply(request, current_user)
+
+@app.post("/chat/voice", dependencies=[Depends(require_ready), Depends(require_voice)])
+async def chat_voice(request: ChatRequest, current_user: dict = Depends(get_current_user)):
+    # Like /chat, plus {"audio": <base64>, "sentence", "seq", "format"} events per synthesized sentence,
+    # each sentence closed by {"audio_end": <sentence>, "sentence_text": ...}
+    return await chat_reply(request, current_user, speaker=new_speaker())
+
+async def chat_reply(request, current_user, speaker=None):
+    frames, lease = await prepare_reply(request, current_user, speaker)
+    # The background task also releases the LLM slot if the stream never started
+    return StreamingResponse(
+        frames,
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+        background=BackgroundTask(lease.release) if lease is not None else None
+    )
+
+async def prepare_reply(request, current_user, speaker=None, session=None):
+    # Returns the reply's SSE frames and the LLM lease they hold (None for local replies).
+    # A WebSocket session (websocket_chat.ChatSession) supplies its conversation, cached turns and retrieval.
     user_input = request.message.strip()
     if not user_input:
         logger.error("Message cannot be empty")
         raise HTTPException(status_code=400, detail="Message cannot be empty")
+    if request.per_source_k and not request.sources:
+        raise HTTPException(status_code=400, detail="per_source_k needs a list of sources")
+    # Answers from a filtered search are not reusable for unfiltered questions
+    filtered = bool(request.sources or request.collections)
+    session_id = request.session_id if session is None else session.session_id
+    # Neither are answers to follow-ups, which depend on the conversation. Other
+    # questions within a session may be answered from the cache, but their own
+    # answers are only stored when the prompt carried none of the user's history.
+    cacheable = not filtered and (session_id is None or is_standalone(user_input))
+    context_key = (
+        user_input, tuple(request.sources or ()), tuple(request.collections or ()), request.per_source_k,
+        request.rerank, request.hybrid, rag.snapshot.version,
+    )
+    context = session.context(context_key) if session is not None else None
 
     try:
-        relevant_chunks, metadata = retrieve_chunks(user_input)
-        context = "\n".join([f"From {meta['filename']}:\n{chunk}" for chunk, meta in zip(relevant_chunks, metadata)])
-
-        system_message = {
-            "role": "system",
-            "content": (
-                "You are a devout companion who speaks of God with intimate knowledge and reverence, never claiming to be God. "
-                "Keep replies brief and compassionate, guiding all—believers, non-believers, atheists, and agnostics—with a focus on truth from God’s sacred words. "
-                "Draw wisdom from the provided context from religious texts, referencing them naturally (e.g., 'As Jesus taught in John 16:33...'). "
-                f"Context from documents:\n{context}\n"
-                "Speak as one who has witnessed God’s truth, using a humble, wise tone (e.g., 'I’ve seen His peace transform lives’). "
-                "Offer comfort, encourage introspection with gentle questions, and adapt to the user’s emotions as if in a sacred conversation. "
-                "Avoid theological debates; guide with clarity and warmth, rooted in scriptural truth. "
-                "Relate to modern events when relevant, showing God’s presence today. "
-                "Let the user feel they’re speaking with a trusted friend who knows God deeply."
+        # Canned intents first: keywords need no embedding, examples reuse the query embedding.
+        # A scripture reference the index cites ("John 3:16") skips the embedding altogether.
+        query_embedding = None
+        with span("intent_keywords"):
+            intent = intent_router.match_keywords(user_input)
+        if intent is None and not rag.has_reference(user_input):
+            if context is not None:
+                query_embedding = context["embedding"]
+            else:
+                with span("embed_query"):
+                    query_embedding = await rag.encode(user_input)
+            with span("intent_embedding"):
+                intent = intent_router.match_embedding(query_embedding)
+        if intent is not None:
+            logger.info(f"Routed to intent '{intent.name}': {user_input!r}")
+            REPLIES.inc(source="intent")
+            return local_frames(current_user["email"], user_input, intent.render(user_input), intent.sources,
+                                session_id, speaker, session), None
+
+        with span("answer_cache_lookup"):
+            cached = (
+                answer_cache.lookup(query_embedding)
+                if answer_cache is not None and query_embedding is not None and cacheable else None
             )
-        }
-        user_message = {"role": "user", "content": user_input}
+        if cached is not None:
+            logger.info(f"Answer cache hit for: {user_input!r} (cached question: {cached['query']!r})")
+            REPLIES.inc(source="cache")
+            return local_frames(current_user["email"], user_input, cached["answer"], cached["sources"],
+                                session_id, speaker, session), None
 
-        messages = [system_message, user_message]
+        # Admission before any further work: overload is answered with a fast 429
+        with span("llm_admission"):
+            lease = await llm.admit(current_user["email"])
+        try:
+            if context is not None:
+                relevant_chunks, metadata = context["chunks"], context["metadata"]
+            else:
+                relevant_chunks, metadata = await rag.retrieve(
+                    user_input,
+                    query_embedding=query_embedding,
+                    sources=request.sources,
+                    collections=request.collections,
+                    per_source_k=request.per_source_k,
+                    rerank=request.rerank,
+                    hybrid=request.hybrid,
+                )
+                if session is not None:
+                    session.remember(
+                        context_key, {"embedding": query_embedding, "chunks": relevant_chunks, "metadata": metadata}
+                    )
+            turns = await session.recent_turns(prompt_builder.recent_turns) if session is not None else None
+            with span("prompt_build"):
+                prompt = await prompt_builder.build(
+                    current_user["email"], session_id, user_input, relevant_chunks, metadata, turns=turns
+                )
+        except BaseException:
+            lease.release()
+            raise
+        logger.info(f"Prompt: {prompt.input_tokens} input tokens, {len(prompt.messages)} messages")
+        REPLIES.inc(source="llm")
 
-        chat_data = {
-            "user_id": current_user["email"],
-            "user_message": user_input,
-            "bot_reply": "Streaming..."
-        }
-        result = chats_collection.insert_one(chat_data)
-        chat_id = result.inserted_id
-
-        return StreamingResponse(
-            stream_response(messages, chat_id, metadata),
-            media_type="text/event-stream"
-        )
+        # The cache is shared by all users, so an answer written from someone's conversation is not stored
+        storable = cacheable and prompt.history_turns == 0 and not prompt.summary
+        frames = stream_response(prompt.messages, current_user["email"], user_input, metadata,
+                                 query_embedding if storable else None, session_id=session_id, prompt=prompt,
+                                 lease=lease, speaker=speaker, session=session)
+        return frames, lease
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat Endpoint Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+# Persistent chat connections: authenticated once, one streaming reply at a time
+open_connections = set()
+REGISTRY.gauge("ws_connections", "Open /ws/chat connections", lambda: len(open_connections))
+
+async def ws_authenticate(connection):
+    # A bearer header (non-browser clients), a ?token= query parameter or a first
+    # {"type": "auth"} message; the conversation is named by ?session_id= or in that message
+    params = connection.websocket.query_params
+    session_id = params.get("session_id")
+    authorization = connection.websocket.headers.get("authorization", "")
+    token = authorization[7:] if authorization.lower().startswith("bearer ") else params.get("token")
+    if not token:
+        message = json.loads(await asyncio.wait_for(connection.receive(), config.WS_AUTH_TIMEOUT_SECONDS))
+        if not isinstance(message, dict) or message.get("type") != "auth" or not message.get("token"):
+            raise HTTPException(status_code=401, detail="Expected an auth message")
+        token = message["token"]
+        session_id = message.get("session_id", session_id)
+    return await get_current_user(token), token_expiry(token), session_id
+
+async def ws_reply(connection, session, message):
+    reply_id = message.get("id")
+    try:
+        request = ChatRequest(**{key: value for key, value in message.items() if key in ChatRequest.model_fields})
+    except ValidationError as e:
+        await connection.send(json.dumps({"id": reply_id, "error": f"Invalid message: {str(e)}"}))
+        return
+    if message.get("voice") and tts is None:
+        await connection.send(json.dumps({"id": reply_id, "error": "Voice replies are not configured"}))
+        return
+    try:
+        frames, lease = await prepare_reply(
+            request, session.user, new_speaker() if message.get("voice") else None, session
+        )
+    except HTTPException as e:
+        await connection.send(json.dumps({"id": reply_id, "error": e.detail, "status": e.status_code}))
+        return
+    try:
+        async for frame in frames:
+            await connection.send(sse_to_message(frame, reply_id))
+    except SlowConsumer:
+        logger.warning(f"Dropped WebSocket of {session.user['email']}: client stopped reading")
+    finally:
+        # Closing the generator ends the upstream LLM stream when the reply was cancelled
+        await frames.aclose()
+        if lease is not None:
+            lease.release()
+
+async def cancel_reply(connection, reply):
+    if reply is None or reply[1].done():
+        return False
+    reply_id, task = reply
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    connection.send_control({"id": reply_id, "cancelled": True})
+    return True
+
+@app.websocket("/ws/chat")
+async def ws_chat(websocket: WebSocket):
+    # Protocol: see websocket_chat.py. Browsers do not apply CORS to WebSockets, so check the origin here.
+    origin = websocket.headers.get("origin")
+    if origin is not None and origin not in origins:
+        await websocket.close(POLICY_VIOLATION)
+        return
+    if not all(readiness.values()) or len(open_connections) >= config.WS_MAX_CONNECTIONS:
+        await websocket.close(TRY_AGAIN_LATER)
+        return
+    await websocket.accept()
+    connection = Connection(
+        websocket,
+        max_queue=config.WS_SEND_QUEUE,
+        send_timeout=config.WS_SEND_TIMEOUT_SECONDS,
+        heartbeat=config.WS_HEARTBEAT_SECONDS,
+        idle_timeout=config.WS_IDLE_TIMEOUT_SECONDS,
+    )
+    try:
+        with span("auth"):
+            user, expires_at, session_id = await ws_authenticate(connection)
+    except WebSocketDisconnect:
+        return
+    except (HTTPException, asyncio.TimeoutError, ValueError) as e:
+        detail = e.detail if isinstance(e, HTTPException) else "Authentication required"
+        await websocket.send_text(json.dumps({"type": "error", "error": detail}))
+        await connection.close(POLICY_VIOLATION, "Unauthorized")
+        return
+
+    session = ChatSession(user, session_id, prompt_builder.turn_window, config.WS_CONTEXT_CACHE)
+    open_connections.add(connection)
+    connection.start()
+    connection.send_control({"type": "ready", "user": user["email"], "session_id": session_id})
+    logger.info(f"WebSocket chat opened for {user['email']}")
+    reply = None  # (id, task) of the reply being streamed
+    try:
+        while True:
+            text = await connection.receive()
+            if expires_at is not None and time.time() >= expires_at:
+                await connection.close(POLICY_VIOLATION, "Token expired")
+                break
+            if len(text) > config.WS_MAX_MESSAGE_BYTES:
+                connection.send_control({"type": "error", "error": "Message too large"})
+                continue
+            try:
+                message = json.loads(text)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict):
+                connection.send_control({"type": "error", "error": "Expected a JSON object"})
+                continue
+            kind = message.get("type")
+            if kind == "message":
+                # A new question interrupts the reply in progress
+                await cancel_reply(connection, reply)
+                reply = (message.get("id"), asyncio.create_task(ws_reply(connection, session, message)))
+            elif kind == "cancel":
+                await cancel_reply(connection, reply)
+            elif kind == "ping":
+                connection.send_control({"type": "pong"})
+            elif kind != "pong":
+                connection.send_control({"type": "error", "error": f"Unknown message type {kind!r}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if reply is not None and not reply[1].done():
+            reply[1].cancel()
+        open_connections.discard(connection)
+        await connection.shutdown()
+        logger.info(f"WebSocket chat closed for {user['email']}")
+
 @app.post("/pray")
 async def pray(current_user: dict = Depends(get_current_user)):
     logger.info(f"Pray request from user: {current_user['email']}")
-    metadata = [{"filename": "bible.txt"}]  # Default metadata
-    response_content = (
-        "Heavenly Father, I come before You with a humble heart, seeking Your peace as we discuss faith. "
-        "Bless those who seek You, as John 3:16 reminds us of Your love, and guide us with Your wisdom. "
-        "Amen."
-    )
-    chat_data = {
-        "user_id": current_user["email"],
-        "user_message": "Pray request",
-        "bot_reply": response_content
-    }
-    result = chats_collection.insert_one(chat_data)
-    chat_id = result.inserted_id
+    with span("chat_record"):
+        await chat_writer.record(current_user["email"], "Pray request", PRAYER_TEXT, kind=database.PRAYER_KIND)
 
     async def pray_stream():
-        yield f"data: {json.dumps({'sources': ['bible.txt']})}\n\n"
-        for chunk in response_content.split():
-            json_data = json.dumps({"text": chunk})
-            yield f"data: {json_data}\n\n"
-            await asyncio.sleep(0.01)
-        yield f"data: {json.dumps({'done': True})}\n\n"
+        yield PRAY_BODY
+
+    return StreamingResponse(pray_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
 
-    return StreamingResponse(pray_stream(), media_type="text/event-stream")
+@app.post("/pray/voice", dependencies=[Depends(require_voice)])
+async def pray_voice(current_user: dict = Depends(get_current_user)):
+    # The prayer's sentences never change, so after the first request they come from the audio cache
+    logger.info(f"Voice pray request from user: {current_user['email']}")
+    with span("chat_record"):
+        await chat_writer.record(current_user["email"], "Pray request", PRAYER_TEXT, kind=database.PRAYER_KIND)
+    speaker = new_speaker()
+    stream = new_sse_stream(speaker.feed)
+
+    async def pray_stream():
+        yield sse_event({"sources": ["bible.txt"]})
+        async for frame in interleave(stream.static_frames(PRAYER_TEXT), speaker):
+            yield frame
+        yield DONE_FRAME
+
+    return StreamingResponse(pray_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def history_item(turn):
+    return {
+        "id": str(turn["_id"]),
+        "user_message": turn.get("user_message"),
+        "bot_reply": turn.get("bot_reply"),
+        "status": turn.get("status", "complete"),  # turns from before statuses were stored are complete
+    }
 
 @app.get("/chat-history")
-def get_chat_history(current_user: dict = Depends(get_current_user)):
+async def get_chat_history(
+    limit: Optional[int] = Query(None, ge=1),
+    before: Optional[str] = None,
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+    current_user: dict = Depends(get_current_user)
+):
     logger.info(f"Fetching chat history for user: {current_user['email']}")
-    chats = list(chats_collection.find({"user_id": current_user["email"]}, {"_id": 0}))
-    return {"history": chats}
+    try:
+        before_id = ObjectId(before) if before else None
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid 'before' cursor")
+
+    if format == "ndjson":
+        # Newest first, one turn per line, streamed straight from the cursor;
+        # without a limit the whole history is streamed in bounded batches
+        async def history_lines():
+            async for turn in database.chats.iter_history(current_user["email"], before_id, limit or 0):
+                yield json.dumps(history_item(turn)) + "\n"
+        return StreamingResponse(history_lines(), media_type="application/x-ndjson")
+
+    limit = min(limit or config.HISTORY_PAGE_SIZE, config.HISTORY_MAX_PAGE_SIZE)
+    turns = await database.chats.history_page(current_user["email"], limit, before_id)
+    next_before = str(turns[-1]["_id"]) if len(turns) == limit else None
+    # Pages are fetched newest first but returned in chronological order
+    return {"history": [history_item(turn) for turn in reversed(turns)], "next_before": next_before}
 
 @app.options("/token")
 async def options_token(req: Request):
@@ -289,22 +774,62 @@ async def options_token(req: Request):
 @app.post("/token")
 async def login(request: TokenRequest, req: Request):
     logger.info(f"Received login request from origin: {req.headers.get('origin')}")
-    logger.info(f"Request headers: {dict(req.headers)}")
-    user = users_collection.find_one({"email": request.email})
+    with span("user_lookup"):
+        user = await database.users.get_by_email(request.email)
     if not user:
         logger.error(f"User not found: {request.email}")
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    logger.info(f"Found user: {user['email']}, Hash: {user['hashed_password']}")
-    password_verified = verify_password(request.password, user["hashed_password"])
-    logger.info(f"Password verification result: {password_verified}")
+    with span("password_verify"):
+        password_verified, new_hash = await password_hasher.verify_and_update(request.password, user["hashed_password"])
     if not password_verified:
         logger.error(f"Password verification failed for {request.email}")
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if new_hash:
+        # Cost parameters changed since this hash was made: upgrade it now
+        # that we have the plain password
+        await database.users.set_password_hash(user["email"], new_hash)
+        invalidate_user(user["email"])
+        logger.info(f"Rehashed password for {user['email']}")
     token = create_access_token(data={"sub": user["email"]}, expires_delta=timedelta(hours=1))
-    logger.info(f"Login success: {request.email}, Token: {token}")
+    logger.info(f"Login success: {request.email}")
     response = {"access_token": token, "token_type": "bearer"}
-    logger.info(f"Returning response with headers: {response}")
     return JSONResponse(
         content=response,
         headers={"Access-Control-Allow-Origin": req.headers.get("origin", "*")}
     )
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/profiler", dependencies=[Depends(require_admin)])
+def profiler_report(limit: Optional[int] = Query(None, ge=1), format: str = Query("folded", pattern="^(folded|json)$")):
+    # Folded stacks (flamegraph.pl / speedscope) collected since the last start
+    if format == "json":
+        return profiler.status()
+    return PlainTextResponse(profiler.folded(limit))
+
+@app.post("/admin/profiler/start", dependencies=[Depends(require_admin)])
+def start_profiler(interval_ms: float = Query(config.PROFILER_INTERVAL_MS, ge=1)):
+    profiler.start(interval_ms)
+    return profiler.status()
+
+@app.post("/admin/profiler/stop", dependencies=[Depends(require_admin)])
+def stop_profiler():
+    profiler.stop()
+    return profiler.status()
+
+@app.get("/admin/index", dependencies=[Depends(require_admin)])
+def index_status():
+    return rag.status()
+
+@app.post("/admin/index/reload", dependencies=[Depends(require_admin)])
+async def reload_index(force: bool = False):
+    # Reloads this worker only; the others pick the snapshot up via INDEX_WATCH_INTERVAL_SECONDS
+    if not rag.ready:
+        raise HTTPException(status_code=503, detail="RAG is still starting up", headers={"Retry-After": "5"})
+    try:
+        reloaded = await rag.reload(force=force)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Index reload failed: {str(e)}")
+    return {"reloaded": reloaded, **rag.status()}
@@ -0,0 +1,98 @@
+import mongomock
+
+# In-process stand-in for AsyncMongoClient, selected with MONGO_URI=memory://
+# (see database.py). It wraps mongomock's synchronous in-memory collections in
+# the async API the repositories use, so benchmarks (bench_load.py) and
+# offline runs need no MongoDB server. Data lives only as long as the process.
+# mongomock is a dev dependency (requirements-dev.txt), not in the Docker image.
+
+
+class AsyncMemoryCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        self.cursor = self.cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, limit):
+        self.cursor = self.cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size):
+        return self
+
+    async def to_list(self, length=None):
+        documents = []
+        for document in self.cursor:
+            documents.append(document)
+            if length and len(documents) == length:
+                break
+        return documents
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncMemoryCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def find_one(self, *args, **kwargs):
+        return self.collection.find_one(*args, **kwargs)
+
+    def find(self, *args, **kwargs):
+        return AsyncMemoryCursor(self.collection.find(*args, **kwargs))
+
+    async def insert_one(self, document):
+        return self.collection.insert_one(document)
+
+    async def insert_many(self, documents, ordered=True):
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    async def update_one(self, *args, **kwargs):
+        return self.collection.update_one(*args, **kwargs)
+
+    async def create_index(self, keys, **kwargs):
+        return self.collection.create_index(keys, **kwargs)
+
+
+class AsyncMemoryDatabase:
+    def __init__(self, database):
+        self.database = database
+        self.collections = {}
+
+    def command(self, name, *args, **kwargs):
+        return _command(name)
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = AsyncMemoryCollection(self.database[name])
+        return self.collections[name]
+
+
+async def _command(name):
+    if name != "ping":
+        raise NotImplementedError(f"memory:// MongoDB does not support the {name!r} command")
+    return {"ok": 1.0}
+
+
+class AsyncMemoryClient:
+    def __init__(self):
+        self.client = mongomock.MongoClient()
+        self.databases = {}
+        self.admin = self["admin"]
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = AsyncMemoryDatabase(self.client[name])
+        return self.databases[name]
+
+    async def close(self):
+        self.client.close()
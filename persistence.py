@@ -0,0 +1,105 @@
+import asyncio
+import logging
+from bson import ObjectId
+from metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind persistence of chat turns. Handlers hand the turn to
+# record() and move on; a background task writes queued turns with one
+# insert_many per batch, triggered by batch size or flush interval. When the
+# queue is full record() waits for room (backpressure) instead of growing
+# memory without bound. close() flushes whatever is still queued.
+class ChatWriter:
+    def __init__(self, repository, batch_size=100, flush_interval_ms=200, max_queue=10000,
+                 max_retries=3, retry_backoff_ms=200):
+        self.repository = repository
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff_ms / 1000
+        self.queue = None
+        self.worker = None
+        # Turns recorded but not written yet, per user and keyed by _id (in
+        # insertion order), so a follow-up message sees its predecessor even
+        # before the batch reaches Mongo
+        self.unwritten = {}
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_queue)
+        self.worker = asyncio.create_task(self._run())
+
+    async def record(self, user_id, user_message, bot_reply, **fields):
+        # The _id is assigned now so turns keep their chronological order in
+        # the collection even though they are written later, in batches
+        turn = {"_id": ObjectId(), "user_id": user_id, "user_message": user_message, "bot_reply": bot_reply, **fields}
+        self.unwritten.setdefault(user_id, {})[turn["_id"]] = turn
+        await self.queue.put(turn)
+        return turn["_id"]
+
+    def pending_turns(self, user_id):
+        return list(self.unwritten.get(user_id, {}).values())
+
+    def _forget(self, batch):
+        for turn in batch:
+            turns = self.unwritten.get(turn["user_id"])
+            if turns is not None:
+                turns.pop(turn["_id"], None)
+                if not turns:
+                    del self.unwritten[turn["user_id"]]
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                with span("chats_insert_many"):
+                    await self.repository.insert_many(batch)
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Dropping {len(batch)} chat turns after {attempt + 1} failed writes: {str(e)}")
+                    return
+                logger.warning(f"Writing {len(batch)} chat turns failed, retrying: {str(e)}")
+                await asyncio.sleep(self.retry_backoff * (2 ** attempt))
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._write(batch)
+            finally:
+                self._forget(batch)
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def close(self, timeout=10):
+        if self.worker is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Shutdown flush timed out with {self.queue.qsize()} chat turns still queued")
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
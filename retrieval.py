@@ -0,0 +1,439 @@
+import asyncio
+import logging
+import os
+import time
+import faiss
+import numpy as np
+from documents import ChunkStore
+from embeddings import EmbeddingBatcher, load_model
+from lexical import LexicalIndex, fuse
+from metrics import REGISTRY, span
+from snapshots import LEXICAL_DIR, VECTORS_FILE, resolve
+from vector_index import search_parameters, set_search_params, describe
+
+logger = logging.getLogger(__name__)
+
+# RAG components: the embedding model, the FAISS index and the chunk store.
+# Nothing is loaded at import time. start() loads the model and the index in
+# parallel worker threads, then warms both up with a few encodes and searches
+# so the first real request does not pay for lazy initialisation, kernel
+# selection or page faults. `ready` turns true once that is done.
+#
+# The index and chunk store are held together in an IndexSnapshot. reload()
+# loads a newly published snapshot (see snapshots.py) in a worker thread,
+# warms it up and swaps it in with a single reference assignment. Requests
+# hold on to the snapshot they started with, and the old one is closed once
+# the last of them is done, so nothing in flight is dropped.
+#
+# retrieve() can be restricted to source files and/or collections (the
+# top-level directory a file was ingested from). The filter is applied inside
+# the search with a FAISS ID selector built from the chunk store's metadata
+# codes (plus the further sources of chunks shared by several files), so it
+# never eats into k. Small filtered sets are scanned exactly
+# against the snapshot's float32 vectors instead, which is both faster and
+# more accurate than an approximate index restricted to a few ids. The same
+# vectors serve the optional exact L2 rerank of over-fetched candidates.
+#
+# Snapshots with a lexical index (lexical.py) add two things. A query naming an
+# unambiguous scripture reference that the corpus cites ("John 3:16", "Psalm
+# 23") gets those chunks straight from the reference table, before any
+# embedding is computed. Any other query is also scored with BM25, and the
+# lexical and vector rankings are merged with reciprocal-rank fusion, which
+# catches exact names and rare words that the embedding blurs. Chunks citing a
+# possible reference ("job 2", "Ps 23") join the fusion as a third ranking, a
+# boost rather than a shortcut, since the words may not be a reference at all.
+
+WARMUP_TEXTS = [
+    "How can I find peace in hard times?",
+    "What does the Bible say about forgiveness?",
+    "Where is God when I suffer?",
+    "How do I grow in faith?",
+]
+
+
+def read_index(path, mmap=True):
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logger.warning(f"Cannot memory-map {path}, reading it into RAM: {str(e)}")
+    return faiss.read_index(path)
+
+
+RELOADS = REGISTRY.counter("index_reloads_total", "Index snapshot reload attempts", ("result",))
+MAX_CACHED_SELECTIONS = 256
+
+
+class IndexSnapshot:
+    # A FAISS index and its chunk store from the same build. `users` counts
+    # requests using it; a retired snapshot is closed when that drops to zero.
+    def __init__(self, version, index=None, chunk_store=None, vectors=None, lexical=None):
+        self.version = version
+        self.index = index
+        self.chunk_store = chunk_store
+        self.vectors = vectors  # exact embeddings, None for snapshots built before they were written
+        self.lexical = lexical  # LexicalIndex, likewise None for older snapshots
+        self.selections = {}  # (field, values) -> sorted chunk ids
+        self.users = 0
+        self.retired = False
+
+    def __enter__(self):
+        self.users += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.users -= 1
+        if self.retired and self.users == 0:
+            self.close()
+        return False
+
+    def select(self, field, values):
+        # Ids of the chunks whose `field` is one of `values`
+        key = (field, frozenset(values))
+        ids = self.selections.get(key)
+        if ids is None:
+            wanted = [code for code, value in enumerate(self.chunk_store.values.get(field, [])) if value in key[1]]
+            codes = self.chunk_store.codes.get(field)
+            if wanted and codes is not None:
+                ids = np.flatnonzero(np.isin(codes, wanted))
+            else:
+                ids = np.empty(0, dtype=np.int64)
+            # A chunk shared by several files matches through any of them
+            shared = [i for i, rows in self.chunk_store.shared.items() if any(row.get(field) in key[1] for row in rows)]
+            if shared:
+                ids = np.union1d(ids, np.asarray(shared, dtype=np.int64))
+            if len(self.selections) >= MAX_CACHED_SELECTIONS:
+                self.selections.pop(next(iter(self.selections)))
+            self.selections[key] = ids
+        return ids
+
+    def retire(self):
+        self.retired = True
+        if self.users == 0:
+            self.close()
+
+    def close(self):
+        if self.chunk_store is not None:
+            self.chunk_store.close()
+        if self.lexical is not None:
+            self.lexical.close()
+        self.index = None
+        self.chunk_store = None
+        self.vectors = None
+        self.lexical = None
+        self.selections = {}
+
+
+class Retriever:
+    def __init__(self, model_path, index_file, chunk_store_dir, mmap=True, nprobe=None, ef_search=None,
+                 max_batch_size=32, max_wait_ms=5, workers=1, backend="torch", onnx_file="model_int8.onnx",
+                 threads=0, snapshot_dir="index_snapshots", watch_interval=0, rerank=False, rerank_candidates=4,
+                 exact_filter_max=4096, hybrid=True, hybrid_candidates=4, rrf_k=60):
+        self.model_path = model_path
+        self.backend = backend
+        self.onnx_file = onnx_file
+        self.threads = threads
+        self.index_file = index_file
+        self.chunk_store_dir = chunk_store_dir
+        self.snapshot_dir = snapshot_dir
+        self.watch_interval = watch_interval
+        self.mmap = mmap
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.rerank = rerank
+        self.rerank_candidates = rerank_candidates
+        self.exact_filter_max = exact_filter_max
+        self.hybrid = hybrid
+        self.hybrid_candidates = hybrid_candidates
+        self.rrf_k = rrf_k
+        self.batcher_options = dict(max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, workers=workers)
+        self.embedder = None
+        self.snapshot = IndexSnapshot(None)
+        self.reload_lock = None  # created on first use, inside the running loop
+        self.watcher = None
+        self.ready = False
+
+    @property
+    def index(self):
+        return self.snapshot.index
+
+    @property
+    def chunk_store(self):
+        return self.snapshot.chunk_store
+
+    def _load_model(self):
+        started = time.perf_counter()
+        model = load_model(self.model_path, self.backend, self.onnx_file, self.threads)
+        logger.info(
+            f"Embedding model loaded from {self.model_path} ({self.backend}) in {time.perf_counter() - started:.1f}s"
+        )
+        return model
+
+    def _load_snapshot(self, version, index_file, chunk_store_dir):
+        # Handle missing FAISS files gracefully
+        if not (os.path.exists(index_file) and os.path.isdir(chunk_store_dir)):
+            logger.warning(f"FAISS index or chunk store not found in index version {version}. RAG disabled.")
+            return IndexSnapshot(version)
+        index = read_index(index_file, self.mmap)
+        chunk_store = ChunkStore(chunk_store_dir)
+        set_search_params(index, nprobe=self.nprobe, ef_search=self.ef_search)
+        vectors = None
+        vectors_file = os.path.join(os.path.dirname(index_file), VECTORS_FILE)
+        if os.path.exists(vectors_file) and os.path.getsize(vectors_file) == index.ntotal * index.d * 4:
+            vectors = np.memmap(vectors_file, dtype="<f4", mode="r", shape=(index.ntotal, index.d))
+        else:
+            logger.warning(f"No exact vectors in index version {version}: filters use the index, no reranking")
+        lexical = None
+        lexical_dir = os.path.join(os.path.dirname(index_file), LEXICAL_DIR)
+        if os.path.isdir(lexical_dir):
+            lexical = LexicalIndex(lexical_dir)
+        else:
+            logger.warning(f"No lexical index in index version {version}: vector search only")
+        logger.info(
+            f"FAISS index and chunk store loaded successfully: {describe(index)}, {len(chunk_store)} chunks "
+            f"(index version {version})"
+        )
+        return IndexSnapshot(version, index, chunk_store, vectors, lexical)
+
+    def _load_index(self):
+        version, index_file, chunk_store_dir = resolve(self.snapshot_dir, self.index_file, self.chunk_store_dir)
+        try:
+            return self._load_snapshot(version, index_file, chunk_store_dir)
+        except Exception as e:
+            logger.error(f"Error loading FAISS files: {str(e)}")
+            return IndexSnapshot(version)
+
+    async def start(self):
+        started = time.perf_counter()
+        model, self.snapshot = await asyncio.gather(
+            asyncio.to_thread(self._load_model),
+            asyncio.to_thread(self._load_index),
+        )
+        self.embedder = EmbeddingBatcher(model, **self.batcher_options)
+        try:
+            await self.warmup()
+        except BaseException:
+            # Leave nothing running behind a failed start, so it can simply be retried
+            await self.embedder.close()
+            self.embedder = None
+            self.snapshot.retire()
+            self.snapshot = IndexSnapshot(None)
+            raise
+        self.ready = True
+        logger.info(f"RAG ready in {time.perf_counter() - started:.1f}s")
+        if self.watch_interval > 0:
+            self.watcher = asyncio.create_task(self.watch())
+
+    async def warmup(self, snapshot=None):
+        # One encode on its own and one concurrent batch, so both batch shapes are exercised
+        embeddings = [await self.encode(WARMUP_TEXTS[0])]
+        embeddings += await asyncio.gather(*(self.encode(text) for text in WARMUP_TEXTS[1:]))
+        snapshot = snapshot or self.snapshot
+        if snapshot.index is not None:
+            for embedding in embeddings:
+                self._search(snapshot, embedding, 3)
+
+    async def reload(self, force=False):
+        # Load the published snapshot next to the live one and swap it in. Returns
+        # whether the version changed; a failed load keeps serving the old one.
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+        async with self.reload_lock:
+            version, index_file, chunk_store_dir = resolve(self.snapshot_dir, self.index_file, self.chunk_store_dir)
+            if version == self.snapshot.version and not force:
+                return False
+            started = time.perf_counter()
+            try:
+                snapshot = await asyncio.to_thread(self._load_snapshot, version, index_file, chunk_store_dir)
+                await self.warmup(snapshot)
+            except Exception as e:
+                RELOADS.inc(result="error")
+                logger.error(f"Loading index version {version} failed, still serving {self.snapshot.version}: {str(e)}")
+                raise
+            previous, self.snapshot = self.snapshot, snapshot
+            previous.retire()
+            RELOADS.inc(result="ok")
+            logger.info(
+                f"Index version {previous.version} -> {version} swapped in after {time.perf_counter() - started:.1f}s"
+            )
+            return True
+
+    async def watch(self):
+        # Poll the CURRENT pointer; cheap enough to run in every worker
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                await self.reload()
+            except Exception:
+                pass  # logged by reload(); retried on the next tick
+
+    async def encode(self, text):
+        return await self.embedder.encode(text)
+
+    @staticmethod
+    def _exact(snapshot, query, ids, k):
+        # Brute-force squared L2 (what IndexFlatL2 returns) over the given chunk ids
+        ids = np.sort(ids)
+        diff = snapshot.vectors[ids] - query
+        distances = np.einsum("ij,ij->i", diff, diff)
+        top = np.argsort(distances)[:k] if len(ids) <= k else np.argpartition(distances, k)[:k]
+        top = top[np.argsort(distances[top])]
+        return [(float(distances[j]), int(ids[j])) for j in top]
+
+    def _search(self, snapshot, query_embedding, k, ids=None, rerank=False):
+        # (distance, chunk id) of the k nearest chunks, optionally only among `ids`
+        query = np.ascontiguousarray(query_embedding, dtype="float32").reshape(1, -1)
+        exact = snapshot.vectors is not None
+        if ids is not None:
+            if len(ids) == 0:
+                return []
+            if exact and len(ids) <= self.exact_filter_max:
+                return self._exact(snapshot, query[0], ids, k)
+        fetch = k * self.rerank_candidates if rerank and exact else k
+        if ids is None:
+            distances, indices = snapshot.index.search(query, fetch)
+        else:
+            mask = np.zeros(snapshot.index.ntotal, dtype=bool)
+            mask[ids] = True
+            bitmap = np.packbits(mask, bitorder="little")  # must outlive the search
+            selector = faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap))
+            distances, indices = snapshot.index.search(
+                query, fetch, params=search_parameters(snapshot.index, selector)
+            )
+        hits = [(float(d), int(i)) for d, i in zip(distances[0], indices[0]) if i >= 0]  # -1 pads short results
+        if fetch > k and hits:
+            with span("rerank"):
+                hits = self._exact(snapshot, query[0], np.array([i for _, i in hits]), k)
+        return hits[:k]
+
+    def _rank(self, snapshot, query, query_embedding, k, ids=None, rerank=False, hybrid=False):
+        # Vector hits, fused with BM25 hits when hybrid: then (-fused score, chunk id), so callers can still sort
+        if not hybrid or snapshot.lexical is None:
+            return self._search(snapshot, query_embedding, k, ids, rerank)
+        depth = k * self.hybrid_candidates
+        with span("bm25_search"):
+            lexical_hits = snapshot.lexical.search(query, depth, ids)
+            reference_ids = snapshot.lexical.references(query)
+            if ids is not None and reference_ids:
+                allowed = set(ids.tolist())
+                reference_ids = [i for i in reference_ids if i in allowed]
+            reference_hits = [(0.0, i) for i in reference_ids[:depth]]
+        # Fused even without lexical hits, so per-source results stay comparable
+        vector_hits = self._search(
+            snapshot, query_embedding, depth if lexical_hits or reference_hits else k, ids, rerank
+        )
+        return fuse([vector_hits, lexical_hits, reference_hits], k, self.rrf_k)
+
+    @staticmethod
+    def _reference_ids(snapshot, query, k, sources=None, allowed=None, per_source_k=None, labels=None):
+        # Chunks citing the unambiguous scripture references in `query`, within the filters.
+        # With per_source_k, `labels` gets the source each chunk was taken for.
+        ids = snapshot.lexical.references(query, strict=True)
+        if not ids:
+            return []
+        if sources:
+            selected = set(snapshot.select("filename", sources).tolist())
+            ids = [i for i in ids if i in selected]
+        if allowed is not None:
+            allowed = set(allowed.tolist())
+            ids = [i for i in ids if i in allowed]
+        if not per_source_k:
+            return ids[:k]
+        selections = {source: set(snapshot.select("filename", [source]).tolist()) for source in sources}
+        taken = {}
+        result = []
+        for i in ids:
+            # A shared chunk counts against the first listed source it occurs in that has room
+            for source, selected in selections.items():
+                if i in selected and taken.get(source, 0) < per_source_k:
+                    taken[source] = taken.get(source, 0) + 1
+                    result.append(i)
+                    labels[i] = source
+                    break
+        return result
+
+    @staticmethod
+    def _metadata(snapshot, i, sources=None, collections=None):
+        # The metadata of a source that passes the filters, for chunks shared by several files
+        rows = snapshot.chunk_store.all_metadata(i)
+        for row in rows:
+            if (not sources or row.get("filename") in sources) and \
+                    (not collections or row.get("collection") in collections):
+                return row
+        return rows[0]
+
+    def has_reference(self, query):
+        # Whether retrieve() can answer `query` from the reference table, without an embedding
+        lexical = self.snapshot.lexical
+        return lexical is not None and bool(lexical.references(query, strict=True))
+
+    async def retrieve(self, query, k=3, query_embedding=None, sources=None, collections=None, per_source_k=None,
+                       rerank=None, hybrid=None):
+        # sources: file paths relative to the source dir; collections: top-level source directories;
+        # per_source_k: return the best per_source_k chunks of each listed source
+        if per_source_k and not sources:
+            raise ValueError("per_source_k needs a list of sources")
+        rerank = self.rerank if rerank is None else rerank
+        hybrid = self.hybrid if hybrid is None else hybrid
+        # Everything below uses the snapshot that was live when the request arrived
+        with self.snapshot as snapshot:
+            if snapshot.index is None:
+                logger.info("RAG disabled, returning empty chunks")
+                return [], []
+            allowed = snapshot.select("collection", collections) if collections else None
+            ids = []
+            labels = {}  # chunk id -> the listed source it was retrieved for, with per_source_k
+            if snapshot.lexical is not None:
+                with span("reference_lookup"):
+                    ids = self._reference_ids(snapshot, query, k, sources, allowed, per_source_k, labels)
+            if not ids:
+                if query_embedding is None:
+                    with span("embed_query"):
+                        query_embedding = await self.encode(query)
+                with span("faiss_search"):
+                    if per_source_k:
+                        hits = []
+                        for source in dict.fromkeys(sources):
+                            source_ids = snapshot.select("filename", [source])
+                            if allowed is not None:
+                                source_ids = np.intersect1d(source_ids, allowed, assume_unique=True)
+                            if labels:
+                                # A chunk shared with an earlier source is returned once, for that source
+                                source_ids = np.setdiff1d(source_ids, list(labels), assume_unique=True)
+                            source_hits = self._rank(
+                                snapshot, query, query_embedding, per_source_k, source_ids, rerank, hybrid
+                            )
+                            labels.update((i, source) for _, i in source_hits)
+                            hits += source_hits
+                        hits.sort()
+                    else:
+                        filter_ids = snapshot.select("filename", sources) if sources else None
+                        if allowed is not None:
+                            filter_ids = allowed if filter_ids is None else np.intersect1d(
+                                filter_ids, allowed, assume_unique=True
+                            )
+                        hits = self._rank(snapshot, query, query_embedding, k, filter_ids, rerank, hybrid)
+                ids = [i for _, i in hits]
+            with span("chunk_lookup"):
+                retrieved_chunks = [snapshot.chunk_store.text(i) for i in ids]
+                retrieved_metadata = [
+                    self._metadata(snapshot, i, [labels[i]] if i in labels else sources, collections) for i in ids
+                ]
+        return retrieved_chunks, retrieved_metadata
+
+    def status(self):
+        snapshot = self.snapshot
+        return {
+            "version": snapshot.version,
+            "chunks": len(snapshot.chunk_store) if snapshot.chunk_store is not None else 0,
+            "index": describe(snapshot.index) if snapshot.index is not None else None,
+            "lexical": snapshot.lexical is not None,
+        }
+
+    async def close(self):
+        if self.watcher is not None:
+            self.watcher.cancel()
+        if self.embedder is not None:
+            await self.embedder.close()
+        self.snapshot.retire()
+
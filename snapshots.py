@@ -0,0 +1,102 @@
+import logging
+import os
+import secrets
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+# Versioned index snapshots, published atomically by index_pdfs.py:
+#
+#   index_snapshots/
+#     CURRENT                    name of the live snapshot
+#     20261018-101500-3fa2c1/
+#       faiss_index.bin
+#       chunk_store/
+#       vectors.f32              exact float32 embeddings, row i = chunk i
+#       lexical/                 BM25 postings and scripture references (see lexical.py)
+#
+# A snapshot directory is complete and fsynced before CURRENT is replaced
+# (write to a temp file, then rename), so readers see either the old or the
+# new version, never a torn index/chunk-store pair. Snapshots are never
+# modified after publishing. Without a CURRENT file the legacy INDEX_FILE and
+# CHUNK_STORE_DIR paths are served, with version "legacy".
+
+CURRENT_FILE = "CURRENT"
+INDEX_FILE = "faiss_index.bin"
+CHUNK_STORE_DIR = "chunk_store"
+VECTORS_FILE = "vectors.f32"
+LEXICAL_DIR = "lexical"
+LEGACY_VERSION = "legacy"
+
+
+def new_version():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{secrets.token_hex(3)}"
+
+
+def snapshot_paths(root, version):
+    path = os.path.join(root, version)
+    return os.path.join(path, INDEX_FILE), os.path.join(path, CHUNK_STORE_DIR)
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def resolve(root, legacy_index_file, legacy_chunk_store_dir):
+    # (version, index file, chunk store dir) of what should be served right now
+    version = current_version(root)
+    if version is None:
+        return LEGACY_VERSION, legacy_index_file, legacy_chunk_store_dir
+    return (version,) + snapshot_paths(root, version)
+
+
+def _fsync_tree(path):
+    for directory, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(directory, name), "rb") as f:
+                os.fsync(f.fileno())
+        _fsync_dir(directory)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # not supported on this platform
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def publish(root, version):
+    # Make the finished snapshot durable, then flip CURRENT to it
+    _fsync_tree(os.path.join(root, version))
+    tmp_path = os.path.join(root, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+    _fsync_dir(root)
+    logger.info(f"Published index snapshot {version}")
+
+
+def prune(root, keep):
+    # Remove the oldest snapshots beyond `keep`, never the live one. Workers
+    # still serving a removed snapshot keep their open mappings until they reload.
+    live = current_version(root)
+    versions = sorted(
+        name for name in os.listdir(root)
+        if os.path.isdir(os.path.join(root, name)) and not name.endswith(".tmp")
+    )
+    for version in versions[:max(len(versions) - keep, 0)]:
+        if version != live:
+            shutil.rmtree(os.path.join(root, version), ignore_errors=True)
+            logger.info(f"Removed old index snapshot {version}")
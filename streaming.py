@@ -0,0 +1,125 @@
+import asyncio
+import json
+
+# Server-sent events helpers shared by /chat and /pray.
+#
+# Tokens are coalesced into frames that are flushed when FLUSH_INTERVAL has
+# passed since the first buffered token or the buffer reaches MAX_FRAME_BYTES,
+# whichever comes first. The first chunk is sent straight away to keep time to
+# first token low. There is no per-token sleep: a fast upstream gets a few
+# large frames, a slow one still sees text within one flush interval.
+# Text frames are contiguous slices of the reply, so concatenating their
+# "text" fields reproduces it exactly.
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",  # stop reverse proxies from buffering the stream
+}
+
+# Pre-encoded frame templates
+_DATA = b"data: "
+_END = b"\n\n"
+_TEXT_PREFIX = b'data: {"text": '
+_TEXT_SUFFIX = b"}\n\n"
+DONE_FRAME = b'data: {"done": true}\n\n'
+
+
+def sse_event(payload):
+    return _DATA + json.dumps(payload).encode("utf-8") + _END
+
+
+def text_frame(text):
+    return _TEXT_PREFIX + json.dumps(text).encode("utf-8") + _TEXT_SUFFIX
+
+
+def split_text(text, max_bytes):
+    # Split an already-complete reply into frame-sized slices at whitespace
+    pieces = []
+    start = 0
+    while len(text) - start > max_bytes:
+        cut = text.rfind(" ", start, start + max_bytes)
+        cut = start + max_bytes if cut <= start else cut + 1
+        pieces.append(text[start:cut])
+        start = cut
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def static_frames(text, max_bytes):
+    # Fully pre-encoded frames for replies that are known up front
+    return b"".join(text_frame(piece) for piece in split_text(text, max_bytes))
+
+
+async def coalesce(chunks, flush_interval, max_bytes):
+    # Re-batch an async iterator of text chunks into larger pieces
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    buffer = []
+    size = 0
+    deadline = None
+    pending = None
+    first = True
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait((pending,), timeout=max(0.0, deadline - loop.time()))
+                if not done:
+                    # Upstream is slow: flush what we have instead of holding it back
+                    yield "".join(buffer)
+                    buffer, size, deadline = [], 0, None
+                    continue
+            try:
+                text = await pending
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+            if not text:
+                continue
+            if first:
+                first = False
+                yield text
+                continue
+            if not buffer:
+                deadline = loop.time() + flush_interval
+            buffer.append(text)
+            size += len(text)  # characters; equal to bytes for the mostly-ASCII replies
+            if size >= max_bytes:
+                yield "".join(buffer)
+                buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+class SSEStream:
+    # Frames a text stream as SSE and keeps the full reply for persistence.
+    # `on_text` sees every piece as it is framed, e.g. voice.Speaker.feed.
+    def __init__(self, flush_interval_ms=25, max_frame_bytes=1024, on_text=None):
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_frame_bytes = max_frame_bytes
+        self.on_text = on_text
+        self.parts = []
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    async def frames(self, chunks):
+        async for piece in coalesce(chunks, self.flush_interval, self.max_frame_bytes):
+            self.parts.append(piece)
+            if self.on_text is not None:
+                self.on_text(piece)
+            yield text_frame(piece)
+
+    async def static_frames(self, text):
+        for piece in split_text(text, self.max_frame_bytes):
+            self.parts.append(piece)
+            if self.on_text is not None:
+                self.on_text(piece)
+            yield text_frame(piece)
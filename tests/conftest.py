@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The modules live at the top level of the repo. The database layer runs on the
+# in-process Mongo stand-in (memory_mongo.py), so no server is needed.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("MONGO_URI", "memory://")
+os.environ.setdefault("JWT_SECRET", "test-secret")
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")  # the minimum; tests only need the hash format
@@ -0,0 +1,189 @@
+import asyncio
+import hashlib
+import numpy as np
+import pytest
+from bson import ObjectId
+import answer_cache
+from answer_cache import SemanticCache, is_standalone
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(answer_cache.time, "time", clock)
+    return clock
+
+
+def vector(*values):
+    return np.array(values, dtype="float32")
+
+
+def test_hit_needs_the_threshold(clock):
+    cache = SemanticCache(threshold=0.95)
+    cache.put(vector(1, 0, 0), "q", "answer", ["bible.txt"])
+    assert cache.lookup(vector(2, 0.1, 0))["answer"] == "answer"  # scale does not matter
+    assert cache.lookup(vector(1, 1, 0)) is None  # cosine 0.71
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_empty_cache_misses(clock):
+    cache = SemanticCache()
+    assert cache.lookup(vector(1, 0)) is None
+    assert cache.misses == 1
+
+
+def test_expired_entries_miss(clock):
+    cache = SemanticCache(ttl_seconds=60)
+    cache.put(vector(1, 0), "q", "answer", [])
+    clock.now += 60
+    assert cache.lookup(vector(1, 0)) is None
+
+
+def test_full_cache_reuses_expired_then_least_recently_used(clock):
+    cache = SemanticCache(ttl_seconds=100, max_entries=2)
+    cache.put(vector(1, 0, 0), "a", "A", [])
+    clock.now += 50
+    cache.put(vector(0, 1, 0), "b", "B", [])
+    clock.now += 60  # "a" has expired
+    cache.put(vector(0, 0, 1), "c", "C", [])
+    assert sorted(entry["query"] for entry in cache.entries) == ["b", "c"]
+
+    clock.now += 1
+    cache.lookup(vector(0, 1, 0))  # "c" is now the least recently used
+    cache.put(vector(1, 1, 0), "d", "D", [])
+    assert sorted(entry["query"] for entry in cache.entries) == ["b", "d"]
+
+
+def test_entries_survive_a_reload_through_the_repository(clock):
+    class Repository:
+        def __init__(self):
+            self.documents = []
+
+        async def save(self, embedding, entry):
+            self.documents.insert(0, {**entry, "embedding": embedding})
+
+        async def load_recent(self, min_created_at, limit):
+            return [d for d in self.documents if d["created_at"] >= min_created_at][:limit]
+
+    async def scenario():
+        repository = Repository()
+        cache = SemanticCache(repository=repository)
+        cache.put(vector(1, 0), "q", "answer", ["bible.txt"])
+        await asyncio.gather(*cache.writes)
+        reloaded = SemanticCache(repository=repository)
+        await reloaded.load()
+        return reloaded.lookup(vector(1, 0))
+
+    assert asyncio.run(scenario())["sources"] == ["bible.txt"]
+
+
+@pytest.mark.parametrize("question, standalone", [
+    ("How can I find peace in hard times?", True),
+    ("What does the Bible say about forgiveness?", True),
+    ("Does God hear me when I pray in His name?", True),
+    ("Can you tell me more about that?", False),
+    ("Why did he say it like that?", False),
+    ("He said what to Peter?", False),
+    ("And what about my brother?", False),
+    ("why?", False),
+])
+def test_follow_ups_are_not_standalone(question, standalone):
+    assert is_standalone(question) is standalone
+
+
+class FakeLease:
+    def release(self):
+        pass
+
+
+class FakeLLM:
+    # Answers from the conversation when the prompt carries one, like the real model would
+    async def admit(self, user_id):
+        return FakeLease()
+
+    async def stream(self, messages):
+        if any(message["role"] == "assistant" for message in messages):
+            yield "I am so sorry about your mother's cancer."
+        else:
+            yield "Scripture speaks of comfort in grief."
+
+    async def complete(self, messages):
+        return "summary"
+
+
+class FakeRag:
+    class snapshot:
+        version = "v1"
+
+    def has_reference(self, query):
+        return False
+
+    async def encode(self, text):
+        # Unrelated texts get near-orthogonal vectors
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(64).astype("float32")
+
+    async def retrieve(self, query, **filters):
+        return [], []
+
+
+class FakeRouter:
+    def match_keywords(self, text):
+        return None
+
+    def match_embedding(self, embedding):
+        return None
+
+
+class FakeWriter:
+    def __init__(self):
+        self.turns = []
+
+    async def record(self, user_id, user_message, bot_reply, **fields):
+        turn = {"_id": ObjectId(), "user_id": user_id, "user_message": user_message, "bot_reply": bot_reply, **fields}
+        self.turns.append(turn)
+        return turn["_id"]
+
+    def pending_turns(self, user_id):
+        return [turn for turn in self.turns if turn["user_id"] == user_id]
+
+
+def test_answers_written_from_a_conversation_are_not_cached(monkeypatch):
+    from fastapi.testclient import TestClient
+    import main
+    from auth import get_current_user
+
+    writer = FakeWriter()
+    for key in main.readiness:
+        monkeypatch.setitem(main.readiness, key, True)
+    monkeypatch.setattr(main, "llm", FakeLLM())
+    monkeypatch.setattr(main, "rag", FakeRag())
+    monkeypatch.setattr(main, "intent_router", FakeRouter())
+    monkeypatch.setattr(main, "chat_writer", writer)
+    monkeypatch.setattr(main, "answer_cache", SemanticCache())
+    monkeypatch.setattr(main.prompt_builder, "pending_turns", writer.pending_turns)
+    monkeypatch.setattr(main.prompt_builder, "summaries", None)
+    client = TestClient(main.app)
+
+    def ask(user, message, session_id=None):
+        main.app.dependency_overrides[get_current_user] = lambda: {"email": user}
+        response = client.post("/chat", json={"message": message, "session_id": session_id})
+        return response.text
+
+    question = "What does the Bible say about suffering and grief?"
+    try:
+        ask("alice@example.com", "My mother has cancer", "s1")
+        assert "mother" in ask("alice@example.com", question, "s1")
+        assert main.answer_cache.lookup(asyncio.run(FakeRag().encode(question))) is None
+        reply = ask("bob@example.com", question)
+    finally:
+        main.app.dependency_overrides.clear()
+    assert "mother" not in reply
@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+from passlib.context import CryptContext
+import auth
+import database
+from auth import PrincipalCache, create_access_token
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(auth.time, "time", clock)
+    return clock
+
+
+def principal(email):
+    return {"email": email}
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = PrincipalCache(ttl_seconds=60)
+    cache.put("t1", principal("a@x"), token_expiry=clock.now + 3600)
+    clock.now += 59
+    assert cache.get("t1") == principal("a@x")
+    clock.now += 2
+    assert cache.get("t1") is None
+    assert cache.entries == {} and cache.tokens_by_user == {}
+
+
+def test_entry_expires_with_its_token(clock):
+    cache = PrincipalCache(ttl_seconds=300)
+    cache.put("t1", principal("a@x"), token_expiry=clock.now + 10)
+    clock.now += 10
+    assert cache.get("t1") is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = PrincipalCache(max_size=2)
+    cache.put("t1", principal("a@x"), clock.now + 3600)
+    cache.put("t2", principal("b@x"), clock.now + 3600)
+    cache.get("t1")  # t2 is now the least recently used
+    cache.put("t3", principal("c@x"), clock.now + 3600)
+    assert list(cache.entries) == ["t1", "t3"]
+    assert "b@x" not in cache.tokens_by_user
+
+
+def test_invalidate_user_drops_all_their_tokens(clock):
+    cache = PrincipalCache()
+    cache.put("t1", principal("a@x"), clock.now + 3600)
+    cache.put("t2", principal("a@x"), clock.now + 3600)
+    cache.put("t3", principal("b@x"), clock.now + 3600)
+    cache.invalidate_user("a@x")
+    assert list(cache.entries) == ["t3"]
+    assert cache.tokens_by_user == {"b@x": {"t3"}}
+
+
+def test_authenticate_caches_principal_until_invalidated():
+    async def scenario():
+        email = "cached@example.com"
+        await database.users.create(email, "not-a-real-hash")
+        token = create_access_token({"sub": email})
+        first = await auth._authenticate(token)
+        await database.users.collection.update_one({"email": email}, {"$set": {"name": "Renamed"}})
+        # Served from the cache until the user's entries are invalidated
+        second = await auth._authenticate(token)
+        auth.invalidate_user(email)
+        third = await auth._authenticate(token)
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert "hashed_password" not in first
+    assert second == first and "name" not in second
+    assert third["name"] == "Renamed"
+
+
+def test_rehash_on_login_invalidates_cached_principal():
+    from fastapi.testclient import TestClient
+    import main
+
+    email = "rehash@example.com"
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=5).hash("secret")  # != BCRYPT_ROUNDS
+    asyncio.run(database.users.create(email, old_hash))
+    token = create_access_token({"sub": email})
+    asyncio.run(auth._authenticate(token))
+    assert auth.principal_cache.get(token) is not None
+
+    response = TestClient(main.app).post("/token", json={"email": email, "password": "secret"})
+    assert response.status_code == 200
+    assert auth.principal_cache.get(token) is None
+    assert asyncio.run(database.users.get_by_email(email))["hashed_password"] != old_hash
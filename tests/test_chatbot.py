@@ -0,0 +1,53 @@
+import asyncio
+from bson import ObjectId
+import database
+from chatbot import PromptBuilder
+from persistence import ChatWriter
+
+
+def turn(user_id, message, session_id=None, **fields):
+    return {"_id": ObjectId(), "user_id": user_id, "user_message": message, "bot_reply": f"re: {message}",
+            "session_id": session_id, **fields}
+
+
+def build(builder, user_id, session_id, message):
+    return asyncio.run(builder.build(user_id, session_id, message, [], []))
+
+
+def test_history_only_for_an_explicit_session():
+    asyncio.run(database.chats.insert_many([
+        turn("history@x", "old question"),
+        turn("history@x", "Pray request", kind=database.PRAYER_KIND),
+        turn("history@x", "first", "s1"),
+        turn("history@x", "other conversation", "s2"),
+    ]))
+    builder = PromptBuilder(database.chats)
+
+    prompt = build(builder, "history@x", None, "a fresh question")
+    assert [m["role"] for m in prompt.messages] == ["system", "user"]
+    assert prompt.history_turns == 0
+
+    prompt = build(builder, "history@x", "s1", "a follow-up")
+    assert [m["content"] for m in prompt.messages[1:]] == ["first", "re: first", "a follow-up"]
+
+
+def test_prayers_never_enter_the_history():
+    asyncio.run(database.chats.insert_many([
+        turn("prayer@x", "Pray request", "s1", kind=database.PRAYER_KIND),
+        turn("prayer@x", "question", "s1"),
+    ]))
+    prompt = build(PromptBuilder(database.chats), "prayer@x", "s1", "next")
+    assert prompt.history_turns == 1
+    assert "Pray request" not in [m["content"] for m in prompt.messages]
+
+
+def test_unwritten_turns_of_the_session_are_included():
+    writer = ChatWriter(database.chats)
+    builder = PromptBuilder(database.chats, pending_turns=writer.pending_turns)
+    writer.unwritten["pending@x"] = {t["_id"]: t for t in [
+        turn("pending@x", "queued", "s1"),
+        turn("pending@x", "elsewhere", "s2"),
+        turn("pending@x", "failed", "s1", bot_reply=""),
+    ]}
+    prompt = build(builder, "pending@x", "s1", "next")
+    assert [m["content"] for m in prompt.messages[1:]] == ["queued", "re: queued", "next"]
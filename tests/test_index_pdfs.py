@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import numpy as np
+import pytest
+import index_pdfs
+from documents import ChunkStore
+from index_pdfs import EmbeddingCache, build_snapshot, chunk_key, update_cache
+from retrieval import IndexSnapshot, Retriever
+from snapshots import CHUNK_STORE_DIR, publish
+
+
+class FakeModel:
+    # Deterministic 8-d vectors derived from the text; counts what it encodes
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts, convert_to_numpy=True, batch_size=None):
+        self.encoded += texts
+        return np.array([
+            np.frombuffer(hashlib.sha256(text.encode("utf-8")).digest()[:8], dtype=np.uint8) / 255.0
+            for text in texts
+        ], dtype="float32")
+
+
+@pytest.fixture
+def model(monkeypatch):
+    fake = FakeModel()
+    monkeypatch.setattr(index_pdfs, "_model", fake)
+    return fake
+
+
+def write(path, words):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(" ".join(words), encoding="utf-8")
+
+
+def ingest(cache, source):
+    changed = update_cache(cache, str(source), workers=1, batch_size=4, chunk_size=3)
+    cache.save()
+    return changed
+
+
+def test_unchanged_files_are_not_reencoded(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three", "four", "five", "six"])
+    write(source / "b.txt", ["seven", "eight", "nine"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    assert ingest(cache, source)
+    assert sorted(model.encoded) == ["four five six", "one two three", "seven eight nine"]
+
+    model.encoded.clear()
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    assert not ingest(cache, source)
+    assert model.encoded == []
+
+
+def test_changed_file_encodes_only_new_chunks(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three", "four", "five", "six"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+
+    model.encoded.clear()
+    write(source / "a.txt", ["one", "two", "three", "ten", "eleven", "twelve"])
+    assert ingest(cache, source)
+    assert model.encoded == ["ten eleven twelve"]
+    assert cache.files["a.txt"]["chunks"] == [chunk_key("one two three"), chunk_key("ten eleven twelve")]
+
+
+def test_identical_chunks_are_stored_once(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three"])
+    write(source / "b.txt", ["one", "two", "three"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    assert model.encoded == ["one two three"]
+    assert len(cache.entries) == 1
+
+
+def test_deleted_file_drops_out(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three"])
+    write(source / "b.txt", ["seven", "eight", "nine"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+
+    (source / "b.txt").unlink()
+    assert ingest(cache, source)
+    assert list(cache.files) == ["a.txt"]
+
+    build = tmp_path / "build"
+    build.mkdir()
+    build_snapshot(cache, "flat", 4, str(build))
+    store = ChunkStore(str(build / CHUNK_STORE_DIR))
+    assert [store.text(i) for i in range(len(store))] == ["one two three"]
+    store.close()
+
+
+def build(tmp_path, cache):
+    path = tmp_path / "build"
+    path.mkdir()
+    build_snapshot(cache, "flat", 4, str(path))
+    return ChunkStore(str(path / CHUNK_STORE_DIR))
+
+
+def test_shared_chunk_keeps_every_source(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three"])
+    write(source / "b.txt", ["one", "two", "three"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    store = build(tmp_path, cache)
+    snapshot = IndexSnapshot("v1", chunk_store=store)
+    assert len(store) == 1
+    assert store.all_metadata(0) == [{"filename": "a.txt"}, {"filename": "b.txt"}]
+    assert snapshot.select("filename", ["b.txt"]).tolist() == [0]
+    assert Retriever._metadata(snapshot, 0, sources=["b.txt"]) == {"filename": "b.txt"}
+    snapshot.close()
+
+
+def test_same_filename_in_two_collections_stays_apart(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "bible" / "notes.txt", ["one", "two", "three"])
+    write(source / "sermons" / "notes.txt", ["seven", "eight", "nine"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    store = build(tmp_path, cache)
+    snapshot = IndexSnapshot("v1", chunk_store=store)
+    ids = snapshot.select("filename", ["sermons/notes.txt"]).tolist()
+    assert [store.text(i) for i in ids] == ["seven eight nine"]
+    assert store.metadata(ids[0]) == {"filename": "sermons/notes.txt", "collection": "sermons"}
+    assert [store.text(i) for i in snapshot.select("collection", ["bible"])] == ["one two three"]
+    snapshot.close()
+
+
+def test_crashed_run_tail_is_truncated(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "a.txt", ["one", "two", "three"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    # Vectors and texts appended without a manifest update, as after a crash mid-run
+    cache.add(["orphan"], ["orphan text"], np.zeros((1, 8), dtype="float32"))
+
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    assert list(cache.entries) == [chunk_key("one two three")]
+    assert cache.vectors().shape == (1, 8)
+
+
+def test_compact_keeps_vectors_and_texts_aligned(tmp_path, model):
+    source = tmp_path / "src"
+    for i in range(4):
+        write(source / f"{i}.txt", [f"w{i}a", f"w{i}b", f"w{i}c"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    key = chunk_key("w3a w3b w3c")
+    vector = cache.vectors()[cache.entries[key][0]].copy()
+
+    for i in range(3):
+        (source / f"{i}.txt").unlink()
+    ingest(cache, source)
+    cache.compact()
+
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    assert list(cache.entries) == [key]
+    with open(cache.texts_path, "rb") as f:
+        texts = f.read()
+    _, offset, length = cache.entries[key]
+    assert texts[offset:offset + length].decode("utf-8") == "w3a w3b w3c"
+    np.testing.assert_array_equal(cache.vectors()[cache.entries[key][0]], vector)
+
+
+def test_per_source_results_list_a_shared_chunk_once(tmp_path, model):
+    source = tmp_path / "src"
+    write(source / "bible.txt", ["one", "two", "three", "four", "five", "six"])
+    write(source / "ot" / "dup.txt", ["one", "two", "three", "seven", "eight", "nine"])
+    cache = EmbeddingCache(str(tmp_path / "state"))
+    ingest(cache, source)
+    root = tmp_path / "snapshots"
+    (root / "v1").mkdir(parents=True)
+    build_snapshot(cache, "flat", 4, str(root / "v1"))
+    publish(str(root), "v1")
+
+    class Embedder:
+        async def encode(self, text):
+            return model.encode([text])[0]
+
+        async def close(self):
+            pass
+
+    rag = Retriever("unused", str(root / "legacy.bin"), str(root / "legacy_chunks"), snapshot_dir=str(root))
+    rag.embedder = Embedder()
+    asyncio.run(rag.reload())
+    chunks, metadata = asyncio.run(rag.retrieve("one two three", sources=["bible.txt", "ot/dup.txt"], per_source_k=2))
+    assert sorted(chunks) == ["four five six", "one two three", "seven eight nine"]
+    labels = {chunk: meta["filename"] for chunk, meta in zip(chunks, metadata)}
+    assert labels == {"one two three": "bible.txt", "four five six": "bible.txt", "seven eight nine": "ot/dup.txt"}
@@ -0,0 +1,91 @@
+import asyncio
+import os
+import faiss
+import numpy as np
+import pytest
+from documents import ChunkStoreWriter
+from lexical import LexicalIndexWriter, fuse, parse_references
+from retrieval import Retriever
+from snapshots import LEXICAL_DIR, publish, snapshot_paths
+
+DIMENSION = 4
+CHUNKS = [
+    "Come to me, all you who are weary and burdened.",
+    "For God so loved the world (John 3:16).",
+    "Job 2:3 says he still maintains his integrity.",
+    "The Lord is my shepherd, Psalm 23.",
+]
+
+
+@pytest.mark.parametrize("text, references", [
+    ("John 3:16", ["john 3:16"]),
+    ("1 Cor. 13:4-6", ["1 corinthians 13:4", "1 corinthians 13:5", "1 corinthians 13:6"]),
+    ("first john 4:8", ["1 john 4:8"]),
+    ("Psalm 23", ["psalms 23"]),
+    ("Ps 23", ["psalms 23"]),
+    ("I lost my job 2 weeks ago", ["job 2"]),
+])
+def test_parse_references(text, references):
+    assert parse_references(text) == references
+
+
+@pytest.mark.parametrize("text, references", [
+    ("John 3:16", ["john 3:16"]),
+    ("Job 2:3", ["job 2:3"]),
+    ("Psalm 23", ["psalms 23"]),
+    ("Romans 8", ["romans 8"]),
+    ("2 Kings 5", ["2 kings 5"]),
+    ("I lost my job 2 weeks ago", []),
+    ("Mark 12 years old", []),
+    ("Ex 3 boyfriend", []),
+    ("Pro 2 tips", []),
+    ("Ps 23", []),
+    ("and i mark 3 papers", []),
+])
+def test_strict_parse_keeps_only_unambiguous_references(text, references):
+    assert parse_references(text, strict=True) == references
+
+
+def test_fuse_ranks_chunks_found_by_several_rankings_first():
+    assert [i for _, i in fuse([[(0.1, 1), (0.2, 2)], [(9.0, 2)], []], k=2)] == [2, 1]
+
+
+class FakeEmbedder:
+    async def encode(self, text):
+        return np.eye(1, DIMENSION, dtype="float32")[0]
+
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def rag(tmp_path):
+    index_file, chunk_store_dir = snapshot_paths(str(tmp_path), "v1")
+    os.makedirs(os.path.dirname(index_file))
+    index = faiss.IndexFlatL2(DIMENSION)
+    index.add(np.eye(len(CHUNKS), DIMENSION, dtype="float32"))
+    faiss.write_index(index, index_file)
+    with ChunkStoreWriter(chunk_store_dir) as writer, \
+            LexicalIndexWriter(os.path.join(os.path.dirname(index_file), LEXICAL_DIR)) as lexical:
+        for text in CHUNKS:
+            writer.add(text, {"filename": "bible.txt"})
+            lexical.add(text)
+    publish(str(tmp_path), "v1")
+    rag = Retriever("unused", str(tmp_path / "legacy.bin"), str(tmp_path / "legacy_chunks"),
+                    snapshot_dir=str(tmp_path))
+    rag.embedder = FakeEmbedder()
+    asyncio.run(rag.reload())
+    return rag
+
+
+def test_unambiguous_reference_skips_vector_search(rag):
+    assert rag.has_reference("What does John 3:16 mean?")
+    chunks, _ = asyncio.run(rag.retrieve("What does John 3:16 mean?", k=3))
+    assert chunks == [CHUNKS[1]]
+
+
+def test_ambiguous_reference_only_boosts_the_fused_ranking(rag):
+    assert not rag.has_reference("I lost my job 2 weeks ago")
+    chunks, _ = asyncio.run(rag.retrieve("I lost my job 2 weeks ago", k=3))
+    assert len(chunks) == 3
+    assert CHUNKS[0] in chunks  # the nearest vector hit still counts
@@ -0,0 +1,172 @@
+import asyncio
+from types import SimpleNamespace
+import httpx
+import openai
+import pytest
+from fastapi import HTTPException
+from llm import Endpoint, LLMGateway
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def timeout_error():
+    return openai.APITimeoutError(request=httpx.Request("POST", "http://llm.test/v1/chat/completions"))
+
+
+def chunk(text):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+
+class FakeStream:
+    def __init__(self, items):
+        self.items = items
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        for item in self.items:
+            if isinstance(item, Exception):
+                raise item
+            yield chunk(item)
+
+
+class FakeClient:
+    # Each create() call takes the next scripted outcome: an exception or a list of tokens
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, model, messages, stream=False):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeStream(outcome)
+
+
+def gateway(*clients, **options):
+    options.setdefault("retry_backoff_ms", 0)
+    endpoints = [Endpoint(f"e{i}", client, "model") for i, client in enumerate(clients)]
+    return LLMGateway(endpoints, **options)
+
+
+async def collect(llm):
+    return "".join([text async for text in llm.stream([])])
+
+
+def test_admission_queues_then_rejects():
+    async def scenario():
+        llm = gateway(max_concurrent=1, max_waiting=1, queue_timeout_ms=1000)
+        first = await llm.admit("a")
+        waiting = asyncio.create_task(llm.admit("b"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as rejected:
+            await llm.admit("c")
+        first.release()
+        second = await waiting
+        second.release()
+        return rejected.value.status_code, llm.active, llm.in_flight
+
+    assert run(scenario()) == (429, 0, {})
+
+
+def test_per_user_limit():
+    async def scenario():
+        llm = gateway(max_per_user=1)
+        lease = await llm.admit("a")
+        with pytest.raises(HTTPException):
+            await llm.admit("a")
+        other = await llm.admit("b")
+        lease.release()
+        other.release()
+        return llm.in_flight
+
+    assert run(scenario()) == {}
+
+
+def test_queue_timeout_frees_the_user_slot():
+    async def scenario():
+        llm = gateway(max_concurrent=1, queue_timeout_ms=10)
+        lease = await llm.admit("a")
+        with pytest.raises(HTTPException):
+            await llm.admit("b")
+        lease.release()
+        return llm.active, llm.in_flight, len(llm.waiters)
+
+    assert run(scenario()) == (0, {}, 0)
+
+
+def test_release_is_idempotent():
+    async def scenario():
+        llm = gateway(max_concurrent=2)
+        first = await llm.admit("a")
+        second = await llm.admit("b")
+        first.release()
+        first.release()
+        active = llm.active
+        second.release()
+        return active, llm.active
+
+    assert run(scenario()) == (1, 0)
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        llm = gateway(max_concurrent=1, queue_timeout_ms=1000)
+        lease = await llm.admit("a")
+        waiting = asyncio.create_task(llm.admit("b"))
+        await asyncio.sleep(0)
+        # The slot is handed over and the waiter cancelled before it runs again
+        lease.release()
+        waiting.cancel()
+        try:
+            (await waiting).release()  # some Python versions let wait_for finish with the result
+        except asyncio.CancelledError:
+            pass
+        third = await llm.admit("c")
+        third.release()
+        return llm.active, llm.in_flight
+
+    assert run(scenario()) == (0, {})
+
+
+def test_retries_then_fails_over_and_skips_the_failed_endpoint():
+    async def scenario():
+        primary = FakeClient([timeout_error(), timeout_error(), ["late"]])
+        secondary = FakeClient([["Hello", " world"], ["again"]])
+        llm = gateway(primary, secondary, max_retries=1, cooldown_seconds=60)
+        first = await collect(llm)
+        second = await collect(llm)
+        return first, second, primary.calls, secondary.calls
+
+    assert run(scenario()) == ("Hello world", "again", 2, 2)
+
+
+def test_no_retry_after_the_first_token():
+    async def scenario():
+        primary = FakeClient([["Hel", timeout_error()]])
+        secondary = FakeClient([["never"]])
+        llm = gateway(primary, secondary)
+        received = []
+        with pytest.raises(openai.APITimeoutError):
+            async for text in llm.stream([]):
+                received.append(text)
+        return received, secondary.calls
+
+    assert run(scenario()) == (["Hel"], 0)
+
+
+def test_all_endpoints_failing_raises_the_last_error():
+    async def scenario():
+        llm = gateway(FakeClient([timeout_error()]), max_retries=0)
+        with pytest.raises(openai.APITimeoutError):
+            await collect(llm)
+
+    run(scenario())
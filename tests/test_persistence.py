@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+from persistence import ChatWriter
+
+
+class FakeRepository:
+    def __init__(self, failures=0):
+        self.batches = []
+        self.failures = failures
+        self.gate = None  # an asyncio.Event holds writes back until set
+
+    async def insert_many(self, turns):
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("write failed")
+        self.batches.append([turn["user_message"] for turn in turns])
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_turns_are_written_in_batches():
+    async def scenario():
+        repository = FakeRepository()
+        writer = ChatWriter(repository, batch_size=2, flush_interval_ms=50)
+        writer.start()
+        for i in range(5):
+            await writer.record("u1", f"q{i}", f"a{i}")
+        await writer.close()
+        return repository.batches
+
+    assert run(scenario()) == [["q0", "q1"], ["q2", "q3"], ["q4"]]
+
+
+def test_pending_turns_are_visible_until_written():
+    async def scenario():
+        repository = FakeRepository()
+        repository.gate = asyncio.Event()
+        writer = ChatWriter(repository, batch_size=10, flush_interval_ms=10)
+        writer.start()
+        first = await writer.record("u1", "q0", "a0", session_id="s")
+        second = await writer.record("u1", "q1", "a1", session_id="s")
+        await writer.record("u2", "other", "reply")
+        await asyncio.sleep(0.05)  # the batch is taken, but its write is held back
+        pending = [turn["_id"] for turn in writer.pending_turns("u1")]
+        repository.gate.set()
+        await writer.close()
+        return pending, [first, second], writer.pending_turns("u1"), writer.unwritten
+
+    pending, recorded, after, unwritten = run(scenario())
+    assert pending == recorded
+    assert after == []
+    assert unwritten == {}
+
+
+def test_forgetting_a_turn_twice_is_harmless():
+    async def scenario():
+        writer = ChatWriter(FakeRepository())
+        writer.start()
+        await writer.record("u1", "q0", "a0")
+        turn = writer.pending_turns("u1")[0]
+        writer._forget([turn])
+        writer._forget([turn])
+        await writer.close()
+        return writer.unwritten
+
+    assert run(scenario()) == {}
+
+
+@pytest.mark.parametrize("failures, written", [(1, [["q0"]]), (10, [])])
+def test_failed_writes_are_retried_then_dropped(failures, written):
+    async def scenario():
+        repository = FakeRepository(failures)
+        writer = ChatWriter(repository, flush_interval_ms=10, max_retries=2, retry_backoff_ms=1)
+        writer.start()
+        await writer.record("u1", "q0", "a0")
+        await writer.close()
+        return repository.batches, writer.pending_turns("u1")
+
+    assert run(scenario()) == (written, [])
+
+
+def test_full_queue_applies_backpressure():
+    async def scenario():
+        repository = FakeRepository()
+        repository.gate = asyncio.Event()
+        writer = ChatWriter(repository, batch_size=1, flush_interval_ms=10, max_queue=1)
+        writer.start()
+        await writer.record("u1", "q0", "a0")  # taken by the worker, whose write is held back
+        await asyncio.sleep(0.02)
+        await writer.record("u1", "q1", "a1")  # fills the queue
+        blocked = asyncio.create_task(writer.record("u1", "q2", "a2"))
+        await asyncio.sleep(0.02)
+        waiting = not blocked.done()
+        repository.gate.set()
+        await blocked
+        await writer.close()
+        return waiting, repository.batches
+
+    assert run(scenario()) == (True, [["q0"], ["q1"], ["q2"]])
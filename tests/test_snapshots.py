@@ -0,0 +1,130 @@
+import asyncio
+import os
+import faiss
+import numpy as np
+import pytest
+from documents import ChunkStoreWriter
+from retrieval import IndexSnapshot, Retriever
+from snapshots import CURRENT_FILE, current_version, prune, publish, resolve, snapshot_paths
+
+DIMENSION = 4
+
+
+def make_snapshot(root, version, texts):
+    index_file, chunk_store_dir = snapshot_paths(str(root), version)
+    os.makedirs(os.path.dirname(index_file))
+    index = faiss.IndexFlatL2(DIMENSION)
+    index.add(np.eye(len(texts), DIMENSION, dtype="float32"))
+    faiss.write_index(index, index_file)
+    with ChunkStoreWriter(chunk_store_dir) as writer:
+        for text in texts:
+            writer.add(text, {"filename": f"{version}.txt"})
+
+
+class FakeEmbedder:
+    async def encode(self, text):
+        return np.eye(1, DIMENSION, dtype="float32")[0]
+
+    async def close(self):
+        pass
+
+
+class FakeChunkStore:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def retriever(root):
+    rag = Retriever("unused", str(root / "legacy.bin"), str(root / "legacy_chunks"), snapshot_dir=str(root))
+    rag.embedder = FakeEmbedder()
+    return rag
+
+
+def test_snapshot_closes_when_retired_and_unused():
+    store = FakeChunkStore()
+    snapshot = IndexSnapshot("v1", chunk_store=store)
+    with snapshot:
+        snapshot.retire()
+        assert not store.closed  # still serving a request
+    assert store.closed
+    assert snapshot.chunk_store is None
+
+
+def test_unused_snapshot_closes_on_retire():
+    store = FakeChunkStore()
+    IndexSnapshot("v1", chunk_store=store).retire()
+    assert store.closed
+
+
+def test_publish_resolve_and_prune(tmp_path):
+    assert resolve(str(tmp_path), "legacy.bin", "legacy_chunks") == ("legacy", "legacy.bin", "legacy_chunks")
+    for version in ("v1", "v2", "v3"):
+        make_snapshot(tmp_path, version, ["a"])
+    publish(str(tmp_path), "v2")
+    assert current_version(str(tmp_path)) == "v2"
+    assert resolve(str(tmp_path), "legacy.bin", "legacy_chunks") == ("v2",) + snapshot_paths(str(tmp_path), "v2")
+
+    prune(str(tmp_path), keep=1)
+    # The live snapshot survives even though it is not the newest
+    assert sorted(os.listdir(tmp_path)) == [CURRENT_FILE, "v2", "v3"]
+
+
+def test_reload_swaps_in_the_new_snapshot_after_requests_finish(tmp_path):
+    async def scenario():
+        make_snapshot(tmp_path, "v1", ["old"])
+        publish(str(tmp_path), "v1")
+        rag = retriever(tmp_path)
+        assert await rag.reload()
+        assert not await rag.reload()  # nothing new published
+
+        make_snapshot(tmp_path, "v2", ["new"])
+        publish(str(tmp_path), "v2")
+        with rag.snapshot as in_flight:
+            assert await rag.reload()
+            # The request that started on v1 still reads v1
+            assert in_flight.chunk_store.text(0) == "old"
+            assert rag.snapshot.version == "v2"
+        chunks, _ = await rag.retrieve("anything", k=1)
+        return in_flight.chunk_store, chunks
+
+    old_store, chunks = asyncio.run(scenario())
+    assert old_store is None  # closed once the request was done
+    assert chunks == ["new"]
+
+
+def test_failed_reload_keeps_serving_the_old_snapshot(tmp_path):
+    async def scenario():
+        make_snapshot(tmp_path, "v1", ["old"])
+        publish(str(tmp_path), "v1")
+        rag = retriever(tmp_path)
+        await rag.reload()
+        os.makedirs(tmp_path / "v2" / "chunk_store")
+        with open(tmp_path / "v2" / "faiss_index.bin", "wb") as f:
+            f.write(b"not an index")
+        publish(str(tmp_path), "v2")
+        try:
+            await rag.reload()
+        except Exception:
+            pass
+        chunks, _ = await rag.retrieve("anything", k=1)
+        return rag.snapshot.version, chunks
+
+    assert asyncio.run(scenario()) == ("v1", ["old"])
+
+
+def test_failed_start_leaves_nothing_running(tmp_path, monkeypatch):
+    class BrokenModel:
+        def encode(self, texts, **kwargs):
+            raise RuntimeError("warmup failed")
+
+    monkeypatch.setattr("retrieval.load_model", lambda *args: BrokenModel())
+    make_snapshot(tmp_path, "v1", ["a"])
+    publish(str(tmp_path), "v1")
+    rag = Retriever("unused", str(tmp_path / "legacy.bin"), str(tmp_path / "legacy_chunks"), snapshot_dir=str(tmp_path))
+    with pytest.raises(RuntimeError):
+        asyncio.run(rag.start())
+    assert not rag.ready and rag.embedder is None
+    assert rag.snapshot.version is None
@@ -0,0 +1,51 @@
+import asyncio
+import pytest
+import main
+from embeddings import MissingModelFiles, check_model_files
+
+
+def test_missing_weights_are_reported_clearly(tmp_path):
+    (tmp_path / "config.json").write_text("{}")
+    with pytest.raises(MissingModelFiles, match="model.safetensors"):
+        check_model_files(str(tmp_path))
+    (tmp_path / "model.safetensors").write_bytes(b"")
+    check_model_files(str(tmp_path))
+    with pytest.raises(MissingModelFiles, match="export_onnx.py"):
+        check_model_files(str(tmp_path), backend="onnx")
+
+
+def test_missing_model_files_are_not_retried(monkeypatch):
+    attempts = []
+
+    async def load_rag():
+        attempts.append(1)
+        raise MissingModelFiles("no weights")
+
+    monkeypatch.setattr(main, "load_rag", load_rag)
+    with pytest.raises(MissingModelFiles):
+        asyncio.run(main.prepare_rag())
+    assert len(attempts) == 1
+
+
+def test_retry_does_not_restart_a_started_rag(monkeypatch):
+    starts = []
+    failures = [RuntimeError("tokenizer download failed")]
+
+    async def start():
+        starts.append(1)
+        main.rag.ready = True
+
+    async def prepare(encode):
+        if failures:
+            raise failures.pop()
+
+    monkeypatch.setattr(main.rag, "ready", False)
+    monkeypatch.setattr(main.rag, "start", start)
+    monkeypatch.setattr(main.intent_router, "prepare", prepare)
+    sleep = asyncio.sleep
+    monkeypatch.setattr(main.asyncio, "sleep", lambda delay: sleep(0))
+    monkeypatch.setitem(main.readiness, "rag", False)
+    monkeypatch.setitem(main.readiness, "intents", False)
+    asyncio.run(main.prepare_rag())
+    assert len(starts) == 1
+    assert main.readiness["intents"]
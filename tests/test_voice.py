@@ -0,0 +1,23 @@
+import asyncio
+import json
+from streaming import SSEStream
+from voice import FakeTTS, Speaker, interleave
+
+REPLY = (
+    "Peace I leave with you; my peace I give you. "
+    "Do not let your hearts be troubled and do not be afraid. "
+    "Come to me, all you who are weary and burdened, and I will give you rest."
+)
+
+
+def test_text_fields_of_a_voice_reply_rebuild_the_reply():
+    async def scenario():
+        speaker = Speaker(FakeTTS(delay_ms=1, bytes_per_char=1), min_chars=20)
+        stream = SSEStream(max_frame_bytes=32, on_text=speaker.feed)
+        return [frame async for frame in interleave(stream.static_frames(REPLY), speaker)]
+
+    payloads = [json.loads(frame[len(b"data: "):]) for frame in asyncio.run(scenario())]
+    ends = [payload for payload in payloads if "audio_end" in payload]
+    assert len(ends) > 1
+    assert "".join(payload["sentence_text"] for payload in ends).replace(" ", "") == REPLY.replace(" ", "")
+    assert "".join(payload.get("text", "") for payload in payloads) == REPLY
@@ -0,0 +1,38 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+import database
+import main
+from auth import create_access_token
+
+
+@pytest.fixture
+def token(monkeypatch):
+    for key in main.readiness:
+        monkeypatch.setitem(main.readiness, key, True)
+    email = "socket@example.com"
+    if asyncio.run(database.users.get_by_email(email)) is None:
+        asyncio.run(database.users.create(email, "not-a-real-hash"))
+    return create_access_token({"sub": email})
+
+
+def test_query_token_and_session_id(token):
+    with TestClient(main.app).websocket_connect(f"/ws/chat?token={token}&session_id=s1") as websocket:
+        assert websocket.receive_json() == {"type": "ready", "user": "socket@example.com", "session_id": "s1"}
+
+
+def test_header_auth_takes_session_id_from_query(token):
+    headers = {"Authorization": f"Bearer {token}"}
+    with TestClient(main.app).websocket_connect("/ws/chat?session_id=s2", headers=headers) as websocket:
+        assert websocket.receive_json()["session_id"] == "s2"
+
+
+def test_auth_message_without_query_params(token):
+    with TestClient(main.app).websocket_connect("/ws/chat") as websocket:
+        websocket.send_json({"type": "auth", "token": token, "session_id": "s3"})
+        assert websocket.receive_json()["session_id"] == "s3"
+
+
+def test_invalid_query_token_is_rejected(token):
+    with TestClient(main.app).websocket_connect("/ws/chat?token=bogus") as websocket:
+        assert websocket.receive_json()["type"] == "error"
@@ -0,0 +1,115 @@
+import logging
+import math
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Supported FAISS index types, chosen at build time
+INDEX_TYPES = ("flat", "ivf_flat", "hnsw", "ivf_pq")
+
+# faiss warns below ~39 training points per centroid; PQ needs 2^bits points per sub-quantizer
+MIN_POINTS_PER_CENTROID = 39
+
+
+def default_nlist(n_vectors):
+    # Rule of thumb: ~4*sqrt(N) inverted lists
+    return max(1, int(4 * math.sqrt(n_vectors)))
+
+
+def default_pq_m(dimension):
+    # Largest sub-quantizer count <= dimension / 8 that divides the dimension
+    for m in range(max(1, dimension // 8), 0, -1):
+        if dimension % m == 0:
+            return m
+    return 1
+
+
+def create_index(dimension, index_type="flat", n_vectors=0, nlist=None, hnsw_m=32,
+                 ef_construction=200, pq_m=None, pq_bits=8):
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dimension)
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        return index
+
+    nlist = nlist or default_nlist(n_vectors)
+    if n_vectors < nlist * MIN_POINTS_PER_CENTROID:
+        # Shrink the number of lists rather than train badly placed centroids
+        nlist = n_vectors // MIN_POINTS_PER_CENTROID
+        logger.warning(f"Only {n_vectors} vectors to train {index_type}; reducing nlist to {nlist}")
+    min_points = 2 ** pq_bits if index_type == "ivf_pq" else MIN_POINTS_PER_CENTROID
+    if nlist < 1 or n_vectors < min_points:
+        logger.warning(f"{n_vectors} vectors are too few to train {index_type}; falling back to flat")
+        return faiss.IndexFlatL2(dimension)
+
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_L2)
+    return faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m or default_pq_m(dimension), pq_bits)
+
+
+def train_index(index, embeddings, max_training_points=100_000, seed=0):
+    if index.is_trained:
+        return
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    if len(embeddings) > max_training_points:
+        rng = np.random.default_rng(seed)
+        embeddings = embeddings[rng.choice(len(embeddings), max_training_points, replace=False)]
+    logger.info(f"Training {type(index).__name__} on {len(embeddings)} vectors")
+    index.train(embeddings)
+
+
+def build_index(embeddings, index_type="flat", **kwargs):
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    index = create_index(embeddings.shape[1], index_type, n_vectors=len(embeddings), **kwargs)
+    train_index(index, embeddings)
+    index.add(embeddings)
+    return index
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    # Query-time knobs: nprobe for IVF variants, efSearch for HNSW. Unset
+    # values keep whatever the index was built with.
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None and nprobe:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None and ef_search:
+        hnsw.efSearch = ef_search
+
+
+def search_parameters(index, selector):
+    # Search-time parameters restricted to `selector`. They replace the index's
+    # own query knobs for that call, so nprobe / efSearch are carried over.
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        ivf = None
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    hnsw = getattr(faiss.downcast_index(index), "hnsw", None)
+    if hnsw is not None:
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def describe(index):
+    index = faiss.downcast_index(index)
+    name = type(index).__name__
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        return f"{name}(ntotal={index.ntotal}, nlist={ivf.nlist}, nprobe={ivf.nprobe})"
+    except RuntimeError:
+        pass
+    if hasattr(index, "hnsw"):
+        return f"{name}(ntotal={index.ntotal}, efSearch={index.hnsw.efSearch})"
+    return f"{name}(ntotal={index.ntotal})"
@@ -0,0 +1,284 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+import httpx
+from metrics import record
+from streaming import sse_event
+
+logger = logging.getLogger(__name__)
+
+# Text-to-speech for the voice endpoints (/chat/voice, /pray/voice).
+#
+# A Speaker is fed the reply text as it streams in. It cuts the text at
+# sentence boundaries and starts synthesizing each sentence right away, up to
+# `max_ahead` sentences ahead of the one being sent. So the next sentence is
+# being synthesized while the current one is still streaming, and the LLM
+# keeps generating meanwhile. Audio chunks go out in sentence order as SSE
+# events as soon as the provider returns them.
+#
+# Synthesized sentences are kept in an AudioCache keyed by a hash of
+# (text, voice, model, format) and bounded by total bytes, so fixed texts
+# such as the prayer are served without a TTS call after the first time.
+#
+# Providers implement `stream(text)` (an async iterator of audio bytes) and
+# the `voice`, `model` and `format` attributes. ElevenLabsTTS calls the
+# ElevenLabs streaming API; FakeTTS produces deterministic bytes after a
+# configurable delay, for local runs and load tests.
+
+
+class ElevenLabsTTS:
+    def __init__(self, api_key, voice, model="eleven_multilingual_v2", format="mp3_44100_128",
+                 base_url="https://api.elevenlabs.io", max_concurrent=8, connect_timeout=5.0, read_timeout=30.0):
+        self.voice = voice
+        self.model = model
+        self.format = format
+        # ElevenLabs limits concurrent requests per plan: queue here rather than collect 429s
+        self.max_concurrent = max_concurrent
+        self.slots = None  # created on first use, inside the running loop
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers={"xi-api-key": api_key},
+            timeout=httpx.Timeout(connect=connect_timeout, read=read_timeout, write=10.0, pool=read_timeout),
+            limits=httpx.Limits(max_connections=max_concurrent, max_keepalive_connections=max_concurrent),
+        )
+
+    async def stream(self, text):
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_concurrent)
+        async with self.slots:
+            async with self.client.stream(
+                "POST",
+                f"/v1/text-to-speech/{self.voice}/stream",
+                params={"output_format": self.format},
+                json={"text": text, "model_id": self.model},
+            ) as response:
+                if response.status_code != 200:
+                    body = await response.aread()
+                    raise RuntimeError(f"ElevenLabs returned {response.status_code}: {body[:200]!r}")
+                async for chunk in response.aiter_bytes():
+                    yield chunk
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class FakeTTS:
+    def __init__(self, delay_ms=100, bytes_per_char=200, chunk_bytes=4096):
+        self.voice = "fake"
+        self.model = "fake"
+        self.format = "fake"
+        self.delay = delay_ms / 1000
+        self.bytes_per_char = bytes_per_char
+        self.chunk_bytes = chunk_bytes
+        self.calls = 0
+
+    async def stream(self, text):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        audio = (seed * (len(text) * self.bytes_per_char // len(seed) + 1))[:len(text) * self.bytes_per_char]
+        for start in range(0, len(audio), self.chunk_bytes):
+            yield audio[start:start + self.chunk_bytes]
+            await asyncio.sleep(0)
+
+    async def close(self):
+        pass
+
+
+class AudioCache:
+    # LRU of synthesized sentences, bounded by total audio bytes
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tts, text):
+        return hashlib.sha256(f"{tts.model}\0{tts.voice}\0{tts.format}\0{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        audio = self.entries.get(key)
+        if audio is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return audio
+
+    def put(self, key, audio):
+        if len(audio) > self.max_bytes // 8 or key in self.entries:
+            return  # one long sentence must not flush everything else
+        self.entries[key] = audio
+        self.size += len(audio)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+# End of a sentence: terminal punctuation, optional closing quotes/brackets, then whitespace
+SENTENCE_END = re.compile(r"[.!?;]+[\"'”’)\]]*\s+|\n+")
+
+
+class SentenceSplitter:
+    # Cuts streamed text into sentences. Pieces shorter than `min_chars` are
+    # merged with the next one (fewer, more natural TTS calls; "e.g." or
+    # "6:33." do not end a sentence on their own), and run-ons are cut at a
+    # space once they exceed `max_chars`.
+    def __init__(self, min_chars=40, max_chars=400):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_END.finditer(self.buffer):
+            if match.end() - start >= self.min_chars:
+                sentences.append(self.buffer[start:match.end()].strip())
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        while len(self.buffer) > self.max_chars:
+            cut = self.buffer.rfind(" ", 0, self.max_chars)
+            cut = self.max_chars if cut <= 0 else cut
+            sentences.append(self.buffer[:cut].strip())
+            self.buffer = self.buffer[cut:]
+        return [sentence for sentence in sentences if sentence]
+
+    def flush(self):
+        rest, self.buffer = self.buffer.strip(), ""
+        return [rest] if rest else []
+
+
+class Speaker:
+    def __init__(self, tts, cache=None, max_ahead=2, min_chars=40, max_chars=400):
+        self.tts = tts
+        self.cache = cache
+        self.splitter = SentenceSplitter(min_chars, max_chars)
+        self.sentences = asyncio.Queue()  # sentence texts, then None
+        self.slots = asyncio.Semaphore(max_ahead)  # sentences synthesized but not yet fully sent
+        self.tasks = set()
+        self.started = time.perf_counter()
+
+    def feed(self, text):
+        for sentence in self.splitter.feed(text):
+            self.sentences.put_nowait(sentence)
+
+    def finish(self):
+        for sentence in self.splitter.flush():
+            self.sentences.put_nowait(sentence)
+        self.sentences.put_nowait(None)
+
+    async def _synthesize(self, sentence, chunks):
+        # Fills `chunks` with audio bytes, then None, or an exception on failure
+        key = AudioCache.key(self.tts, sentence) if self.cache is not None else None
+        cached = self.cache.get(key) if key is not None else None
+        if cached is not None:
+            chunks.put_nowait(cached)
+            chunks.put_nowait(None)
+            return
+        parts = []
+        try:
+            async for chunk in self.tts.stream(sentence):
+                parts.append(chunk)
+                chunks.put_nowait(chunk)
+        except Exception as e:
+            chunks.put_nowait(e)
+            return
+        if key is not None:
+            self.cache.put(key, b"".join(parts))
+        chunks.put_nowait(None)
+
+    async def _schedule(self, jobs):
+        # Start each sentence's synthesis as soon as it is complete and a slot is free
+        while True:
+            sentence = await self.sentences.get()
+            if sentence is None:
+                jobs.put_nowait(None)
+                return
+            await self.slots.acquire()
+            chunks = asyncio.Queue()
+            task = asyncio.create_task(self._synthesize(sentence, chunks))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            jobs.put_nowait((sentence, chunks))
+
+    async def frames(self):
+        # SSE audio events in sentence order; ends after finish() once everything is sent
+        jobs = asyncio.Queue()
+        scheduler = asyncio.create_task(self._schedule(jobs))
+        index = 0
+        try:
+            while True:
+                job = await jobs.get()
+                if job is None:
+                    return
+                sentence, chunks = job
+                try:
+                    seq = 0
+                    while True:
+                        chunk = await chunks.get()
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, Exception):
+                            logger.error(f"TTS failed for sentence {index}: {str(chunk)}")
+                            yield sse_event({"audio_error": str(chunk), "sentence": index})
+                            break
+                        if index == 0 and seq == 0:
+                            record("tts_first_audio", time.perf_counter() - self.started)
+                        yield sse_event({
+                            "audio": base64.b64encode(chunk).decode("ascii"),
+                            "format": self.tts.format,
+                            "sentence": index,
+                            "seq": seq,
+                        })
+                        seq += 1
+                finally:
+                    self.slots.release()
+                # Not "text": joining the text fields of a reply must give back the reply
+                yield sse_event({"audio_end": index, "sentence_text": sentence})
+                index += 1
+        finally:
+            scheduler.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+
+
+async def interleave(frames, speaker):
+    # Merge the text frames of a reply with the speaker's audio frames. The
+    # text side feeds the speaker (see SSEStream's on_text) and ends it.
+    queue = asyncio.Queue()
+
+    async def pump_text():
+        try:
+            async for frame in frames:
+                queue.put_nowait(frame)
+        finally:
+            speaker.finish()
+
+    async def pump_audio():
+        async for frame in speaker.frames():
+            queue.put_nowait(frame)
+
+    tasks = [asyncio.create_task(pump_text()), asyncio.create_task(pump_audio())]
+    for task in tasks:
+        task.add_done_callback(lambda _: queue.put_nowait(None))
+    running = len(tasks)
+    try:
+        while running:
+            frame = await queue.get()
+            if frame is None:
+                running -= 1
+                continue
+            yield frame
+        for task in tasks:
+            task.result()  # re-raise what failed, e.g. the LLM stream
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+
+logger = logging.getLogger(__name__)
+
+# Building blocks of the /ws/chat transport (the endpoint itself is in main.py).
+#
+# Connect to /ws/chat?session_id=... and authenticate with an Authorization:
+# Bearer header, a ?token= query parameter, or an auth message. session_id is
+# optional; without one every question stands alone.
+#
+# Protocol, one JSON object per WebSocket text message:
+#
+#   client -> server
+#     {"type": "auth", "token": "<jwt>", "session_id": "..."}   first, unless a header or ?token= was given
+#     {"type": "message", "id": "1", "message": "...", ...}     ChatRequest fields, plus "voice": true
+#     {"type": "cancel"}                                         stop the reply in progress
+#     {"type": "ping"} / {"type": "pong"}
+#
+#   server -> client
+#     {"type": "ready", "user": "...", "session_id": ...}
+#     {"id": "1", ...}       the same payloads as the /chat SSE events (sources, text, audio, done, error)
+#     {"id": "1", "cancelled": true}
+#     {"type": "ping"} / {"type": "pong"} / {"type": "error", "error": "..."}
+#
+# One reply streams at a time; a new message cancels the one in progress. The
+# connection authenticates once and keeps a ChatSession: the user, the recent
+# turns of its conversation and a few cached retrieval results.
+
+# Close codes
+POLICY_VIOLATION = 1008
+TRY_AGAIN_LATER = 1013
+GOING_AWAY = 1001
+
+_DATA = b"data: "
+_END = b"\n\n"
+
+
+def sse_to_message(frame, reply_id):
+    # Turn one SSE frame of a reply ("data: {...}\n\n") into a WebSocket
+    # message tagged with the reply id, without re-encoding the payload
+    payload = frame[len(_DATA):-len(_END)].decode("utf-8")
+    return '{"id": ' + json.dumps(reply_id) + ", " + payload[1:]
+
+
+class ChatSession:
+    def __init__(self, user, session_id=None, turn_window=10, max_contexts=16):
+        self.user = user
+        self.session_id = session_id
+        self.turn_window = turn_window
+        self.turns = None  # loaded on the first message, then kept up to date here
+        self.contexts = OrderedDict()  # (message, filters, index version) -> retrieval result
+        self.max_contexts = max_contexts
+
+    async def recent_turns(self, load):
+        if self.session_id is None:
+            return []  # no conversation to remember, like /chat without a session_id
+        if self.turns is None:
+            self.turns = await load(self.user["email"], self.session_id)
+        return list(self.turns)
+
+    def add_turn(self, turn_id, user_message, bot_reply):
+        if self.turns is None or not bot_reply:
+            return
+        self.turns.append({
+            "_id": turn_id,
+            "user_id": self.user["email"],
+            "user_message": user_message,
+            "bot_reply": bot_reply,
+            "session_id": self.session_id,
+        })
+        del self.turns[:-self.turn_window]
+
+    def context(self, key):
+        value = self.contexts.get(key)
+        if value is not None:
+            self.contexts.move_to_end(key)
+        return value
+
+    def remember(self, key, value):
+        self.contexts[key] = value
+        while len(self.contexts) > self.max_contexts:
+            self.contexts.popitem(last=False)
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class Connection:
+    # Outgoing messages go through a bounded queue drained by one sender task.
+    # A reply waits for room (so a slow client slows its own LLM stream down
+    # instead of growing memory), and a client that stays full for
+    # `send_timeout` seconds is disconnected.
+    def __init__(self, websocket, max_queue=64, send_timeout=10.0, heartbeat=20.0, idle_timeout=60.0):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.send_timeout = send_timeout
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self.last_seen = time.monotonic()
+        self.tasks = []
+        self.closed = False
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._send_loop()), asyncio.create_task(self._heartbeat_loop())]
+
+    async def send(self, text):
+        try:
+            await asyncio.wait_for(self.queue.put(text), self.send_timeout)
+        except asyncio.TimeoutError:
+            await self.close(TRY_AGAIN_LATER, "Client is not reading")
+            raise SlowConsumer()
+
+    def send_control(self, payload):
+        # Control messages never wait; with a full queue the client sees the replies first
+        try:
+            self.queue.put_nowait(json.dumps(payload))
+        except asyncio.QueueFull:
+            pass
+
+    async def receive(self):
+        text = await self.websocket.receive_text()
+        self.last_seen = time.monotonic()
+        return text
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self.websocket.send_text(await self.queue.get())
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # the receive side notices the disconnect
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat)
+            if time.monotonic() - self.last_seen > self.idle_timeout:
+                logger.info("Closing idle WebSocket")
+                await self.close(GOING_AWAY, "Idle timeout")
+                return
+            self.send_control({"type": "ping"})
+
+    async def close(self, code=1000, reason=None):
+        if self.closed:
+            return
+        self.closed = True
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code, reason)
+            except RuntimeError:
+                pass
+
+    async def shutdown(self):
+        for task in self.tasks:
+            task.cancel()
+        await self.close()